@@ -0,0 +1,167 @@
+"""
+Microbenchmarks of the utils.diff_tools converters on the generated diff corpus (see benchmarks.diff_corpus)
+
+    python -m benchmarks.diff_converters --sizes 1K,1M,16M
+    python -m benchmarks.diff_converters --sizes 256M --repeat 1
+
+Every converter is timed on every corpus size and run once more under tracemalloc for its peak allocation.
+Outputs are checked against the digests in benchmarks/golden/diff_converters.json, so an optimization that changes a
+generated patch fails the run (exit code 1). --update-golden records the digests of the current outputs instead.
+Results are appended to the output file as JSON lines, one line per run.
+"""
+import argparse
+import hashlib
+import io
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import time
+import tracemalloc
+from typing import Callable, NamedTuple
+
+from benchmarks import diff_corpus
+from utils import diff_tools
+
+GOLDEN_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "golden", "diff_converters.json")
+REVISION = "1234"
+
+
+class Case(NamedTuple):
+    name: str
+    kind: str
+    run: Callable[[str], str]
+    # cases producing the same output share their golden digests
+    golden: str
+
+
+def spool(diff, convert):
+    out = io.StringIO()
+    diff_tools.spool_diff(iter(diff.split("\n")), out, convert, REVISION)
+    return out.getvalue()
+
+
+CASES = (
+    Case("svn_format_diff", "git", lambda diff: "\n".join(diff_tools.svn_format_diff(diff, REVISION)),
+         "svn_format_diff"),
+    Case("spool_diff(svn)", "git", lambda diff: spool(diff, "svn"), "svn_format_diff"),
+    Case("git_format_diff", "svn", lambda diff: "\n".join(diff_tools.git_format_diff(diff, REVISION)),
+         "git_format_diff"),
+    Case("spool_diff(git)", "svn", lambda diff: spool(diff, "git"), "git_format_diff"),
+    Case("git_get_binary_files", "git", lambda diff: json.dumps(diff_tools.git_get_binary_files(diff)),
+         "git_get_binary_files"),
+    Case("git_get_rename_files", "git", lambda diff: json.dumps(diff_tools.git_get_rename_files(diff)),
+         "git_get_rename_files"),
+)
+
+
+def time_case(case: Case, diff, repeat):
+    timings = []
+    output = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        output = case.run(diff)
+        timings.append(time.perf_counter() - start)
+    return output, timings
+
+
+def trace_allocations(case: Case, diff):
+    """:return: peak bytes allocated while converting, and bytes still allocated after (the output included)"""
+    tracemalloc.start()
+    try:
+        output = case.run(diff)
+        current, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    del output
+    return peak, current
+
+
+def digest(output):
+    return hashlib.sha256(output.encode("utf-8", errors="surrogatepass")).hexdigest()
+
+
+def load_golden():
+    if not os.path.exists(GOLDEN_FILE):
+        return {}
+    with open(GOLDEN_FILE, encoding="utf-8") as golden_file:
+        return json.load(golden_file)
+
+
+def save_golden(golden):
+    os.makedirs(os.path.dirname(GOLDEN_FILE), exist_ok=True)
+    with open(GOLDEN_FILE, "w", encoding="utf-8") as golden_file:
+        json.dump(golden, golden_file, indent=2, sort_keys=True)
+        golden_file.write("\n")
+
+
+def tree_revision():
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], cwd=os.path.dirname(os.path.abspath(__file__)),
+                              stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, check=True).stdout.decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--sizes", default="1K,64K,1M,16M", help=f"comma separated, from: {', '.join(diff_corpus.SIZES)}")
+    parser.add_argument("--cases", default=",".join(case.name for case in CASES))
+    parser.add_argument("--repeat", type=int, default=5, help="timed runs of every case, the best one is reported")
+    parser.add_argument("--seed", type=int, default=0, help="corpus seed, golden digests exist for seed 0 only")
+    parser.add_argument("--corpus", default="output/benchmarks/corpus", help="where generated diffs are cached")
+    parser.add_argument("--no-alloc", action="store_true", help="skip the tracemalloc run")
+    parser.add_argument("--update-golden", action="store_true", help="record the outputs as the expected ones")
+    parser.add_argument("--output", default="output/benchmarks/diff_converters.jsonl")
+    args = parser.parse_args(argv)
+
+    cases = [case for case in CASES if case.name in args.cases.split(",")]
+    golden = load_golden()
+    results = []
+    mismatches = 0
+    for size_name in args.sizes.split(","):
+        corpus = {kind: diff_corpus.load(args.corpus, kind, size_name, args.seed) for kind in diff_corpus.KINDS}
+        for case in cases:
+            diff = corpus[case.kind]
+            output, timings = time_case(case, diff, args.repeat)
+            peak, retained = trace_allocations(case, diff) if not args.no_alloc else (None, None)
+
+            key = f"{case.golden}/{case.kind}_{size_name}_{args.seed}"
+            output_digest = digest(output)
+            if args.update_golden:
+                golden[key] = output_digest
+                check = "updated"
+            elif key not in golden:
+                check = "missing"
+            else:
+                check = "ok" if golden[key] == output_digest else "mismatch"
+                mismatches += check == "mismatch"
+
+            best = min(timings)
+            result = {'case': case.name, 'corpus': case.kind, 'size': size_name, 'input_bytes': len(diff),
+                      'output_bytes': len(output), 'best_seconds': best, 'median_seconds': statistics.median(timings),
+                      'mb_per_second': len(diff) / best / 2 ** 20 if best > 0 else None,
+                      'peak_alloc_bytes': peak, 'retained_bytes': retained, 'golden': check}
+            results.append(result)
+            print(f"{case.name:<22} {case.kind}_{size_name:<5} {best * 1000:10.2f} ms "
+                  f"{result['mb_per_second'] or 0:8.1f} MB/s  peak {(peak or 0) / 2 ** 20:8.1f} MiB  {check}")
+
+    if args.update_golden:
+        save_golden(golden)
+
+    os.makedirs(os.path.dirname(os.path.abspath(args.output)), exist_ok=True)
+    with open(args.output, "a", encoding="utf-8") as output_file:
+        output_file.write(json.dumps({'timestamp': time.time(), 'tree': tree_revision(),
+                                      'platform': platform.platform(), 'python': platform.python_version(),
+                                      'repeat': args.repeat, 'seed': args.seed, 'results': results}) + "\n")
+
+    if mismatches:
+        print(f"{mismatches} outputs differ from the golden digests", file=sys.stderr)
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,207 @@
+"""
+Generated diffs for the converter benchmarks, deterministic for a given kind, size and seed
+
+'git' diffs look like 'git diff --no-prefix --binary' output (the input of svn_format_diff), 'svn' diffs like
+'svn diff --git' output (the input of git_format_diff). Both mix text hunks, new and deleted files, binary files,
+mode changes and renames, svn diffs also carry property blocks and svn:ignore-only sections.
+"""
+import base64
+import os
+import random
+
+SIZES = {'1K': 1024, '64K': 64 * 1024, '1M': 1024 ** 2, '16M': 16 * 1024 ** 2, '256M': 256 * 1024 ** 2}
+KINDS = ("git", "svn")
+
+WORDS = ("sync", "revision", "patch", "hunk", "file", "tree", "commit", "diff", "branch", "merge", "author", "log")
+
+
+class DiffBuilder:
+    """Appends file sections of a random kind until the diff reaches the requested size"""
+
+    def __init__(self, seed):
+        self.random = random.Random(seed)
+        self.parts = []
+        self.size = 0
+        self.files = 0
+
+    def build(self, size, sections):
+        names, weights = zip(*sections)
+        while self.size < size:
+            self.random.choices(names, weights)[0](self)
+        # like GitPython and svn, no newline after the last line
+        return "".join(self.parts).rstrip("\n")
+
+    def add(self, *lines):
+        for line in lines:
+            self.parts.append(line + "\n")
+            self.size += len(line) + 1
+
+    def path(self, extension="txt"):
+        self.files += 1
+        depth = self.random.randint(0, 4)
+        directories = "".join(f"{self.random.choice(WORDS)}{self.random.randint(0, 9)}/" for _ in range(depth))
+        return f"src/{directories}{self.random.choice(WORDS)}_{self.files}.{extension}"
+
+    def sha(self):
+        return f"{self.random.getrandbits(28):07x}"
+
+    def text(self):
+        return " ".join(self.random.choices(WORDS, k=self.random.randint(1, 12)))
+
+    def hunks(self, count=None, new=False, deleted=False):
+        """unified diff hunks (header included) with context, removed and added lines"""
+        start = 1
+        for _ in range(count or self.random.randint(1, 6)):
+            if new or deleted:
+                body = [("+" if new else "-") + self.text() for _ in range(self.random.randint(1, 40))]
+                self.add(f"@@ -{0 if new else 1},{0 if new else len(body)} +{1 if new else 0},"
+                         f"{len(body) if new else 0} @@", *body)
+                return
+
+            start += self.random.randint(0, 50)
+            before, removed, added, after = (self.random.randint(0, 3), self.random.randint(0, 8),
+                                             self.random.randint(0, 8), self.random.randint(0, 3))
+            body = ([" " + self.text() for _ in range(before)] + ["-" + self.text() for _ in range(removed)] +
+                    ["+" + self.text() for _ in range(added)] + [" " + self.text() for _ in range(after)])
+            self.add(f"@@ -{start},{before + removed + after} +{start},{before + added + after} @@ "
+                     f"{self.random.choice(WORDS)}()", *body)
+            start += before + removed + after
+
+    def binary_patch(self):
+        """a 'GIT binary patch' literal, base85 lines as git writes them"""
+        data = self.random.randbytes(self.random.randint(16, 4096))
+        self.add("GIT binary patch", f"literal {len(data)}")
+        for offset in range(0, len(data), 52):
+            chunk = data[offset:offset + 52]
+            length = chr(ord("A") + len(chunk) - 1) if len(chunk) <= 26 else chr(ord("a") + len(chunk) - 27)
+            self.add(length + base64.b85encode(chunk).decode("ascii"))
+        self.add("", "literal 0", "HcmV?d00001", "")
+
+
+def git_modified(b: DiffBuilder):
+    path = b.path()
+    b.add(f"diff --git {path} {path}", f"index {b.sha()}..{b.sha()} 100644", f"--- {path}", f"+++ {path}")
+    b.hunks()
+
+
+def git_new(b: DiffBuilder):
+    path = b.path()
+    b.add(f"diff --git {path} {path}", "new file mode 100644", f"index 0000000..{b.sha()}", "--- /dev/null",
+          f"+++ {path}")
+    b.hunks(new=True)
+
+
+def git_deleted(b: DiffBuilder):
+    path = b.path()
+    b.add(f"diff --git {path} {path}", "deleted file mode 100644", f"index {b.sha()}..0000000", f"--- {path}",
+          "+++ /dev/null")
+    b.hunks(deleted=True)
+
+
+def git_binary(b: DiffBuilder):
+    path = b.path("png")
+    new = b.random.random() < 0.5
+    b.add(f"diff --git {path} {path}", *(["new file mode 100644"] if new else []),
+          f"index {'0000000' if new else b.sha()}..{b.sha()}")
+    b.binary_patch()
+
+
+def git_mode_change(b: DiffBuilder):
+    path = b.path("sh")
+    b.add(f"diff --git {path} {path}", "old mode 100644", "new mode 100755")
+    if b.random.random() < 0.5:
+        b.add(f"index {b.sha()}..{b.sha()}", f"--- {path}", f"+++ {path}")
+        b.hunks(1)
+
+
+def git_rename(b: DiffBuilder):
+    old, new = b.path(), b.path()
+    if b.random.random() < 0.5:
+        b.add(f"diff --git {old} {new}", "similarity index 100%", f"rename from {old}", f"rename to {new}")
+        return
+
+    b.add(f"diff --git {old} {new}", f"similarity index {b.random.randint(50, 99)}%", f"rename from {old}",
+          f"rename to {new}", f"index {b.sha()}..{b.sha()} 100644", f"--- {old}", f"+++ {new}")
+    b.hunks()
+
+
+GIT_SECTIONS = ((git_modified, 50), (git_new, 10), (git_deleted, 5), (git_binary, 5), (git_mode_change, 5),
+                (git_rename, 10))
+
+
+def svn_header(b: DiffBuilder, path, *git_lines):
+    b.add(f"Index: {path}", "=" * 67, f"diff --git a/{path} b/{path}", *git_lines)
+
+
+def svn_modified(b: DiffBuilder):
+    path = b.path()
+    revision = b.random.randint(1, 99999)
+    svn_header(b, path, f"--- a/{path}\t(revision {revision})", f"+++ b/{path}\t(working copy)")
+    b.hunks()
+
+
+def svn_new(b: DiffBuilder):
+    path = b.path()
+    svn_header(b, path, "new file mode 100644", f"--- a/{path}\t(nonexistent)", f"+++ b/{path}\t(working copy)")
+    b.hunks(new=True)
+
+
+def svn_deleted(b: DiffBuilder):
+    path = b.path()
+    revision = b.random.randint(1, 99999)
+    svn_header(b, path, "deleted file mode 100644", f"--- a/{path}\t(revision {revision})",
+               f"+++ b/{path}\t(nonexistent)")
+    b.hunks(deleted=True)
+
+
+def svn_binary(b: DiffBuilder):
+    path = b.path("png")
+    b.add(f"Index: {path}", "=" * 67, "Cannot display: file marked as a binary type.",
+          "svn:mime-type = application/octet-stream")
+    if b.random.random() < 0.5:
+        b.add("")
+        svn_properties(b, path, "Added", "svn:mime-type", "application/octet-stream")
+
+
+def svn_property_change(b: DiffBuilder):
+    path = b.path("sh")
+    revision = b.random.randint(1, 99999)
+    svn_header(b, path, f"--- a/{path}\t(revision {revision})", f"+++ b/{path}\t(working copy)")
+    b.add("")
+    svn_properties(b, path, b.random.choice(("Added", "Modified", "Deleted")),
+                   b.random.choice(("svn:executable", "svn:eol-style", "svn:keywords")), "*")
+
+
+def svn_ignore_deleted(b: DiffBuilder):
+    path = b.path("d")
+    revision = b.random.randint(1, 99999)
+    svn_header(b, path, f"--- a/{path}\t(revision {revision})", f"+++ b/{path}\t(working copy)")
+    b.add("")
+    svn_properties(b, path, "Deleted", "svn:ignore", "*.log")
+
+
+def svn_properties(b: DiffBuilder, path, action, name, value):
+    sign, header = ("-", "## -1 +0,0 ##") if action == "Deleted" else ("+", "## -0,0 +1 ##")
+    b.add(f"Property changes on: {path}", "_" * 67, f"{action}: {name}", header, f"{sign}{value}",
+          "\\ No newline at end of property")
+
+
+SVN_SECTIONS = ((svn_modified, 50), (svn_new, 10), (svn_deleted, 5), (svn_binary, 5), (svn_property_change, 5),
+                (svn_ignore_deleted, 2))
+
+
+def generate(kind, size, seed=0):
+    return DiffBuilder(seed).build(size, GIT_SECTIONS if kind == "git" else SVN_SECTIONS)
+
+
+def load(directory, kind, size_name, seed=0):
+    """A corpus diff, generated and written to 'directory' the first time it is asked for"""
+    path = os.path.join(directory, f"{kind}_{size_name}_{seed}.diff")
+    if not os.path.exists(path):
+        os.makedirs(directory, exist_ok=True)
+        with open(f"{path}.tmp", "w", encoding="utf-8", newline="") as corpus_file:
+            corpus_file.write(generate(kind, SIZES[size_name], seed))
+        os.replace(f"{path}.tmp", path)
+
+    with open(path, encoding="utf-8", newline="") as corpus_file:
+        return corpus_file.read()
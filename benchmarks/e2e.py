@@ -0,0 +1,385 @@
+"""
+End-to-end sync throughput benchmark on local synthetic repositories
+
+    python -m benchmarks.e2e --shapes small,binaries --directions "svn=>git,git=>svn" --set PREFETCH_DEPTH=0
+
+Every run builds a fresh svn repository (svnadmin create) and git repository (git init --bare), writes a history of
+the requested shape on the source side and runs start_revision_tracker in its own process until every revision has
+been synced. Revisions/s, p50/p99 revision latency and peak RSS are appended to the output file as JSON lines, one
+line per run, so runs can be compared over time.
+"""
+import argparse
+import ast
+import json
+import multiprocessing
+import os
+import platform
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from pathlib import Path
+from typing import NamedTuple
+
+try:
+    import resource
+except ImportError:  # not available on Windows, peak RSS is left out of the results there
+    resource = None
+
+from utils.logger import get_logger
+
+logger = get_logger(__name__)
+
+BRANCH = "master"
+SVN_BRANCH = "trunk"
+AUTHOR = "bench"
+AUTHOR_EMAIL = "bench@example.com"
+BASE_FILE = "README.md"
+BASE_CONTENT = b"Benchmark repository\n"
+
+
+class HistoryShape(NamedTuple):
+    """The history written to the source repository: 'commits' commits touching 'files_per_commit' files each"""
+    commits: int
+    files_per_commit: int
+    file_size: int
+    binary: bool = False
+    renames: bool = False
+    depth: int = 1
+
+
+SHAPES = {
+    # many small commits
+    'small': HistoryShape(commits=200, files_per_commit=1, file_size=512),
+    # a few commits touching thousands of files
+    'huge': HistoryShape(commits=5, files_per_commit=2000, file_size=4 * 1024),
+    'binaries': HistoryShape(commits=50, files_per_commit=5, file_size=256 * 1024, binary=True),
+    # every file is renamed (and edited) in every commit
+    'renames': HistoryShape(commits=100, files_per_commit=5, file_size=2 * 1024, renames=True),
+    'deep': HistoryShape(commits=100, files_per_commit=5, file_size=1024, depth=20),
+}
+
+DIRECTIONS = ("svn=>git", "git=>svn")
+
+
+def run(args, cwd=None, check=True):
+    result = subprocess.run(args, cwd=cwd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+    if check and result.returncode != 0:
+        raise RuntimeError(f"{' '.join(map(str, args))} failed ({result.returncode}): "
+                           f"{result.stdout.decode('utf-8', errors='replace')}")
+    return result.stdout.decode("utf-8", errors="replace")
+
+
+class GitWorkspace:
+    """A bare git repository and a clone to write history into"""
+
+    def __init__(self, root: Path):
+        self.bare = root / "git.bare"
+        self.path = root / "git-author"
+        run(["git", "init", "-q", "--bare", str(self.bare)])
+        run(["git", "symbolic-ref", "HEAD", f"refs/heads/{BRANCH}"], cwd=self.bare)
+        self.path = self.clone(self.path)
+
+    def clone(self, path: Path):
+        run(["git", "clone", "-q", str(self.bare), str(path)])
+        run(["git", "config", "user.name", AUTHOR], cwd=path)
+        run(["git", "config", "user.email", AUTHOR_EMAIL], cwd=path)
+        run(["git", "config", "core.autocrlf", "false"], cwd=path)
+        return path
+
+    def rename(self, old, new):
+        (self.path / new).parent.mkdir(parents=True, exist_ok=True)
+        run(["git", "mv", old, new], cwd=self.path)
+
+    def commit(self, message):
+        run(["git", "add", "-A"], cwd=self.path)
+        run(["git", "commit", "-q", "-m", message], cwd=self.path)
+        return run(["git", "rev-parse", "HEAD"], cwd=self.path).strip()
+
+    def publish(self):
+        run(["git", "push", "-q", "origin", f"HEAD:refs/heads/{BRANCH}"], cwd=self.path)
+
+
+class SvnWorkspace:
+    """A svn repository (accepting revprop changes) and a working copy of its trunk to write history into"""
+
+    def __init__(self, root: Path):
+        self.repo = root / "svn.repo"
+        self.path = root / "svn-author"
+        run(["svnadmin", "create", str(self.repo)])
+        self.allow_revprop_changes()
+        self.url = f"{self.repo.resolve().as_uri()}/{SVN_BRANCH}"
+        run(["svn", "mkdir", "-q", "--parents", "-m", "Create trunk", "--username", AUTHOR, self.url])
+        self.path = self.checkout(self.path)
+
+    def allow_revprop_changes(self):
+        # the svn target rewrites svn:author and svn:date of every revision it commits
+        if sys.platform == "win32":
+            (self.repo / "hooks" / "pre-revprop-change.bat").write_text("@exit 0\n")
+        else:
+            hook = self.repo / "hooks" / "pre-revprop-change"
+            hook.write_text("#!/bin/sh\nexit 0\n")
+            hook.chmod(0o755)
+
+    def checkout(self, path: Path):
+        run(["svn", "checkout", "-q", self.url, str(path)])
+        return path
+
+    def rename(self, old, new):
+        run(["svn", "mv", "-q", "--parents", old, new], cwd=self.path)
+
+    def commit(self, message):
+        run(["svn", "add", "-q", "--force", "."], cwd=self.path)
+        output = run(["svn", "commit", "-m", message, "--username", AUTHOR], cwd=self.path)
+        revision = output.strip().splitlines()[-1].strip(".").split()[-1]
+        run(["svn", "update", "-q"], cwd=self.path)
+        return revision
+
+    def publish(self):
+        pass
+
+
+class HistoryWriter:
+    """Writes a history of a given shape, deterministic for a given seed"""
+
+    def __init__(self, workspace, shape: HistoryShape, seed=0):
+        self.workspace = workspace
+        self.shape = shape
+        self.random = random.Random(seed)
+        self.paths = {}
+
+    def write_base(self):
+        (self.workspace.path / BASE_FILE).write_bytes(BASE_CONTENT)
+        return self.workspace.commit("Base revision")
+
+    def write_history(self):
+        for commit in range(self.shape.commits):
+            for index in range(self.shape.files_per_commit):
+                self.change_file(commit, index)
+            self.workspace.commit(f"Benchmark commit {commit + 1}\n\n{self.shape}")
+        self.workspace.publish()
+
+    def change_file(self, commit, index):
+        path = self.paths.get(index)
+        if path is not None and self.shape.renames:
+            new_path = self.file_path(index, commit)
+            self.workspace.rename(path, new_path)
+            path = self.paths[index] = new_path
+        elif path is None:
+            path = self.paths[index] = self.file_path(index, commit)
+
+        target = self.workspace.path / path
+        target.parent.mkdir(parents=True, exist_ok=True)
+        target.write_bytes(self.content(target.read_bytes() if target.exists() else None))
+
+    def file_path(self, index, commit):
+        directory = "/".join(f"d{index % 4}_{level}" for level in range(self.shape.depth))
+        name = f"file_{index}" + (f"_r{commit}" if self.shape.renames else "")
+        return f"{directory}/{name}.{'bin' if self.shape.binary else 'txt'}"
+
+    def content(self, previous):
+        if self.shape.binary:
+            # the NUL byte makes sure every tool sees the file as binary
+            return b"\0" + self.random.randbytes(self.shape.file_size - 1)
+
+        if previous is None:
+            lines, size = [], 0
+            while size < self.shape.file_size:
+                lines.append(self.line())
+                size += len(lines[-1])
+            return b"".join(lines)
+
+        # edit about one line in ten, so diffs have several hunks
+        lines = previous.splitlines(keepends=True)
+        for line in self.random.sample(range(len(lines)), max(len(lines) // 10, 1)):
+            lines[line] = self.line()
+        return b"".join(lines)
+
+    def line(self):
+        words = self.random.choices(("sync", "revision", "patch", "hunk", "file", "tree", "commit", "diff"), k=8)
+        return (" ".join(words) + f" {self.random.getrandbits(32):08x}\n").encode("ascii")
+
+
+def prepare_run(work_dir: Path, direction, shape: HistoryShape, seed):
+    """
+    Build the repositories for one run and write the history on the source side
+
+    :return: the sync config and the number of revisions to sync
+    """
+    git, svn = GitWorkspace(work_dir), SvnWorkspace(work_dir)
+    source, target = (svn, git) if direction == "svn=>git" else (git, svn)
+    writer = HistoryWriter(source, shape, seed)
+    source_base = writer.write_base()
+    target_base = HistoryWriter(target, shape, seed).write_base()
+    target.publish()
+    writer.write_history()
+
+    # the trackers work on their own clones, as they would in production
+    git_path = git.clone(work_dir / "git")
+    svn_path = svn.checkout(work_dir / "svn")
+
+    name = f"bench_{direction.replace('=>', '2')}"
+    history_dir = work_dir / "output" / "history"
+    history_dir.mkdir(parents=True, exist_ok=True)
+    (history_dir / f"sync_last_{name}").write_text(f"{source_base}=>{target_base}")
+
+    source_url, target_url = (svn_path, git_path) if direction == "svn=>git" else (git_path, svn_path)
+    sync = {'mode': direction, 'name': name,
+            'source_url': str(source_url), 'source_branch': SVN_BRANCH if source is svn else BRANCH,
+            'target_url': str(target_url), 'target_branch': SVN_BRANCH if target is svn else BRANCH}
+    return sync, shape.commits
+
+
+def run_tracker(sync, output_dir, overrides, expected, timeout, results):
+    """sync worker: point the config at the run's directories, then sync until 'expected' revisions are done"""
+    from server import config
+    config.patches_dir = f"{output_dir}/patches/"
+    config.patch_archive_dir = f"{output_dir}/patch_archive/"
+    config.tracker_dir = f"{output_dir}/history/"
+    config.metrics_dir = f"{output_dir}/metrics/"
+    config.traces_dir = f"{output_dir}/traces/"
+    config.profiles_dir = f"{output_dir}/profiles/"
+    config.STATE_DB = f"{config.tracker_dir}sync_state.db"
+    config.sync_configs = [sync]
+    for key, value in overrides.items():
+        setattr(config, key, value)
+
+    # imported only now, they read the config when they are imported
+    from server import app, setup, web
+    from utils import tracker
+
+    setup.setup_folders()
+    trk = setup.create_tracker_setup(sync)
+    web.initialize(trk.name)
+
+    started = time.time()
+    thread = threading.Thread(target=app.start_revision_tracker, args=(trk.name, trk.src, trk.tgt), daemon=True)
+    thread.start()
+
+    statuses = []
+    while time.time() - started < timeout and thread.is_alive():
+        statuses = tracker.list_revision_status(trk.name)
+        if len(statuses) >= expected or any(status == "failed" for _, status, __, ___ in statuses):
+            break
+        time.sleep(0.1)
+
+    results.put({'started': started, 'statuses': statuses,
+                 'peak_rss': peak_rss("RUSAGE_SELF"), 'peak_child_rss': peak_rss("RUSAGE_CHILDREN")})
+
+
+def peak_rss(who):
+    """peak resident set size in bytes (ru_maxrss is in kilobytes, bytes on macOS), None where it is unknown"""
+    if resource is None:
+        return None
+    maxrss = resource.getrusage(getattr(resource, who)).ru_maxrss
+    return maxrss if sys.platform == "darwin" else maxrss * 1024
+
+
+def summarize(run_result, expected):
+    statuses = run_result['statuses']
+    counts = {}
+    for _, status, __, ___ in statuses:
+        counts[status] = counts.get(status, 0) + 1
+
+    # revisions are synced one after the other, so each one took the time since the previous one finished
+    times = [updated for _, __, ___, updated in statuses]
+    latencies = sorted(b - a for a, b in zip(times, times[1:]))
+    elapsed = times[-1] - times[0] if len(times) > 1 else 0
+    return {'result': "ok" if counts.get("failed", 0) == 0 and len(statuses) >= expected else "failed",
+            'revisions': len(statuses), 'expected': expected, 'statuses': counts,
+            'startup_seconds': times[0] - run_result['started'] if times else None,
+            'sync_seconds': elapsed,
+            'revisions_per_second': (len(times) - 1) / elapsed if elapsed > 0 else None,
+            'latency_p50': percentile(latencies, 50), 'latency_p99': percentile(latencies, 99),
+            'peak_rss_bytes': run_result['peak_rss'], 'peak_child_rss_bytes': run_result['peak_child_rss']}
+
+
+def percentile(values, percent):
+    """nearest-rank percentile of sorted values"""
+    if not values:
+        return None
+    return values[min(len(values) - 1, max(0, -(-len(values) * percent // 100) - 1))]
+
+
+def benchmark(direction, shape_name, shape, overrides, timeout, seed, keep):
+    work_dir = Path(tempfile.mkdtemp(prefix=f"bench_{shape_name}_"))
+    try:
+        logger.info(f"Preparing {direction} '{shape_name}' run in {work_dir}")
+        sync, expected = prepare_run(work_dir, direction, shape, seed)
+
+        context = multiprocessing.get_context("spawn")
+        results = context.Queue()
+        worker = context.Process(target=run_tracker, args=(sync, str(work_dir / "output"), overrides, expected,
+                                                           timeout, results), name=f"bench-{sync['name']}")
+        worker.start()
+        run_result = results.get(timeout=timeout + 120)
+        worker.join(timeout=30)
+        if worker.is_alive():
+            worker.kill()
+
+        summary = summarize(run_result, expected)
+    finally:
+        if keep:
+            logger.info(f"Keeping {work_dir}")
+        else:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    return {'timestamp': time.time(), 'tree': tree_revision(), 'platform': platform.platform(),
+            'python': platform.python_version(), 'direction': direction, 'shape': shape_name,
+            'history': shape._asdict(), 'config': overrides, **summary}
+
+
+def tree_revision():
+    try:
+        return run(["git", "rev-parse", "HEAD"], cwd=os.path.dirname(os.path.abspath(__file__))).strip()
+    except (OSError, RuntimeError):
+        return None
+
+
+def parse_overrides(assignments):
+    """NAME=VALUE config overrides, values are Python literals (or plain strings)"""
+    overrides = {}
+    for assignment in assignments:
+        key, _, value = assignment.partition("=")
+        try:
+            overrides[key] = ast.literal_eval(value)
+        except (ValueError, SyntaxError):
+            overrides[key] = value
+    return overrides
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--shapes", default=",".join(SHAPES), help=f"comma separated, from: {', '.join(SHAPES)}")
+    parser.add_argument("--directions", default=",".join(DIRECTIONS))
+    parser.add_argument("--commits", type=int, help="override the number of commits of every shape")
+    parser.add_argument("--set", action="append", default=[], metavar="NAME=VALUE",
+                        help="override a server.config setting for the sync, e.g. PREFETCH_DEPTH=0")
+    parser.add_argument("--timeout", type=float, default=1800, help="seconds allowed for one run")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", default="output/benchmarks/e2e.jsonl")
+    parser.add_argument("--keep", action="store_true", help="keep the repositories of every run")
+    args = parser.parse_args(argv)
+
+    overrides = parse_overrides(args.set)
+    os.makedirs(os.path.dirname(os.path.abspath(args.output)), exist_ok=True)
+    for direction in args.directions.split(","):
+        for shape_name in args.shapes.split(","):
+            shape = SHAPES[shape_name]
+            if args.commits:
+                shape = shape._replace(commits=args.commits)
+
+            result = benchmark(direction, shape_name, shape, overrides, args.timeout, args.seed, args.keep)
+            with open(args.output, "a", encoding="utf-8") as output:
+                output.write(json.dumps(result) + "\n")
+            print(f"{direction} {shape_name}: {result['result']}, {result['revisions']}/{result['expected']} "
+                  f"revisions, {result['revisions_per_second'] or 0:.2f} rev/s, "
+                  f"p50 {result['latency_p50'] or 0:.3f}s, p99 {result['latency_p99'] or 0:.3f}s, "
+                  f"peak RSS {(result['peak_rss_bytes'] or 0) / 2 ** 20:.0f} MiB")
+
+
+if __name__ == '__main__':
+    main()
@@ -1,10 +1,12 @@
 import sys
 import traceback
 
-from server import app
+from server import app, config
 from utils.logger import setup_logger, get_logger
 
-setup_logger('git2svn-sync')
+setup_logger('git2svn-sync', asynchronous=config.ASYNC_LOGGING, queue_size=config.LOG_QUEUE_SIZE,
+             max_message_length=config.LOG_MAX_MESSAGE_LENGTH, rate_limits=config.LOG_RATE_LIMITS,
+             compress_mode=config.LOG_COMPRESSION)
 
 logger = get_logger(__name__)
 
@@ -0,0 +1,111 @@
+import itertools
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+import dateutil.parser as dateparser
+
+from repo.git_tracker import GitTracker
+from repo.tracker_base import TrackerBase, in_caller_context
+from utils.git_fast_import import FastImportStream, FileChange, FILE_MODE, EXECUTABLE_MODE, SYMLINK_MODE
+
+from server.config import COMPANY_DOMAIN, DUMMY_GIT
+from server.config import FAST_IMPORT_CHECKPOINT_INTERVAL, FAST_IMPORT_READ_WORKERS
+from utils.logger import get_logger
+
+logger = get_logger(__name__)
+
+
+class GitFastImportTracker(GitTracker):
+    """
+    A git target that writes every synced revision through 'git fast-import' instead of applying patches.
+    File contents are read from the svn source as they are at the revision, and author, date and message are set
+    on the commit directly, so the working tree and index are never touched (the target may be a bare repository).
+    """
+
+    def __init__(self, name, url, branch, is_test=False, **kwargs):
+        TrackerBase.__init__(self, name, "Git", url, **kwargs)
+        self._open_repository(url, branch, is_test)
+        self.ref = f"refs/heads/{branch}"
+        self.stream = FastImportStream(url, checkpoint_interval=FAST_IMPORT_CHECKPOINT_INTERVAL)
+        # tip of the branch as written to the stream, which may be ahead of the ref until the next checkpoint
+        self.head = None
+        self.committer = self.repo.git.var("GIT_COMMITTER_IDENT").rsplit(" ", 2)[0]
+
+        if not is_test and self.ref not in (ref.path for ref in self.repo.references):
+            logger.info(f"Creating branch: {branch} from origin/{branch}")
+            self.repo.git.branch("--track", branch, f"origin/{branch}")
+
+    def get_last_commit(self, with_pull=True):
+        # this tracker is the only writer of the branch, there is nothing to pull into a working tree
+        self.stream.flush()
+        return self.get_log_entry(self.repo.commit(self.ref))
+
+    def commit(self, date, msg, author, rev, diff, files=(), src: TrackerBase = None):
+        if DUMMY_GIT or self.is_test:
+            return "dummy_commit", -1
+
+        username = author if "@" in author else f"{author}@{COMPANY_DOMAIN}"
+        commit_msg = f"{msg}\n\n#author:{username}\n\n#Synced from: {rev}"
+        when = self.to_raw_date(date)
+
+        deleted, changed = src.get_changed_files(rev)
+        properties = src.get_file_properties(rev, changed) if changed else {}
+        logger.info(f"{self.name}: fast-import of rev: {rev}, {len(changed)} files changed, {len(deleted)} deleted")
+
+        with ThreadPoolExecutor(max_workers=FAST_IMPORT_READ_WORKERS) as pool:
+            contents = pool.map(in_caller_context(lambda f: self.read_source_file(src, rev, f)), changed)
+            # a generator, so each file goes into the stream as soon as it has been read
+            changes = itertools.chain((FileChange(path, None) for path in deleted),
+                                      (self.to_file_change(file, data, properties.get(file, {}))
+                                       for file, data in zip(changed, contents)))
+            if self.head is None:
+                self.head = self.repo.git.rev_parse("--verify", "--quiet", self.ref, with_exceptions=False) or None
+            self.head = self.stream.commit(self.ref, self.head, f"{username.split('@')[0]} <{username}> {when}",
+                                           f"{self.committer} {when}", commit_msg, changes)
+
+        logger.info(f"{self.name}: changes committed for rev: {rev} as {self.head}")
+        return commit_msg, self.head
+
+    def has_unflushed_commits(self):
+        return self.stream.pending > 0
+
+    def flush_commits(self):
+        self.stream.flush()
+
+    @staticmethod
+    def read_source_file(src: TrackerBase, rev, file):
+        """contents of a file at rev, handed over by the prefetcher when it read the file ahead"""
+        prefetched = src.take_prefetched(rev, file)
+        return bytes(prefetched) if prefetched is not None else src.cat_file(rev, file)
+
+    @staticmethod
+    def to_file_change(file, data, properties):
+        if "svn:special" in properties and data.startswith(b"link "):
+            return FileChange(file, data[len(b"link "):], SYMLINK_MODE)
+
+        return FileChange(file, data, EXECUTABLE_MODE if "svn:executable" in properties else FILE_MODE)
+
+    @staticmethod
+    def to_raw_date(date):
+        """'<epoch> <tz>' as fast-import reads it with --date-format=raw"""
+        if isinstance(date, (int, float)):
+            return f"{int(date)} +0000"
+
+        date_obj = date if isinstance(date, datetime) else dateparser.parse(date)
+        offset = date_obj.utcoffset()
+        minutes = int(offset.total_seconds() // 60) if offset else 0
+        sign = '-' if minutes < 0 else '+'
+        return f"{int(date_obj.timestamp())} {sign}{abs(minutes) // 60:02d}{abs(minutes) % 60:02d}"
+
+    def restore(self):
+        # nothing is written to the working tree, restarting the stream is all there is to restore
+        self.cleanup()
+
+    def cleanup(self):
+        logger.info("Restarting 'git fast-import'")
+        if DUMMY_GIT or self.is_test:
+            return
+
+        # anything written but not checkpointed is dropped, the next commit starts again from the branch
+        self.stream.close(kill=True)
+        self.head = None
@@ -5,28 +5,49 @@ import subprocess
 import threading
 
 from utils import file_utils
+from utils.git_cat_file import CatFileBatch, CatFileBatchPool
 from git import Repo
+from git.cmd import Git
 
 from repo.tracker_base import TrackerBase
 
-from utils.diff_tools import git_format_diff, git_get_binary_files
+from utils.diff_tools import git_format_diff, parse_diff, spool_diff, DiffStream
 from server.config import COMPANY_DOMAIN
 from server.config import git_pull_timeout
-from server.config import patches_dir, DUMMY_GIT, USE_PATCH_TOOL_FOR_GIT
+from server.config import DUMMY_GIT, USE_PATCH_TOOL_FOR_GIT, USE_APPLY_ENGINE
+from server.config import STREAM_DIFFS, DIFF_STREAM_BUFFER_SIZE
+from server.config import SCOPED_STATUS, SCOPED_STATUS_BATCH_SIZE
+from utils import metrics, tracing
 from utils.logger import get_logger
 
 logger = get_logger(__name__)
 
+# paths handed to status/add are file names, never globs
+LITERAL_PATHSPECS = {'GIT_LITERAL_PATHSPECS': "1"}
+
+TreeChange = collections.namedtuple('TreeChange', ['status', 'old_mode', 'new_mode', 'old_sha', 'new_sha', 'path',
+                                                   'new_path'])
+
+
+class MeteredGit(Git):
+    """GitPython's command wrapper, counting the git processes it runs and the output they return"""
+
+    def execute(self, command, *args, **kwargs):
+        with tracing.subprocess_span(command if isinstance(command, (list, tuple)) else [command]):
+            result = super().execute(command, *args, **kwargs)
+        output = result[1] if isinstance(result, tuple) else result
+        metrics.record_subprocess("git", len(output) if isinstance(output, (str, bytes)) else 0)
+        return result
+
+
+class MeteredRepo(Repo):
+    GitCommandWrapperType = MeteredGit
+
 
 class GitTracker(TrackerBase):
     def __init__(self, name, url, branch, is_test=False, **kwargs):
         TrackerBase.__init__(self, name, "Git", url, **kwargs)
-        self.branch = branch
-        self.is_test = is_test
-        self.repo = Repo(url)
-        self._lock = threading.Lock()
-
-        logger.info("GIT version" + str(self.repo.git.version_info))
+        self._open_repository(url, branch, is_test)
 
         if not is_test:
             branch_exists = False
@@ -42,15 +63,30 @@ class GitTracker(TrackerBase):
                 logger.info(f"Checking out NEW branch: {branch}")
                 self.repo.git.checkout('-t', f"origin/{branch}")
 
+    def _open_repository(self, url, branch, is_test):
+        """The repository and object readers, shared with the git trackers that do not check out the branch"""
+        self.branch = branch
+        self.is_test = is_test
+        self.repo = MeteredRepo(url)
+        self.objects = CatFileBatch(url)
+        # blob reads of files copied into another tracker, transfer_workers at once
+        self.blob_readers = CatFileBatchPool(url, self.transfer_workers)
+        self._lock = threading.Lock()
+
+        logger.info("GIT version" + str(self.repo.git.version_info))
+
     def run_command(self, subcommand, args=(), encoding="utf-8-sig", return_binary=False):
         try:
             args = [] if len(args) == 0 else args
             cmd = [subcommand] + args
-            git_cmd = subprocess.Popen(cmd, stdout=subprocess.PIPE, cwd=f"{self.repo_path}")
+            with tracing.subprocess_span(cmd):
+                git_cmd = subprocess.Popen(cmd, stdout=subprocess.PIPE, cwd=f"{self.repo_path}")
+                output = git_cmd.communicate()[0]
+            metrics.record_subprocess(subcommand, len(output))
             if return_binary:
-                return git_cmd.communicate()[0]
+                return output
             else:
-                return git_cmd.communicate()[0].decode(encoding=encoding)
+                return output.decode(encoding=encoding)
         except Exception as e:
             logger.error(f"Failed while running command {subcommand}", exc_info=e)
             raise e
@@ -61,7 +97,9 @@ class GitTracker(TrackerBase):
         if with_pull:
             origin.pull(kill_after_timeout=git_pull_timeout)
 
-        last_commit = self.repo.head.commit
+        return self.get_log_entry(self.repo.head.commit)
+
+    def get_log_entry(self, last_commit):
         files = self.repo.git.diff("--name-only", f"{last_commit.hexsha}~1..{last_commit.hexsha}")
         c = collections.namedtuple('LogEntry', ['date', 'message', 'revision', 'author', 'changelist'])
 
@@ -77,17 +115,50 @@ class GitTracker(TrackerBase):
 
     def get_diff(self, rev):
         cmd = self.repo.git
-        diff = cmd.diff("--no-prefix", "--binary", f"{rev}~1..{rev}")
+        if STREAM_DIFFS:
+            diff = DiffStream(["git", "diff", "--no-prefix", "--binary", f"{rev}~1..{rev}"], self.repo_path,
+                              DIFF_STREAM_BUFFER_SIZE, strip_final_newline=True, check=True)
+        else:
+            diff = cmd.diff("--no-prefix", "--binary", f"{rev}~1..{rev}")
         files = cmd.diff("--name-only", f"{rev}~1..{rev}")
         msg = cmd.log("--pretty=format:%B", f"{rev}~1..{rev}")
         date = cmd.log("--pretty=format:%ci", f"{rev}~1..{rev}")
         author = cmd.log("--pretty=format:%ae", f"{rev}~1..{rev}")
 
-        logger.debug(f"Diff (revision = {rev})\n\n{diff}")
-        logger.debug(f"Files (revision = {rev}, count = {len(files)})\n\n{files}")
+        # formatted only when debug logging is on, diffs can be huge
+        logger.debug("Diff (revision = %s)\n\n%s", rev, diff)
+        logger.debug("Files (revision = %s, count = %d)\n\n%s", rev, len(files), files)
 
         return date, msg, author, diff, files.splitlines(keepends=False) if files else []
 
+    def get_synced_revisions(self):
+        log = self.repo.git.log("--format=%H%x00%B%x00", self.branch)
+        fields = log.split("\0")
+        for sha, message in zip(fields[0::2], fields[1::2]):
+            source_rev = self.parse_synced_from(message)
+            if source_rev:
+                yield source_rev, sha.strip()
+
+    def get_changes(self, rev):
+        """
+        The change manifest of a revision from 'git diff-tree' (renames detected), one TreeChange per path.
+        'status' is the one letter status (A, M, D, R, T), 'new_path' is only set for renames.
+        """
+        output = self.repo.git.diff_tree("--no-commit-id", "-r", "-z", "-M", "--root", rev)
+        fields = output.split("\0")
+        changes = []
+        i = 0
+        while i < len(fields) - 1:
+            old_mode, new_mode, old_sha, new_sha, status = fields[i].lstrip(":").split(" ")
+            if status[0] in "RC":
+                changes.append(TreeChange(status[0], old_mode, new_mode, old_sha, new_sha, fields[i + 1], fields[i + 2]))
+                i += 3
+            else:
+                changes.append(TreeChange(status[0], old_mode, new_mode, old_sha, new_sha, fields[i + 1], None))
+                i += 2
+
+        return changes
+
     def commit(self, date, msg, author, rev, diff, files=(), src: TrackerBase = None):
         with self._lock:
             if DUMMY_GIT or self.is_test:
@@ -97,8 +168,13 @@ class GitTracker(TrackerBase):
                 logger.info(f"{self.name}: patch successful, committing changes for rev: {rev}...")
                 username = author if "@" in author else f"{author}@{COMPANY_DOMAIN}"
                 commit_msg = f"{msg}\n\n#author:{username}\n\n#Synced from: {rev}"
-                self.repo.git.add("-A")
-                self.repo.git.commit(f"--author={author}", "-am", commit_msg)
+                changed = self.get_changed_paths(self.touched_paths) if SCOPED_STATUS and self.touched_paths else None
+                if changed:
+                    self.stage(changed)
+                    self.repo.git.commit(f"--author={author}", "-m", commit_msg)
+                else:
+                    self.repo.git.add("-A")
+                    self.repo.git.commit(f"--author={author}", "-am", commit_msg)
                 # self.repo.git.push()
                 # self.repo.git.push("--tags")
                 commit_info = self.get_last_commit(True)
@@ -112,65 +188,172 @@ class GitTracker(TrackerBase):
         if DUMMY_GIT:
             return
 
-        patch_path, formatted_diff = self.format_and_save(rev, diff)
-        binary_files = git_get_binary_files(formatted_diff)
-
-        if USE_PATCH_TOOL_FOR_GIT:
-            orig_dir = os.getcwd()
-            try:
-                os.chdir(self.repo.git_dir)
-                pto = patch.fromfile(patch_path)
-                if pto and pto.apply(strip=0):
-                    logger.info(f'Finished patching rev: {rev}')
-                    return True
-            finally:
-                os.chdir(orig_dir)
+        self.touched_paths = list(files)
+        if USE_APPLY_ENGINE and not isinstance(diff, DiffStream):
+            model = self.parse_diff(diff)
+            self.touched_paths = self.changed_paths(model, files)
+            self.archive_patch(rev, contents="\n".join(model.lines))
+            # 'git apply' used to run with --ignore-whitespace
+            digests = self.apply_in_process(rev, model, ignore_whitespace=True).digests
         else:
+            patch_path, model = self.format_and_save(rev, diff)
+            self.touched_paths = self.changed_paths(model, files)
+            digests = None
+
+            if USE_PATCH_TOOL_FOR_GIT:
+                orig_dir = os.getcwd()
+                try:
+                    os.chdir(self.repo.git_dir)
+                    pto = patch.fromfile(patch_path)
+                    if pto and pto.apply(strip=0):
+                        logger.info(f'Finished patching rev: {rev}')
+                        return True
+                finally:
+                    os.chdir(orig_dir)
+
+                logger.info(f"Could not apply patch for rev: {rev}")
+                return None
+
             patch_result = self.repo.git.apply(patch_path, "-p1", "--ignore-whitespace", "-v")
             logger.info(f'Finished patching rev: {rev}, result = {patch_result}')
 
-            if src and src.type == "Svn":
-                self.retrieve_binaries(binary_files, rev, src)
+        if src and src.type == "Svn":
+            self.retrieve_binaries(model.binary_files(), rev, src)
 
-            if not self.verify_apply(rev, src, diff, files):
-                return False
+        if not self.verify_apply(rev, src, model, files, digests):
+            return False
 
-            if self.has_changes(rev, files):
-                return True
+        if self.has_changes(rev, self.touched_paths):
+            return True
 
         logger.info(f"Could not apply patch for rev: {rev}")
 
     def retrieve_binaries(self, binary_files, rev: str, src: TrackerBase):
-        for file in binary_files:
-            file_byte_array = src.get_file(rev, file, is_binary=True)
-            file_utils.overwrite_file(f"{self.repo_path}/{file}", file_byte_array)
+        self.transfer_files(rev, src, binary_files)
 
     def format_and_save(self, rev, diff):
-        diff_lines = git_format_diff(diff, revision="HEAD")
-        patch_path = f"{patches_dir}{self.name}/{rev}.txt"
+        patch_path = self.patch_path(rev)
+        if isinstance(diff, DiffStream):
+            with open(patch_path, "w", encoding="utf-8-sig", errors="surrogateescape",
+                      buffering=DIFF_STREAM_BUFFER_SIZE) as patch_file:
+                model = spool_diff(diff.lines(strip_cr=True), patch_file, "git", revision="HEAD")
+            self.archive_patch(rev, patch_path)
+            return patch_path, model
+
+        model = parse_diff(diff, strip_cr=True)
+        diff_lines = git_format_diff(model, revision="HEAD")
         with open(patch_path, "w", encoding="utf-8-sig") as patch_file:
             patch_file.write(u"\n".join(diff_lines))
             patch_file.flush()
             patch_file.close()
 
-        return patch_path, u"\n".join(diff_lines)
+        self.archive_patch(rev, patch_path)
+        return patch_path, model
+
+    def parse_diff(self, diff):
+        # the apply engine writes the line endings of the diff, 'git apply' gets a patch without carriage returns
+        return parse_diff(diff, strip_cr=not USE_APPLY_ENGINE)
 
     def get_file(self, rev, file, is_binary=False, encoding="utf-8-sig"):
         logger.info(f"Pulling contents of file (rev={rev}) = {file} and is_binary={is_binary}")
         if is_binary:
-            file_contents = self.run_command("git", ["show", "--binary", f"{rev}:{file}"], return_binary=True)
-            return bytearray(file_contents, encoding=encoding)
-        else:
-            file_contents = self.run_command("git", ["show", f"{rev}:{file}"])
-            return "\n".join(file_contents.splitlines(keepends=False))
+            prefetched = self.take_prefetched(rev, file)
+            return prefetched if prefetched is not None else self.blob_readers.read(rev, file) or b""
+
+        file_contents = self.blob_readers.read(rev, file) or b""
+
+        return "\n".join(file_contents.decode(encoding=encoding).splitlines(keepends=False))
+
+    def open_file(self, rev, file):
+        """the blob streamed out of the 'git cat-file --batch' pipe"""
+        return self.blob_readers.open(rev, file)
+
+    def get_file_sizes(self, rev, files):
+        readable = [file for file in files if "\n" not in file]
+        if not readable:
+            return {}
+
+        cmd = ["git", "cat-file", "--batch-check=%(objectsize)"]
+        with tracing.subprocess_span(cmd):
+            output = subprocess.run(cmd, input="".join(f"{rev}:{file}\n" for file in readable).encode("utf-8"),
+                                    stdout=subprocess.PIPE, cwd=f"{self.repo_path}").stdout
+        metrics.record_subprocess("git", len(output))
+
+        # one line per file, '<rev>:<path> missing' for files that are not there
+        return {file: int(line) for file, line in zip(readable, output.decode("utf-8").splitlines()) if line.isdigit()}
+
+    def get_file_digest(self, rev, file):
+        return file_utils.content_digest(self.objects.read(rev, file) or b"")
 
     def has_changes(self, rev: str, files: list = ()):
+        """Whether the working tree has changes, in 'files' (and below them) only when they are given"""
         if DUMMY_GIT:
             return True
+
+        if SCOPED_STATUS and files:
+            if self.get_changed_paths(files):
+                return True
+            logger.info(f"No changes found in the {len(files)} paths of rev: {rev}, checking the whole tree")
+
         response = self.run_command("git", ["ls-files", "-o", "--directory", "--exclude-standard"])
         untracked_files = response.strip().splitlines(keepends=False) if response else []
         return self.repo.is_dirty() or (untracked_files and len(untracked_files) > 0)
 
+    def get_status(self, paths):
+        """
+        'git status' of just 'paths' (and what is below them)
+
+        :return: (status, path, source path of a staged rename or copy, else None) of every changed or untracked file
+        """
+        entries = []
+        for i in range(0, len(paths), SCOPED_STATUS_BATCH_SIZE):
+            status = self.repo.git.status("--porcelain", "-z", "--untracked-files=all", "--",
+                                          *paths[i:i + SCOPED_STATUS_BATCH_SIZE], env=LITERAL_PATHSPECS)
+            fields = iter(status.split("\0"))
+            for field in fields:
+                if field:
+                    # staged renames and copies are followed by their source path
+                    entries.append((field[:2], field[3:], next(fields, None) if field[0] in "RC" else None))
+
+        return entries
+
+    def get_changed_paths(self, paths):
+        """Modified, deleted and untracked files among 'paths' (or below them)"""
+        return [path for _, path, __ in self.get_status(paths)]
+
+    def stage(self, paths):
+        """'git add -A' limited to 'paths'"""
+        logger.info(f"Staging {len(paths)} changed paths")
+        for i in range(0, len(paths), SCOPED_STATUS_BATCH_SIZE):
+            self.repo.git.add("-A", "--", *paths[i:i + SCOPED_STATUS_BATCH_SIZE], env=LITERAL_PATHSPECS)
+
+    def is_damaged(self):
+        """A lock or an unfinished merge, rebase or cherry-pick left in the repository"""
+        if DUMMY_GIT or self.is_test:
+            return False
+
+        return any(os.path.exists(os.path.join(self.repo.git_dir, name))
+                   for name in ("index.lock", "MERGE_HEAD", "CHERRY_PICK_HEAD", "rebase-apply", "rebase-merge"))
+
+    def restore_paths(self, paths):
+        """Put 'paths' back as they are in HEAD, index included, and delete untracked files among them"""
+        if DUMMY_GIT or self.is_test:
+            return
+
+        with self._lock:
+            tracked, untracked = [], []
+            for status, path, source in self.get_status(paths):
+                if status == "??":
+                    untracked.append(path)
+                else:
+                    tracked.extend([path, source] if source else [path])
+
+            for i in range(0, len(tracked), SCOPED_STATUS_BATCH_SIZE):
+                self.repo.git.restore("--source=HEAD", "--staged", "--worktree", "--",
+                                      *tracked[i:i + SCOPED_STATUS_BATCH_SIZE], env=LITERAL_PATHSPECS)
+            for path in untracked:
+                os.remove(os.path.join(self.repo_path, path))
+
     def revert_all(self):
         logger.info("Performing 'git reset --HARD'")
         if DUMMY_GIT or self.is_test:
@@ -188,7 +371,7 @@ class GitTracker(TrackerBase):
             if os.path.exists(lock_file_path):
                 os.remove(lock_file_path)
             else:
-                print("No lock file found")
+                logger.debug("No lock file found")
 
             self.revert_all()
             self.repo.git.clean("-f", "-d")
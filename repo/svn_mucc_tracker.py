@@ -0,0 +1,163 @@
+import os
+import re
+import subprocess
+import tempfile
+
+from repo.svn_tracker import SvnTracker
+from repo.tracker_base import TrackerBase
+
+from server.config import DUMMY_SVN, patches_dir
+from utils import metrics, tracing
+from utils.logger import get_logger
+
+logger = get_logger(__name__)
+
+EXECUTABLE_MODE = "100755"
+SYMLINK_MODE = "120000"
+GITLINK_MODE = "160000"
+
+
+class SvnMuccTracker(SvnTracker):
+    """
+    An svn target that commits every synced revision as a single 'svnmucc' transaction against the repository URL
+    of the configured checkout, built from the git change manifest (see GitTracker.get_changes) and the git blobs.
+    The working copy is only used to find the repository, it is never patched, updated or cleaned up.
+    """
+
+    def get_last_commit(self, with_pull=True):
+        logger.info("Getting last commit info from svn (svn info <url>)")
+        revision = self.run_svn_command("info", ["--show-item", "last-changed-revision", self.to_repo_url("")],
+                                        do_combine=True)
+        return self.get_log_entry(revision.strip())
+
+    def commit(self, date, msg, author, rev, diff, files=(), src: TrackerBase = None):
+        if DUMMY_SVN or self.is_test:
+            return "dummy_commit", -1
+
+        username = author.split('@')[0]
+        commit_msg = f"{msg}\n\n#author:{username}\n\n#Synced from: {rev}"
+
+        changes = [change for change in src.get_changes(rev) if GITLINK_MODE not in (change.old_mode, change.new_mode)]
+        if not changes:
+            return None, None
+
+        with tempfile.TemporaryDirectory(dir=f"{patches_dir}{self.name}") as staging_dir:
+            operations = self.build_operations(rev, changes, src, staging_dir)
+            arguments_path = os.path.join(staging_dir, "operations.txt")
+            with open(arguments_path, "w", encoding="utf-8", newline="\n") as arguments:
+                arguments.write("\n".join(operations) + "\n")
+
+            logger.info(f"Performing 'svnmucc' with {len(changes)} changes for rev: {rev}")
+            # on file:// (and wherever the server takes it) the username becomes svn:author right away
+            cmd = ["svnmucc", "--non-interactive", "--username", username, "-m", commit_msg, "-X", arguments_path]
+            with tracing.subprocess_span(cmd):
+                result = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, cwd=self.repo.path)
+            metrics.record_subprocess("svnmucc", len(result.stdout))
+            output = result.stdout.decode("utf-8", errors="replace")
+            if result.returncode != 0:
+                raise Exception(f"svnmucc failed with ({result.returncode}) for rev: {rev}\n{output}")
+
+        match = re.search(r"^r(\d+) committed", output, re.MULTILINE)
+        if not match:
+            raise Exception(f"Could not find the committed revision in svnmucc output: {output}")
+        revision = int(match.group(1))
+
+        try:
+            self.set_revision_properties(revision, username, date)
+        except Exception as exc:
+            # revision properties can only be changed when the pre-revprop-change hook allows it
+            logger.warning(f"Keeping author/date of r{revision} as committed: {exc}")
+
+        logger.info(f"{self.name}: changes committed for rev: {rev} as r{revision}")
+        return commit_msg, revision
+
+    def build_operations(self, rev, changes, src, staging_dir):
+        """
+        svnmucc operations for the changes of a git revision, one argument per entry. Files are staged in
+        staging_dir for 'put'. Deleted files are removed first so their paths can be reused, then directories are
+        created, files moved and written, and directories left without files in git are removed last.
+        """
+        removed, created, moved, written, properties = [], [], [], [], []
+
+        deleted_files = [change.path for change in changes if change.status == "D"]
+        added_files = [change.new_path or change.path for change in changes if change.status != "D"]
+
+        # directories emptied in git are removed as a whole, unless a new file takes their place
+        emptied = self.emptied_directories(rev, deleted_files + [c.path for c in changes if c.status == "R"], src)
+        replaced = [d for d in emptied if d in added_files]
+        removed_dirs = [d for d in emptied if d not in replaced]
+
+        removed.extend(["rm", self.to_repo_url(d)] for d in replaced)
+        for file in deleted_files:
+            if not any(file.startswith(f"{d}/") for d in emptied):
+                removed.append(["rm", self.to_repo_url(file)])
+
+        existing = set()
+        for file in added_files:
+            for directory in parent_directories(file):
+                if directory in existing or directory in created:
+                    continue
+                if directory in deleted_files:
+                    created.append(directory)
+                elif src.objects.read(f"{rev}~1", directory) is not None and directory not in emptied \
+                        or self.is_directory(directory):
+                    existing.add(directory)
+                else:
+                    created.append(directory)
+
+        for i, change in enumerate(changes):
+            if change.status == "D":
+                continue
+
+            path = change.new_path or change.path
+            if change.status == "R":
+                moved.append(["mv", self.to_repo_url(change.path), self.to_repo_url(path)])
+            if change.old_sha != change.new_sha or change.status == "T":
+                staged = os.path.join(staging_dir, str(i))
+                if change.new_mode == SYMLINK_MODE:
+                    with open(staged, "wb") as staged_file:
+                        staged_file.write(b"link " + (src.objects.read(rev, path) or b""))
+                else:
+                    src.transfer_file(rev, path, staged)
+                written.append(["put", staged, self.to_repo_url(path)])
+
+            properties.extend(property_operations(change, self.to_repo_url(path)))
+
+        operations = removed + [["mkdir", self.to_repo_url(d)] for d in created] + moved + written + properties
+        operations += [["rm", self.to_repo_url(d)] for d in removed_dirs if not any(
+            d.startswith(f"{other}/") for other in removed_dirs)]
+        return [argument for operation in operations for argument in operation]
+
+    @staticmethod
+    def emptied_directories(rev, removed_files, src):
+        """Directories of removed files that existed before the revision but have no files left after it"""
+        emptied = []
+        for file in removed_files:
+            for directory in parent_directories(file):
+                if directory not in emptied and src.objects.read(rev, directory) is None:
+                    emptied.append(directory)
+        return emptied
+
+    def is_directory(self, directory):
+        output = self.run_command("svn", ["info", "--show-item", "kind", self.to_repo_url(directory)])
+        return output.strip() == "dir"
+
+    def cleanup(self):
+        logger.info("Nothing to clean up, svnmucc commits do not use the working copy")
+
+
+def parent_directories(path):
+    """'a/b/c.txt' => ['a', 'a/b']"""
+    parts = path.split("/")[:-1]
+    return ["/".join(parts[:i + 1]) for i in range(len(parts))]
+
+
+def property_operations(change, url):
+    """svn:executable and svn:special updates for a change of git file mode"""
+    operations = []
+    for mode, name in ((EXECUTABLE_MODE, "svn:executable"), (SYMLINK_MODE, "svn:special")):
+        if change.new_mode == mode and change.old_mode != mode:
+            operations.append(["propset", name, "*", url])
+        elif change.old_mode == mode and change.new_mode != mode:
+            operations.append(["propdel", name, url])
+    return operations
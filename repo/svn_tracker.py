@@ -1,4 +1,10 @@
 import os
+import re
+import shutil
+import sqlite3
+import pathlib
+import itertools
+import contextlib
 import subprocess
 import logging
 
@@ -7,40 +13,66 @@ import patch
 import svn.local
 import pprint
 import time
+import xml.etree.ElementTree
 
-from datetime import timezone
+from datetime import datetime, timezone
+from urllib.parse import quote, unquote
 import dateutil.parser as dateparser
 
 from utils import file_utils
+from utils.patch_apply import ApplyResult, EXECUTABLE_MODE
+from utils.process_stream import ProcessStream
 from repo.tracker_base import TrackerBase
 
-from utils.diff_tools import svn_format_diff, git_get_binary_files, git_get_rename_files
+from utils.diff_tools import svn_format_diff, spool_diff, DiffStream
 from server.config import DUMMY_SVN
-from server.config import patches_dir, USE_SVN_PATCH_FORMAT, USE_PATCH_TOOL_FOR_SVN
+from server.config import USE_SVN_PATCH_FORMAT, USE_PATCH_TOOL_FOR_SVN, USE_APPLY_ENGINE
+from server.config import STREAM_DIFFS, DIFF_STREAM_BUFFER_SIZE
+from server.config import SCOPED_STATUS, SCOPED_STATUS_BATCH_SIZE, SVN_LOG_CACHE_SIZE
+from utils import metrics, tracing
 from utils.logger import get_logger
 
 logger = get_logger(__name__)
 
+LogEntry = collections.namedtuple('LogEntry', ['date', 'message', 'revision', 'author', 'changelist', 'paths'])
+ChangedPath = collections.namedtuple('ChangedPath', ['action', 'kind', 'path', 'copyfrom_path', 'copyfrom_rev'])
+
+re_committed_revision = re.compile(r'^Committed revision (\d+)\.', re.MULTILINE)
+# 'Sending        a/b.txt', 'Adding  (bin)  c.png', ... in the output of 'svn commit'
+re_committed_path = re.compile(r'^(?:Sending|Adding|Deleting|Replacing) +(?:\(bin\) +)?(.+?)\r?$', re.MULTILINE)
+
+
+class MeteredSvnClient(svn.local.LocalClient):
+    """svn.local.LocalClient, counting the svn processes it runs and the output they return"""
+
+    def external_command(self, cmd, *args, **kwargs):
+        with tracing.subprocess_span(cmd):
+            result = super().external_command(cmd, *args, **kwargs)
+        output_bytes = len(result) if isinstance(result, (str, bytes)) else sum(len(line) + 1 for line in result)
+        metrics.record_subprocess("svn", output_bytes)
+        return result
+
 
 class SvnTracker(TrackerBase):
     def __init__(self, name, url, branch, is_test=False, **kwargs):
         TrackerBase.__init__(self, name, "Svn", url, **kwargs)
         self.branch = branch
         self.is_test = is_test
-        self.repo = svn.local.LocalClient(url)
+        self.repo = MeteredSvnClient(url)
+        self._log_cache = {}
+        self._relative_url = None
+        self._url = None
 
         logger.info("SVN version:" + self.run_command("svn", ['--version', '--quiet']).strip())
 
     def run_command(self, subcommand, args=(), encoding="utf-8-sig", return_binary=False):
-        orig_dir = os.getcwd()
-        try:
-            args = [] if len(args) == 0 else args
-            os.chdir(self.repo.path)
-            cmd = [subcommand] + args
-            svn_cmd = subprocess.Popen(cmd, stdout=subprocess.PIPE)
-            return svn_cmd.communicate()[0].decode(encoding=encoding)
-        finally:
-            os.chdir(orig_dir)
+        args = [] if len(args) == 0 else args
+        cmd = [subcommand] + args
+        with tracing.subprocess_span(cmd):
+            svn_cmd = subprocess.Popen(cmd, stdout=subprocess.PIPE, cwd=self.repo.path)
+            output = svn_cmd.communicate()[0]
+        metrics.record_subprocess(subcommand, len(output))
+        return output if return_binary else output.decode(encoding=encoding)
 
     def run_svn_command(self, subcommand, args=(), **kwargs):
         args = [] if len(args) == 0 else args
@@ -48,17 +80,62 @@ class SvnTracker(TrackerBase):
 
     def get_last_commit(self, with_pull=True):
         logger.info("Getting last commit info from svn (svn info)")
-        c = collections.namedtuple('LogEntry', ['date', 'message', 'revision', 'author', 'changelist'])
         if DUMMY_SVN:
-            return c(**{'date': time.time(), 'revision': -1, 'msg': "Dummy message",
-                        'author': 'fake_author', 'changedlist': []})
+            return LogEntry(**{'date': time.time(), 'revision': -1, 'message': "Dummy message",
+                               'author': 'fake_author', 'changelist': [], 'paths': []})
 
         if with_pull:
             self.repo.update()
 
-        last_commit = list(self.repo.log_default(limit=1)).pop()
-        return c(**{'date': last_commit.date, 'revision': last_commit.revision, 'message': last_commit.msg,
-                    'author': last_commit.author, 'changelist': last_commit.changelist})
+        revision = self.run_svn_command("info", ["--show-item", "last-changed-revision"], do_combine=True)
+        return self.get_log_entry(revision.strip())
+
+    def get_log_entry(self, rev) -> LogEntry:
+        """Get the log entry for a revision, fetching the log from that revision to HEAD if it is not cached"""
+        entry = self._log_cache.get(int(rev))
+        if entry is None:
+            # only the source clears the cache for each batch, the target's misses would add to it forever
+            if len(self._log_cache) >= SVN_LOG_CACHE_SIZE:
+                self._log_cache.clear()
+            self.prefetch_log(rev)
+            entry = self._log_cache[int(rev)]
+
+        return entry
+
+    def prefetch_log(self, revision_from, revision_to="HEAD"):
+        """
+        Fetch the verbose log for a whole revision range with a single 'svn log' and cache every entry by revision
+
+        :return: the fetched log entries, oldest first
+        """
+        logger.info(f"Fetching svn log for r{revision_from}:{revision_to}")
+        result = self.run_svn_command("log", ["--xml", "--verbose", "-r", f"{revision_from}:{revision_to}",
+                                              self.repo.path], do_combine=True)
+
+        entries = []
+        for e in xml.etree.ElementTree.fromstring(result).iter('logentry'):
+            date = e.findtext('date')
+            paths = [ChangedPath(p.get('action'), p.get('kind'), p.text, p.get('copyfrom-path'),
+                                 p.get('copyfrom-rev')) for p in e.iter('path')]
+            entry = LogEntry(**{'date': dateparser.parse(date) if date else None,
+                                'revision': int(e.get('revision')),
+                                'message': e.findtext('msg') or "",
+                                'author': e.findtext('author'),
+                                'changelist': self.to_relative_paths(p.path for p in paths if p.kind != "dir"),
+                                'paths': paths})
+            self._log_cache[entry.revision] = entry
+            entries.append(entry)
+
+        return entries
+
+    def to_relative_paths(self, repo_paths):
+        """Map repository paths from 'svn log' (e.g. '/trunk/a.txt') to working copy paths, dropping the rest"""
+        if self._relative_url is None:
+            relative_url = self.run_svn_command("info", ["--show-item", "relative-url"], do_combine=True)
+            self._relative_url = unquote(relative_url.strip().lstrip("^")).rstrip("/")
+
+        prefix = f"{self._relative_url}/"
+        return [path[len(prefix):] for path in repo_paths if path.startswith(prefix)]
 
     def get_last_commit_info(self, with_pull=True):
         logger.info("Getting last commit info from svn (svn info)")
@@ -71,7 +148,7 @@ class SvnTracker(TrackerBase):
         info = self.repo.info()
 
         if logger.isEnabledFor(logging.DEBUG):
-            pprint.pprint(info)
+            logger.debug(f"SVN info:\n{pprint.pformat(info)}")
 
         return info
 
@@ -79,32 +156,36 @@ class SvnTracker(TrackerBase):
         if DUMMY_SVN:
             return []
 
-        revs = self.repo.log_default(revision_from=f"{rev}")
-        revs = list(map(lambda x: x.revision, revs))
-        revs.pop(0)
+        # a new batch starts here, so drop metadata from the previous one before refilling the cache
+        self._log_cache.clear()
+        entries = self.prefetch_log(rev)
 
-        return revs
+        return [entry.revision for entry in entries if entry.revision > int(rev)]
 
     def get_diff(self, rev, is_git_diff=True):
         if DUMMY_SVN:
             return ""
 
-        if not is_git_diff:
+        if STREAM_DIFFS and is_git_diff:
+            diff = DiffStream(["svn", "diff", "--git", "-r", f"{int(rev) - 1}:{rev}", "-x", "-U10"], self.repo.path,
+                              DIFF_STREAM_BUFFER_SIZE, encoding="utf-8-sig")
+        elif not is_git_diff:
             diff = self.run_svn_command("diff", ["-r", f"{int(rev) - 1}:{rev}", "-x", "-U10"])
         else:
             diff = self.run_command("svn", ["diff", "--git", "-r", f"{int(rev) - 1}:{rev}", "-x", "-U10"])
 
-        log = list(self.repo.log_default(revision_from=rev, revision_to=rev)).pop()
+        log = self.get_log_entry(rev)
         author = log.author
-        msg = log.msg
+        msg = log.message
         date = log.date
 
         if isinstance(diff, list):
             diff = "\n".join(diff)
 
-        files = map(lambda x: x[0], log.changelist) if log.changelist else []
-        logger.debug(f"Diff (revision = {rev})\n\n{diff}")
-        logger.debug(f"Files (revision = {rev}, count = {len(files)})\n\n{files}")
+        files = log.changelist
+        # formatted only when debug logging is on, diffs can be huge
+        logger.debug("Diff (revision = %s)\n\n%s", rev, diff)
+        logger.debug("Files (revision = %s, count = %d)\n\n%s", rev, len(files), files)
 
         return date, msg, author, diff, files
 
@@ -116,93 +197,150 @@ class SvnTracker(TrackerBase):
         commit_msg = f"{msg}\n\n#author:{username}\n\n#Synced from: {rev}"
         if self.apply(rev, diff, src, files):
             logger.info(f"Performing 'svn commit --username {username} -m {msg} <diff> {','.join(files)}'")
-            self.repo.commit(commit_msg)
-            logger.info(f"Commit successful, begin check for updating author to {username}")
-            commit_info = self.get_last_commit(with_pull=True)
-
-            # Update commit author
-            if username != commit_info.author:
-                logger.info(f"Author mismatch: updating author from '{commit_info.author}' to '{username}")
-                commit_info = self.update_author(commit_info.revision, username)
-            else:
-                logger.info(f"Author is already set to {username}")
-
-            # Update commit date: 2022-01-18 21:10:38 -0500
-            date_obj = date if type(date) is date else dateparser.parse(date)
-            if date_obj != commit_info.date:
-                logger.info(f"Commit date mismatch: updating date from '{commit_info.date}' to '{date_obj}")
-                commit_info = self.update_timestamp(commit_info.revision, date_obj)
-            else:
-                logger.info(f"Date is already set to {date}")
-
-            return commit_msg, commit_info.revision
+            output = self.run_svn_command("commit", ["-m", commit_msg], do_combine=True)
+            revision = self.get_committed_revision(output)
+
+            # the rest of the working copy is only updated by the next poll
+            self.update_parent_directories(revision, re_committed_path.findall(output))
+            self.set_revision_properties(revision, username, date)
+            logger.info(f"{self.name}: changes committed for rev: {rev} as r{revision}")
+            return commit_msg, revision
         else:
             return None, None
 
-    def update_author(self, revision, username):
-        logger.info(f"Updating author to '{username}' on r{revision}")
+    def update_parent_directories(self, revision, committed_paths):
+        """
+        Bring the directories above committed paths to the committed revision, without their contents. 'svn commit'
+        only moves the committed paths themselves, and a later revision of the same pass deleting one of those
+        directories or changing its properties would otherwise fail as out of date.
+        """
+        directories = {"."}
+        for path in committed_paths:
+            parent = os.path.dirname(path.replace("\\", "/"))
+            while parent and parent not in directories:
+                directories.add(parent)
+                parent = os.path.dirname(parent)
+
+        directories = sorted(directories)
+        for i in range(0, len(directories), SCOPED_STATUS_BATCH_SIZE):
+            targets = [f"{d}@" if "@" in d else d for d in directories[i:i + SCOPED_STATUS_BATCH_SIZE]]
+            self.run_svn_command("update", ["--depth=empty", "--quiet", "-r", str(revision)] + targets)
+
+    def get_committed_revision(self, commit_output):
+        """The revision 'svn commit' reports, asking the repository (not the working copy) if it cannot be found"""
+        match = re_committed_revision.search(commit_output)
+        if match:
+            return int(match.group(1))
+
+        logger.warning(f"Could not find the committed revision in: {commit_output}")
+        revision = self.run_svn_command("info", ["--show-item", "last-changed-revision", self.to_repo_url("")],
+                                        do_combine=True)
+        return int(revision.strip())
+
+    def set_revision_properties(self, revision, username, date):
+        """
+        Set svn:author and svn:date of a committed revision on the repository. Neither the working copy nor the
+        log is read back, the log cache only drops its entry for the revision.
+        """
+        logger.info(f"Updating author to '{username}' and date to '{date}' on r{revision}")
         if DUMMY_SVN:
-            return self.get_last_commit(with_pull=True)
-
-        svn_rev = revision
-        try:
-            self.run_svn_command('propset', ['--revprop', f"-r{svn_rev}", 'svn:author', username])
-            commit_info = self.get_last_commit(with_pull=True)
-            logger.info(f"Successfully updated author to {username} on r{revision}")
-            return commit_info
-        except Exception as exc:
-            logger.info(f"Failed to update author on revision=r{svn_rev} to '{username} due to: {exc}")
-            raise exc
-
-    def update_timestamp(self, revision, timestamp):
-        logger.info(f"Updating date to '{timestamp}' on r{revision}")
-        if DUMMY_SVN:
-            return self.get_last_commit(with_pull=True)
+            return
 
-        svn_rev = revision
+        date_obj = date if isinstance(date, datetime) else dateparser.parse(date)
+        time_str = date_obj.astimezone(timezone.utc).strftime("%Y-%m-%dT%H:%M:%S.%fZ")
+        url = self.to_repo_url("")
         try:
-            time_str = timestamp.astimezone(timezone.utc).strftime("%Y-%m-%dT%H:%M:%S.%fZ")
-            self.run_svn_command('propset', ['--revprop', f"-r{svn_rev}", 'svn:date', time_str])
-            commit_info = self.get_last_commit(with_pull=True)
-            logger.info(f"Successfully updated date to {timestamp} on r{revision}")
-            return commit_info
+            for name, value in (('svn:author', username), ('svn:date', time_str)):
+                self.run_svn_command('propset', ['--revprop', f"-r{revision}", name, value, url])
         except Exception as exc:
-            logger.info(f"Failed to update date on revision=r{svn_rev} to '{timestamp} due to: {exc}")
+            logger.info(f"Failed to update author/date on revision=r{revision} to '{username}'/{time_str} "
+                        f"due to: {exc}")
             raise exc
+        finally:
+            self._log_cache.pop(int(revision), None)
 
     def apply(self, rev, diff, src: TrackerBase = None, files: list = ()):
         logger.info(f"Performing 'svn patch <diff>' for rev: {rev}")
         if DUMMY_SVN:
             return
 
-        patch_path, formatted_diff = self.format_and_save(rev, diff)
-        binary_files = git_get_binary_files(formatted_diff)
-        renamed_files = git_get_rename_files(diff)
-
-        if USE_PATCH_TOOL_FOR_SVN:
-            orig_dir = os.getcwd()
-            try:
-                os.chdir(self.repo.path)
-                pto = patch.fromfile(patch_path)
-                logger.info(f'Finished patching rev: {rev}')
-                if pto.apply():
-                    return True
-            finally:
-                os.chdir(orig_dir)
+        self.touched_paths = list(files)
+        if USE_APPLY_ENGINE and not isinstance(diff, DiffStream):
+            model = self.parse_diff(diff)
+            self.touched_paths = self.changed_paths(model, files)
+            self.archive_patch(rev, contents="\n".join(model.lines))
+            # moved first so that they keep their history, the engine then patches them in place
+            self.force_rename(model.rename_files())
+            result = self.apply_in_process(rev, model)
+            self.schedule_changes(result, [file['from'] for file in model.rename_files()])
+            digests = result.digests
         else:
+            patch_path, model = self.format_and_save(rev, diff)
+            self.touched_paths = self.changed_paths(model, files)
+            digests = None
+
+            if USE_PATCH_TOOL_FOR_SVN:
+                orig_dir = os.getcwd()
+                try:
+                    os.chdir(self.repo.path)
+                    pto = patch.fromfile(patch_path)
+                    logger.info(f'Finished patching rev: {rev}')
+                    if pto.apply():
+                        return True
+                finally:
+                    os.chdir(orig_dir)
+
+                logger.info(f"Could not apply patch for rev: {rev}")
+                return None
+
             patch_result = self.run_svn_command("patch", [patch_path])
             logger.info(f'Finished patching rev: {rev}, result = {patch_result}')
 
-            if src and src.type == "Git":
-                self.retrieve_binaries(binary_files, rev, src)
-                self.force_rename(renamed_files)
-
-            if not self.verify_apply(rev, src, diff, files):
-                return False
+        if src and src.type == "Git":
+            self.retrieve_binaries(model.binary_files(), rev, src)
+            if digests is None:
+                self.force_rename(model.rename_files())
 
-            return True if self.has_changes(rev, files) else False
+        if not self.verify_apply(rev, src, model, files, digests):
+            return False
 
-        logger.info(f"Could not apply patch for rev: {rev}")
+        return True if self.has_changes(rev, self.touched_paths) else False
+
+    def schedule_changes(self, result: ApplyResult, moved_from=()):
+        """
+        'svn add'/'svn rm' the files the apply engine created and deleted, executable modes become svn:executable.
+        Directories left without files by deletes and renames (moved_from) are removed, as 'svn patch' does.
+        """
+        executable = [path for path, mode in result.modes.items() if mode == EXECUTABLE_MODE]
+        not_executable = [path for path, mode in result.modes.items()
+                          if mode != EXECUTABLE_MODE and result.old_modes.get(path) == EXECUTABLE_MODE]
+        emptied = self.emptied_working_copy_directories(result.deleted + list(moved_from))
+        for subcommand, args, paths in (("add", ["--force", "--parents"], result.created),
+                                        ("rm", ["--force"], result.deleted),
+                                        ("rm", ["--force"], emptied),
+                                        ("propset", ["svn:executable", "*"], executable),
+                                        ("propdel", ["svn:executable"], not_executable)):
+            for i in range(0, len(paths), SCOPED_STATUS_BATCH_SIZE):
+                targets = [f"{path}@" if "@" in path else path for path in paths[i:i + SCOPED_STATUS_BATCH_SIZE]]
+                self.run_svn_command(subcommand, args + targets)
+
+    def emptied_working_copy_directories(self, removed_paths):
+        """The topmost directories above removed_paths that have nothing left in them on disk"""
+        directories = set()
+        for path in removed_paths:
+            directory = os.path.dirname(path)
+            while directory:
+                directories.add(directory)
+                directory = os.path.dirname(directory)
+
+        # deepest first, a directory is empty when all it holds are directories found empty before it
+        emptied = set()
+        for directory in sorted(directories, key=lambda d: d.count("/"), reverse=True):
+            full_path = os.path.join(self.repo.path, directory)
+            if os.path.isdir(full_path) and all(f"{directory}/{name}" in emptied for name in os.listdir(full_path)):
+                emptied.add(directory)
+
+        return sorted(d for d in emptied if os.path.dirname(d) not in emptied)
 
     def force_rename(self, renamed_files):
         # handle file renames
@@ -217,42 +355,221 @@ class SvnTracker(TrackerBase):
 
     def retrieve_binaries(self, binary_files, rev: str, src: TrackerBase):
         """directly retrieve binaries from the revision control system"""
-        for file in binary_files:
-            ba = bytearray(src.run_command("git", ["show", "--binary", f"{rev}:{file}"], return_binary=True))
-            self.overwrite_file(file, ba)
-
-    def format_and_save(self, rev, diff: str):
-        diff_lines = svn_format_diff(diff, revision=rev) if USE_SVN_PATCH_FORMAT else diff.splitlines(keepends=False)
-        patch_path = f"{patches_dir}{self.name}/{rev}.txt"
+        self.transfer_files(rev, src, binary_files)
+
+    def format_and_save(self, rev, diff):
+        patch_path = self.patch_path(rev)
+        if isinstance(diff, DiffStream):
+            with open(patch_path, "w", encoding="utf-8-sig", errors="surrogateescape", newline="\n",
+                      buffering=DIFF_STREAM_BUFFER_SIZE) as patch_file:
+                model = spool_diff(diff.lines(), patch_file, "svn" if USE_SVN_PATCH_FORMAT else "", revision=rev)
+            self.archive_patch(rev, patch_path)
+            return patch_path, model
+
+        model = self.parse_diff(diff)
+        diff_lines = svn_format_diff(model, revision=rev) if USE_SVN_PATCH_FORMAT else model.lines
         with open(patch_path, "w", encoding="utf-8-sig", newline="\n") as patch_file:
             patch_file.write(u"\n".join(diff_lines))
             patch_file.flush()
             patch_file.close()
 
-        return patch_path, "\n".join(diff_lines)
+        self.archive_patch(rev, patch_path)
+        return patch_path, model
 
     def get_file(self, rev, file, is_binary=False, encoding="utf-8-sig"):
         logger.info(f"Pulling contents of file (rev={rev}) = {file} and is_binary={is_binary}")
-        file_contents = self.run_command("svn", ["cat", "-r", rev, file])
         if is_binary:
-            return bytearray(file_contents, encoding=encoding)
+            prefetched = self.take_prefetched(rev, file)
+            if prefetched is not None:
+                return prefetched
 
+        if is_binary:
+            # raw bytes, binary contents do not survive a round trip through a text encoding
+            return self.cat_file(rev, file)
+
+        file_contents = self.run_command("svn", ["cat", "-r", rev, file])
         return "\n".join(file_contents.splitlines(keepends=False))
 
-    def overwrite_file(self, file, contents):
-        super().overwrite_file(file, contents)
-        self.run_svn_command("add", ["--force", "--parents", file])
+    def get_synced_revisions(self):
+        result = self.run_svn_command("log", ["--xml", "-r", "1:HEAD", self.to_repo_url("")], do_combine=True)
+        for e in xml.etree.ElementTree.fromstring(result).iter('logentry'):
+            source_rev = self.parse_synced_from(e.findtext('msg'))
+            if source_rev:
+                yield source_rev, e.get('revision')
+
+    def cat_file(self, rev, file) -> bytes:
+        """Raw contents of a file at a revision, read by URL so files deleted since then can still be read"""
+        return self.run_command("svn", ["cat", f"{self.to_repo_url(file)}@{rev}"], return_binary=True)
+
+    def open_file(self, rev, file):
+        """'svn cat' of a file at a revision (see cat_file), streamed from its output"""
+        return ProcessStream(["svn", "cat", f"{self.to_repo_url(file)}@{rev}"], self.repo.path)
+
+    def to_repo_url(self, file):
+        if self._url is None:
+            self._url = self.run_svn_command("info", ["--show-item", "url"], do_combine=True).strip().rstrip("/")
+        return f"{self._url}/{quote(file)}" if file else self._url
+
+    def get_changed_files(self, rev):
+        """
+        Files changed by a revision, relative to the working copy. Deleted directories are reported as they are,
+        copied directories are expanded to the files they contain.
+
+        :return: (deleted paths, added or modified files)
+        """
+        deleted, changed = [], []
+        for change in self.get_log_entry(rev).paths:
+            relative = self.to_relative_paths([change.path])
+            if not relative:
+                continue
+            path = relative[0]
+
+            if change.action in ("D", "R"):
+                deleted.append(path)
+            if change.action == "D":
+                continue
+
+            if change.kind == "dir":
+                if change.action != "M":
+                    changed.extend(f"{path}/{file}" for file in self.list_files(rev, path))
+            else:
+                changed.append(path)
+
+        return deleted, list(dict.fromkeys(changed))
+
+    def list_files(self, rev, directory):
+        listing = self.run_command("svn", ["list", "-R", f"{self.to_repo_url(directory)}@{rev}"])
+        return [entry for entry in listing.splitlines(keepends=False) if entry and not entry.endswith("/")]
+
+    def get_file_properties(self, rev, files, batch_size=100):
+        """
+        Versioned properties of files at a revision
+
+        :return: {file: {property: value}} for files that have any
+        """
+        properties = {}
+        for i in range(0, len(files), batch_size):
+            batch = files[i:i + batch_size]
+            urls = [self.to_repo_url(file) for file in batch]
+            by_url = {unquote(url): file for url, file in zip(urls, batch)}
+
+            result = self.run_command("svn", ["proplist", "--xml", "-v"] + [f"{url}@{rev}" for url in urls])
+            if not result.strip():
+                continue
+
+            for target in xml.etree.ElementTree.fromstring(result).iter('target'):
+                file = by_url.get(unquote(target.get('path', '')))
+                if file is not None:
+                    properties[file] = {p.get('name'): p.text or "" for p in target.iter('property')}
+
+        return properties
+
+    def get_file_sizes(self, rev, files, batch_size=100):
+        sizes = {}
+        for i in range(0, len(files), batch_size):
+            batch = files[i:i + batch_size]
+            urls = [self.to_repo_url(file) for file in batch]
+            by_url = {unquote(url): file for url, file in zip(urls, batch)}
+
+            result = self.run_command("svn", ["list", "--xml"] + [f"{url}@{rev}" for url in urls])
+            try:
+                listings = xml.etree.ElementTree.fromstring(result)
+            except xml.etree.ElementTree.ParseError:
+                # a missing file stops 'svn list' halfway, the sizes of the whole batch are then left out
+                continue
+
+            for listing in listings.iter('list'):
+                file = by_url.get(unquote(listing.get('path', '')))
+                size = listing.findtext('entry/size')
+                if file is not None and size is not None:
+                    sizes[file] = int(size)
+
+        return sizes
+
+    def get_file_digest(self, rev, file):
+        return file_utils.content_digest(self.run_command("svn", ["cat", "-r", f"{rev}", file], return_binary=True))
+
+    def add_files(self, files):
+        for i in range(0, len(files), SCOPED_STATUS_BATCH_SIZE):
+            targets = [f"{file}@" if "@" in file else file for file in files[i:i + SCOPED_STATUS_BATCH_SIZE]]
+            self.run_svn_command("add", ["--force", "--parents"] + targets)
 
     def has_changes(self, rev: str, files: list = ()):
+        """Whether the working copy has changes, in 'files' only when they are given"""
         if DUMMY_SVN:
             return True
 
+        if SCOPED_STATUS and files:
+            if self.get_changed_paths(files):
+                return True
+            logger.info(f"No changes found in the {len(files)} paths of rev: {rev}, checking the whole working copy")
+
         status = self.repo.status()
         if len(list(status)) == 0:
             return False
 
         return True
 
+    def get_status(self, paths):
+        """
+        'svn status' of just 'paths' (no depth)
+
+        :return: (the 7 status columns, path) of every path with a status
+        """
+        entries = []
+        for i in range(0, len(paths), SCOPED_STATUS_BATCH_SIZE):
+            # a trailing '@' keeps svn from reading an '@' in the path as a peg revision
+            targets = [f"{path}@" if "@" in path else path for path in paths[i:i + SCOPED_STATUS_BATCH_SIZE]]
+            # paths that do not exist (e.g. rename sources already gone) are only warned about on stderr
+            status = self.run_command("svn", ["status", "--depth=empty"] + targets)
+            for line in status.splitlines():
+                # 7 status columns and a space before the path, other lines are notes (e.g. on tree conflicts)
+                if len(line) > 8 and line[7] == " ":
+                    entries.append((line[:7], line[8:]))
+
+        return entries
+
+    def get_changed_paths(self, paths):
+        """Added, deleted, modified, unversioned or missing paths among 'paths'"""
+        return [path for status, path in self.get_status(paths) if status[0] in "ACDMR?!~" or status[1] in "CM"]
+
+    def is_damaged(self):
+        """Working copy locks or unfinished work (e.g. an interrupted update) recorded in the working copy database"""
+        if DUMMY_SVN or self.is_test:
+            return False
+
+        database = pathlib.Path(self.repo.path, ".svn", "wc.db").resolve().as_uri()
+        with contextlib.closing(sqlite3.connect(f"{database}?mode=ro", uri=True)) as connection:
+            return any(connection.execute(f"SELECT 1 FROM {table} LIMIT 1").fetchone()
+                       for table in ("WC_LOCK", "WORK_QUEUE"))
+
+    def restore_paths(self, paths):
+        """Revert 'paths' and their parent directories, then delete whatever is left unversioned among them"""
+        if DUMMY_SVN or self.is_test:
+            return
+
+        directories = set()
+        for directory in {os.path.dirname(path) for path in paths} - {""}:
+            directories.update(itertools.accumulate(directory.split("/"), lambda parent, name: f"{parent}/{name}"))
+        paths = list(paths) + sorted(directories - set(paths))
+
+        # additions are reverted with everything below them (all new), anything else on its own
+        statuses = self.get_status(paths)
+        for depth, reverted in (("infinity", [path for status, path in statuses if status[0] in "AR"]),
+                                ("empty", [path for status, path in statuses if status[0] not in "AR?"])):
+            for i in range(0, len(reverted), SCOPED_STATUS_BATCH_SIZE):
+                targets = [f"{path}@" if "@" in path else path for path in reverted[i:i + SCOPED_STATUS_BATCH_SIZE]]
+                self.run_svn_command("revert", [f"--depth={depth}"] + targets)
+
+        # reverted additions stay on disk, unversioned; deepest first so directories are empty when removed
+        unversioned = [path for status, path in self.get_status(paths) if status[0] == "?"]
+        for path in sorted(unversioned, key=lambda p: p.count("/"), reverse=True):
+            full_path = os.path.join(self.repo.path, path)
+            if os.path.isdir(full_path):
+                shutil.rmtree(full_path)
+            elif os.path.lexists(full_path):
+                os.remove(full_path)
+
     def revert_all(self):
         logger.info("Performing 'svn revert --depth=infinity .'")
         if DUMMY_SVN or self.is_test:
@@ -1,10 +1,50 @@
+import io
+import re
+import sqlite3
 import difflib
-from typing import List, NamedTuple
-
-from utils import file_utils, logger, diff_tools
+import contextlib
+import functools
+import inspect
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import Dict, List, NamedTuple, Union
+
+from utils import file_utils, logger, diff_tools, metrics, tracing, patch_apply, patch_archive
+from server.config import VERIFY_WORKERS, APPLY_FUZZ, BLOB_CHUNK_SIZE, TRANSFER_WORKERS
+from server.config import patches_dir, patch_archive_dir, ARCHIVE_PATCHES
+from server.config import PATCH_RETENTION_DAYS, PATCH_RETENTION_COUNT, PATCH_RETENTION_BYTES
 
 logger = logger.get_logger(__name__)
 
+# every synced commit ends with this trailer naming the source revision, see the commit() implementations
+SYNCED_FROM_TRAILER = re.compile(r"^#Synced from: (\S+)\s*$", re.MULTILINE)
+
+
+def in_caller_context(function):
+    """
+    Wrap a function handed to a thread pool so that it runs with the sync, revision usage and revision trace of the
+    thread submitting it; they are thread-local and would otherwise be lost on the pool threads
+    """
+    context, trace = metrics.current_context(), tracing.current_trace()
+
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        with metrics.in_context(context), tracing.in_trace(trace):
+            return function(*args, **kwargs)
+
+    return wrapper
+
+
+class TransferError(Exception):
+    """Files of a revision that could not be copied from the source, with the error of each"""
+
+    def __init__(self, rev, errors):
+        self.rev = rev
+        self.errors = errors
+        listed = ", ".join(f"{file} ({error})" for file, error in list(errors.items())[:10])
+        more = f" and {len(errors) - 10} more" if len(errors) > 10 else ""
+        super().__init__(f"Could not copy {len(errors)} files of rev: {rev}: {listed}{more}")
+
 
 class IdenticalCheckResult(NamedTuple):
     is_identical: bool
@@ -13,9 +53,23 @@ class IdenticalCheckResult(NamedTuple):
     identical_count: int
 
 
+# tracker methods timed as stages of a sync (see metrics.timed_stage), every public method is traced
+STAGES = ('get_diff', 'format_and_save', 'apply', 'verify_apply', 'commit', 'get_last_commit')
+
+
 class TrackerMeta(type):
     """A repo tracker metaclass that will be used for tracker creation"""
 
+    def __init__(cls, name, bases, namespace):
+        super().__init__(name, bases, namespace)
+        for method_name, method in namespace.items():
+            if method_name.startswith("_") or not inspect.isfunction(method):
+                continue
+            method = tracing.traced_method(method_name, method)
+            if method_name in STAGES:
+                method = metrics.timed_stage(method_name, method)
+            setattr(cls, method_name, method)
+
     def __instancecheck__(cls, instance):
         return cls.__subclasscheck__(type(instance))
 
@@ -45,20 +99,106 @@ class TrackerBase(metaclass=TrackerMeta):
         self.type = tracker_type
         self.repo_path = repo_path
         self.args = kwargs
+        self._prefetched = {}
+        self._prefetched_size = 0
+        self._prefetched_lock = threading.Lock()
+        # working tree paths the revision being applied touches, restored after an error (see restore)
+        self.touched_paths = []
+        # files read from this tracker at once when copying them to another one (see copy_concurrently)
+        self.transfer_workers = kwargs.get('transfer_workers') or TRANSFER_WORKERS.get(tracker_type, 1)
 
     def run_command(self, subcommand, args=(), encoding="utf-8-sig", return_binary=False):
         pass
 
     def overwrite_file(self, file, contents):
+        self.write_file(file, contents)
+        self.add_files([file])
+
+    def write_file(self, file, contents):
+        """Write a file of the working tree, without telling the repository about it (see add_files)"""
         logger.info(f"Overwriting file: {file} with new contents")
-        logger.debug(f"Overwrite contents: {contents}")
+        logger.debug("Overwrite contents: %s", contents)
 
         file_path = f"{self.repo_path}/{file}"
         file_utils.overwrite_file(file_path, contents)
 
+    def add_files(self, files):
+        """Put files written to the working tree under version control, where the repository needs to be told"""
+        pass
+
+    def transfer_files(self, rev, src, files):
+        """Stream (binary) files of a revision of src into this working tree concurrently, see transfer_file"""
+        TrackerBase.copy_concurrently(rev, src, files,
+                                      lambda file: src.transfer_file(rev, file, f"{self.repo_path}/{file}"))
+        self.add_files(files)
+
     def get_file(self, rev, file, is_binary=False, encoding="utf-8-sig"):
         pass
 
+    def open_file(self, rev, file):
+        """
+        A readable binary stream of a file at a revision, to be closed by the caller. Trackers stream it from the
+        output of the command reading it, this default reads the whole file through get_file.
+
+        :return: the stream, None if the file does not exist at that revision
+        """
+        return io.BytesIO(self.get_file(rev, file, is_binary=True))
+
+    def transfer_file(self, rev, file, file_path, chunk_size=BLOB_CHUNK_SIZE):
+        """
+        Write a (binary) file of a revision of this tracker to 'file_path', e.g. in another tracker's working tree.
+        Its contents are streamed from open_file in chunk_size pieces, so memory use does not grow with the file, and
+        the target is only replaced once the whole file was read (a missing file is written empty).
+        """
+        prefetched = self.take_prefetched(rev, file)
+        if prefetched is not None:
+            file_utils.write_atomically(file_path, bytes(prefetched))
+            return
+
+        stream = self.open_file(rev, file)
+        if stream is None:
+            file_utils.write_atomically(file_path, b"")
+            return
+
+        with contextlib.closing(stream):
+            file_utils.write_stream_atomically(file_path, stream, chunk_size)
+
+    def get_file_sizes(self, rev, files) -> Dict[str, int]:
+        """Sizes in bytes of files at a revision, files whose size cannot be told are left out"""
+        return {}
+
+    def prefetch_files(self, rev, files, max_bytes):
+        """
+        Read binary files of an upcoming revision ahead of time, holding at most max_bytes at once. Files that do not
+        fit in what is left of the budget, or whose size is unknown, are left to be streamed by transfer_file.
+        """
+        sizes = self.get_file_sizes(rev, files)
+        for file in files:
+            size = sizes.get(file)
+            with self._prefetched_lock:
+                if size is None or self._prefetched_size + size > max_bytes:
+                    logger.info(f"{file} (rev={rev}, {size} bytes) does not fit in the prefetch budget of {max_bytes} "
+                                f"bytes, it will be read later")
+                    continue
+
+            contents = self.get_file(rev, file, is_binary=True)
+            with self._prefetched_lock:
+                self._prefetched[(str(rev), file)] = contents
+                self._prefetched_size += len(contents)
+
+    def take_prefetched(self, rev, file):
+        """Hand over (and forget) a file read by prefetch_files, None if it was not prefetched"""
+        with self._prefetched_lock:
+            contents = self._prefetched.pop((str(rev), file), None)
+            if contents is not None:
+                self._prefetched_size -= len(contents)
+            return contents
+
+    def clear_prefetched(self):
+        with self._prefetched_lock:
+            self._prefetched.clear()
+            self._prefetched_size = 0
+
     def get_current_file(self, file, is_binary=False, encoding="utf-8-sig"):
         logger.info(f"Pulling contents of file (local) = {file} and is_binary={is_binary}")
 
@@ -74,15 +214,82 @@ class TrackerBase(metaclass=TrackerMeta):
 
         return "\n".join(file_contents.splitlines(keepends=False))
 
+    def get_file_digest(self, rev, file):
+        """Digest of a file at a revision, comparable with get_current_file_digest (see file_utils.NormalizedDigest)"""
+        return file_utils.content_digest(self.get_file(rev, file))
+
+    def get_current_file_digest(self, file):
+        return file_utils.file_digest(f"{self.repo_path}/{file}")
+
+    def parse_diff(self, diff) -> diff_tools.DiffModel:
+        """Parse a source diff the way this tracker reads it when applying"""
+        return diff_tools.parse_diff(diff)
+
     def format_and_save(self, rev, diff):
         pass
 
+    def patch_path(self, rev):
+        """Where format_and_save writes the patch of a revision, one file reused by every revision if they are archived"""
+        return f"{patches_dir}{self.name}/{'current' if ARCHIVE_PATCHES else rev}.txt"
+
+    def archive_patch(self, rev, patch_path=None, contents=None):
+        """Keep the patch of a revision (a patch file or its contents) in the patch archive, see utils.patch_archive"""
+        if not ARCHIVE_PATCHES:
+            return
+
+        try:
+            archive = patch_archive.get_archive(patch_archive_dir, retention_days=PATCH_RETENTION_DAYS,
+                                                retention_count=PATCH_RETENTION_COUNT,
+                                                retention_bytes=PATCH_RETENTION_BYTES)
+            if patch_path is not None:
+                archive.put_file(self.name, rev, patch_path)
+            else:
+                archive.put(self.name, rev, contents)
+        except (OSError, sqlite3.Error) as e:
+            # only needed for debugging, a sync does not stop for it
+            logger.warning(f"Could not archive the patch of rev: {rev}: {e}")
+
+    def apply_in_process(self, rev, model: diff_tools.DiffModel, ignore_whitespace=False) -> patch_apply.ApplyResult:
+        """Apply the text changes of a parsed diff to the working tree without a patch file (see patch_apply)"""
+        result = patch_apply.apply_diff(model, self.repo_path, fuzz=APPLY_FUZZ, ignore_whitespace=ignore_whitespace)
+        logger.info(f'Finished patching rev: {rev} in-process, result = {result}')
+        return result
+
     def get_diff(self, rev: str):
         pass
 
     def cleanup(self):
         pass
 
+    def restore(self):
+        """
+        Undo what the last applied revision left in the working tree, touching only its paths. Falls back to a full
+        cleanup() when the working tree is damaged (locks, unfinished operations), changes remain or restoring fails.
+        """
+        paths, self.touched_paths = self.touched_paths, []
+        try:
+            if not self.is_damaged():
+                if paths:
+                    logger.info(f"Restoring {len(paths)} paths in {self.type}")
+                    self.restore_paths(paths)
+                if not self.is_damaged() and not (paths and self.get_changed_paths(paths)):
+                    return
+        except Exception as e:
+            logger.warning(f"Could not restore {len(paths)} paths in {self.type}: {e}")
+
+        logger.info(f"Leftover damage in {self.type}, performing a full cleanup")
+        self.cleanup()
+
+    def is_damaged(self):
+        """Whether the working tree needs a full cleanup whatever the paths touched, always for unknown trackers"""
+        return True
+
+    def restore_paths(self, paths):
+        pass
+
+    def get_changed_paths(self, paths):
+        return []
+
     def get_last_commit(self, with_pull=False):
         pass
 
@@ -92,13 +299,33 @@ class TrackerBase(metaclass=TrackerMeta):
     def commit(self, date, msg, author, rev, diff, files=(), src=None):
         pass
 
-    def verify_apply(self, rev: str, src, diff: str, files: List[str]) -> bool:
+    def has_unflushed_commits(self):
+        """Whether commits made so far could still be dropped by a restore(), see flush_commits()"""
+        return False
+
+    def flush_commits(self):
+        """Make every commit made so far durable"""
+        pass
+
+    def get_synced_revisions(self):
+        """(source revision, revision) pairs parsed from the '#Synced from:' trailers of this tracker's history"""
+        return []
+
+    @staticmethod
+    def parse_synced_from(message):
+        """the source revision a commit was synced from, None if the message has no trailer"""
+        matches = SYNCED_FROM_TRAILER.findall(message or "")
+        return matches[-1] if matches else None
+
+    def verify_apply(self, rev: str, src, diff: Union[str, diff_tools.DiffModel], files: List[str],
+                     digests: Dict[str, str] = None) -> bool:
+        """:param digests: digests of files as they were just written (see apply_in_process), not read back"""
         logger.info(f"Verifying patch apply for {len(files)} files for rev: {rev}")
-        binary_files = diff_tools.git_get_binary_files(diff)
+        binary_files = diff_tools.parse_diff(diff).binary_files()
         logger.info(f"Binary files will be skipped: {binary_files}")
 
         files_to_verify = list(filter(lambda f: f not in binary_files, files))
-        check_identical = TrackerBase.check_identical_files(rev, src, self, files_to_verify)
+        check_identical = TrackerBase.check_identical_files(rev, src, self, files_to_verify, digests)
         if not check_identical.is_identical:
             logger.info(f"Copy files over manually as last resort, files = {check_identical.files}")
             TrackerBase.try_copy_files(rev, src, self, check_identical.files)
@@ -112,48 +339,100 @@ class TrackerBase(metaclass=TrackerMeta):
         return True
 
     @staticmethod
-    def check_identical_files(rev: str, src, tgt, files: List[str]) -> IdenticalCheckResult:
+    def changed_paths(diff: diff_tools.DiffModel, files=()) -> List[str]:
+        """The paths a revision touches: its changelist plus every path of its diff, rename sources and targets"""
+        paths = set(files or ())
+        for file in diff.files:
+            paths.update(path for path in (file.old_path, file.new_path, file.rename_from, file.rename_to) if path)
+        paths.discard("/dev/null")
+        return sorted(paths)
+
+    @staticmethod
+    def check_identical_files(rev: str, src, tgt, files: List[str], digests: Dict[str, str] = None) \
+            -> IdenticalCheckResult:
         diffs = {}
         diff_files = []
-        diff_count = 0
         identical_count = 0
         is_identical = len(files) > 0
 
-        for file in files:
-            is_file_identical = True
-            try:
-                src_content: str = src.get_file(rev, file)
-                tgt_content: str = tgt.get_current_file(file)
-                print(f"Src: {src_content}")
-                print(f"Tgt: {tgt_content}")
-                if file_utils.is_content_identical(tgt_content, src_content):
+        with ThreadPoolExecutor(max_workers=VERIFY_WORKERS) as pool:
+            results = pool.map(in_caller_context(lambda f: TrackerBase.check_identical_file(rev, src, tgt, f, digests)),
+                               files)
+            for file, error in zip(files, results):
+                if error is None:
                     identical_count += 1
                 else:
-                    is_file_identical = False
-                    diff_count += 1
                     diff_files.append(file)
-                    diffs[file] = difflib.unified_diff(tgt_content.splitlines(keepends=False),
-                                                       src_content.splitlines(keepends=False))
+                    diffs[file] = error
+
+        # only files that differ are worth the cost of a unified diff
+        for file in diff_files:
+            if diffs[file]:
+                continue
+            try:
+                diffs[file] = "\n".join(difflib.unified_diff(tgt.get_current_file(file).splitlines(keepends=False),
+                                                             src.get_file(rev, file).splitlines(keepends=False),
+                                                             lineterm=""))
             except Exception as e:
-                logger.error(e, "Failed in 'check_identical_files'")
-                is_file_identical = False
-                diff_count += 1
-                diff_files.append(file)
                 diffs[file] = repr(e)
-            finally:
-                is_identical &= is_file_identical
-                result = "contents same" if is_file_identical else "files differ"
-                logger.info(f"Checking if {file} is identical ({src.type} => {tgt.type}) => {result}")
 
         for name, diff in diffs.items():
-            logger.info(f"diff({name}):" + '\n'.join(diff))
+            logger.info("diff(%s): %s", name, diff)
+
+        is_identical &= len(diff_files) == 0
+        return IdenticalCheckResult(is_identical, diff_files, len(diff_files), identical_count)
 
-        return IdenticalCheckResult(is_identical, diff_files, diff_count, identical_count)
+    @staticmethod
+    def check_identical_file(rev: str, src, tgt, file: str, digests: Dict[str, str] = None):
+        """
+        Compare the digests of a file in the source revision and the target working copy
+
+        :param digests: known target digests, files not in there are read from the working copy
+        :return: None if the contents are the same, "" if they differ or the error that prevented the check
+        """
+        try:
+            current_digest = digests.get(file) if digests else None
+            is_file_identical = src.get_file_digest(rev, file) == (current_digest or tgt.get_current_file_digest(file))
+            error = None if is_file_identical else ""
+        except Exception as e:
+            logger.error(f"Failed in 'check_identical_files' for {file}", exc_info=e)
+            is_file_identical = False
+            error = repr(e)
+
+        result = "contents same" if is_file_identical else "files differ"
+        logger.info(f"Checking if {file} is identical ({src.type} => {tgt.type}) => {result}")
+        return error
 
     @staticmethod
     def try_copy_files(rev: str, src, tgt, files: List[str]):
         logger.info(f"Overwriting files: {files}")
-        for file in files:
+
+        def copy(file):
             logger.info(f"Attempt to overwrite file ({src.type} => {tgt.type}): {file}")
-            contents = src.get_file(rev, file)
-            tgt.overwrite_file(file, contents)
+            tgt.write_file(file, src.get_file(rev, file))
+
+        TrackerBase.copy_concurrently(rev, src, files, copy)
+        tgt.add_files(files)
+
+    @staticmethod
+    def copy_concurrently(rev: str, src, files: List[str], copy):
+        """
+        Run copy(file) for every file, at most src.transfer_workers at once. Every file is attempted whatever happens
+        to the others.
+
+        :raise TransferError: naming every file that could not be copied and why
+        """
+        errors = {}
+        workers = max(1, min(src.transfer_workers, len(files)))
+        with ThreadPoolExecutor(max_workers=workers, thread_name_prefix=f"transfer-{src.type}") as pool:
+            futures = {pool.submit(in_caller_context(copy), file): file for file in files}
+            for future in as_completed(futures):
+                file = futures[future]
+                try:
+                    future.result()
+                except Exception as e:
+                    logger.error(f"Could not copy {file} (rev: {rev}) from {src.type}", exc_info=e)
+                    errors[file] = e
+
+        if errors:
+            raise TransferError(rev, errors)
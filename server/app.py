@@ -1,18 +1,76 @@
 import sys
 import traceback
 import threading
-from time import sleep
+import random
+import multiprocessing
+from collections import deque
+from time import sleep, monotonic
 
 from server import config
-from utils import tracker, file_utils
+from utils import tracker, diff_tools, metrics, tracing
 from server import setup
 from server import web
 
 from utils.logger import get_logger
+from utils.prefetch import RevisionPrefetcher
 from repo.tracker_base import TrackerBase
 
 logger = get_logger(__name__)
 threads = []
+workers = {}
+
+
+class SyncScheduler:
+    """
+    Decides how long a sync waits before its next pass.
+    Idle syncs poll at about half their recent mean gap between commits and slow down further with every idle pass,
+    failures back off exponentially with jitter, and transient errors (lock contention) are retried quickly.
+    A trigger always ends the wait early.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.commit_times = deque()
+        self.idle_passes = 0
+        self.failures = 0
+        self.transient_failures = 0
+
+    def record_commits(self, count):
+        now = monotonic()
+        self.commit_times.extend([now] * count)
+        self.idle_passes = 0
+
+    def record_success(self):
+        self.failures = 0
+        self.transient_failures = 0
+
+    def commit_rate(self):
+        """commits per second over the last POLL_RATE_WINDOW seconds"""
+        horizon = monotonic() - config.POLL_RATE_WINDOW
+        while self.commit_times and self.commit_times[0] < horizon:
+            self.commit_times.popleft()
+        return len(self.commit_times) / config.POLL_RATE_WINDOW
+
+    def idle_delay(self):
+        rate = self.commit_rate()
+        interval = 1 / (2 * rate) if rate > 0 else config.POLL_INTERVAL_MAX
+        interval *= config.POLL_IDLE_GROWTH ** self.idle_passes
+        self.idle_passes += 1
+        return min(max(interval, config.POLL_INTERVAL_MIN), config.POLL_INTERVAL_MAX)
+
+    def failure_delay(self, exc):
+        if is_transient_error(exc) and self.transient_failures < config.TRANSIENT_RETRY_LIMIT:
+            self.transient_failures += 1
+            return config.TRANSIENT_RETRY_DELAY
+
+        self.failures += 1
+        delay = min(config.RETRY_BACKOFF_BASE * 2 ** (self.failures - 1), config.RETRY_BACKOFF_MAX)
+        return delay * (1 - random.uniform(0, config.RETRY_JITTER))
+
+
+def is_transient_error(exc):
+    message = str(exc)
+    return any(pattern in message for pattern in config.TRANSIENT_ERROR_PATTERNS)
 
 
 def start_revision_tracker(name: str, source: TrackerBase, target: TrackerBase):
@@ -21,18 +79,27 @@ def start_revision_tracker(name: str, source: TrackerBase, target: TrackerBase):
     commit_count = 0
     empty_count = 0
     identical_count = 0
+    schedule = SyncScheduler(name)
+    metrics.set_current_sync(name)
 
     source.cleanup()
     target.cleanup()
     tracker.initialize(name)
+    tracker.rebuild_revision_map(name, target)
+    trace_dir = config.traces_dir if config.TRACE_REVISIONS else None
+    profile_requests = tracing.ProfileRequests(config.profiles_dir)
+    if name in config.PROFILE_REVISIONS:
+        mode, revisions = config.PROFILE_REVISIONS[name]
+        profile_requests.request(name, revisions, mode)
 
     while True:
         try:
             if config.USE_TRIGGERS_TO_INITIATE_SYNC:
                 logger.info(f"{name}: Waiting for trigger to initiate sync")
-                file_utils.wait_until(web.has_trigger_for(name))
-                # clear trigger counters
-                web.clear_trigger_counter(name)
+                web.wait_for_trigger(name)
+            # clear trigger counters, triggers arriving from here on wake up the next wait
+            web.clear_trigger_counter(name)
+            metrics.record_pass(name)
 
             pending_revs = tracker.get_pending_revisions(name)
             last_src_tracked_rev, last_tgt_tracked_rev, last_src_tracked_rev_pos = tracker.get_last_revision(name)
@@ -58,76 +125,160 @@ def start_revision_tracker(name: str, source: TrackerBase, target: TrackerBase):
                         f"pending = {len(pending_revs)} commits, position = {last_src_tracked_rev_pos}")
 
             if len(pending_revs) <= 0:
-                logger.info(f"{name}: No pending changes...resume in 60 seconds")
-                web.clear_trigger_counter(name)
-                sleep(60)
+                tracker.flush()
+                publish_metrics(name)
+                schedule.record_success()
+                if not config.USE_TRIGGERS_TO_INITIATE_SYNC:
+                    delay = schedule.idle_delay()
+                    logger.info(f"{name}: No pending changes...resume in {delay:.0f} seconds or on trigger")
+                    web.wait_for_trigger(name, timeout=delay)
                 continue
 
-            logger.info(f"{name}: Revisions (pending): {', '.join(map(str, pending_revs))}")
+            logger.info(f"{name}: Revisions (pending): {len(pending_revs)} from {pending_revs[0]} to {pending_revs[-1]}")
 
             tracker.save_pending_revisions(name, pending_revs)
 
             latest_synced_tgt_rev = None
             latest_synced_src_rev = None
-            for rev in pending_revs[last_src_tracked_rev_pos:]:
-                try:
-                    logger.info(f"Processing rev: {rev} from position: {last_src_tracked_rev_pos}")
-                    date, msg, author, diff, files = source.get_diff(rev)
-                    if not file_utils.remove_control_characters(str(diff)).strip():
-                        logger.info(f"{name}: Diff was empty for revision: {rev}")
-                        empty_count += 1
-                        continue
-
-                    target_msg, latest_synced_tgt_rev = target.commit(date, msg, author, rev, diff, files, src=source)
-                    iteration_count += 1
-
-                    if latest_synced_tgt_rev:
-                        commit_count += 1
-                        last_src_tracked_rev_pos += 1
-                        latest_synced_src_rev = rev
-                        # Only update position but keep original start and end points
-                        tracker.set_last_revision(name, last_src_tracked_rev, last_tgt_tracked_rev,
-                                                  last_src_tracked_rev_pos)
-                        sleep(1)
-                    else:
-                        raise Exception("Patch application produces no revision changes")
-                except Exception as exc:
-                    logger.error(f"{name}: {exc} occurred in apply diff loop")
-                    traceback.print_exc(file=sys.stdout)
-                    raise
+            # (source, target) revisions committed but not durable on the target yet
+            unsaved_revs = []
+            prefetcher = RevisionPrefetcher(source, target, pending_revs[last_src_tracked_rev_pos:],
+                                            config.PREFETCH_DEPTH, config.PREFETCH_BLOB_BUDGET, trace_dir)
+            try:
+                for rev, date, msg, author, diff, files, usage in prefetcher:
+                    try:
+                        logger.info(f"Processing rev: {rev} from position: {last_src_tracked_rev_pos}")
+                        if diff_tools.is_empty_diff(diff):
+                            logger.info(f"{name}: Diff was empty for revision: {rev}")
+                            tracker.set_revision_status(name, rev, "empty")
+                            metrics.record_revision(name, "empty", usage)
+                            empty_count += 1
+                            continue
+
+                        with metrics.track_revision(usage), tracing.revision_trace(trace_dir, name, rev), \
+                                tracing.profiled(profile_requests.take(name), f"{config.profiles_dir}{name}_{rev}"):
+                            target_msg, latest_synced_tgt_rev = target.commit(date, msg, author, rev, diff, files,
+                                                                              src=source)
+                        iteration_count += 1
+
+                        if latest_synced_tgt_rev:
+                            commit_count += 1
+                            schedule.record_commits(1)
+                            last_src_tracked_rev_pos += 1
+                            latest_synced_src_rev = rev
+                            unsaved_revs.append((rev, latest_synced_tgt_rev))
+                            # a target that checkpoints its commits (fast-import) may still drop this one on restore
+                            if not target.has_unflushed_commits():
+                                save_synced_revisions(name, unsaved_revs, last_src_tracked_rev,
+                                                      last_tgt_tracked_rev, last_src_tracked_rev_pos)
+                            metrics.record_revision(name, "committed", usage)
+                            publish_metrics(name)
+                        else:
+                            raise Exception("Patch application produces no revision changes")
+                    except Exception as exc:
+                        logger.error(f"{name}: {exc} occurred in apply diff loop")
+                        tracker.set_revision_status(name, rev, "failed")
+                        metrics.record_revision(name, "failed", usage)
+                        traceback.print_exc(file=sys.stdout)
+                        raise
+            finally:
+                prefetcher.close()
+
+            if unsaved_revs:
+                target.flush_commits()
+                save_synced_revisions(name, unsaved_revs, last_src_tracked_rev, last_tgt_tracked_rev,
+                                      last_src_tracked_rev_pos)
 
             # done current batch scenario, move latest revision for src and tgt to final items
             if last_src_tracked_rev_pos >= len(pending_revs):
                 logger.info(f"Finished batch of {len(pending_revs)} revisions from index {last_src_tracked_rev_pos}")
                 logger.info(f"Saving limit from '{last_src_tracked_rev}' to '{latest_synced_src_rev}'")
                 tracker.set_last_revision(name, latest_synced_src_rev, latest_synced_tgt_rev, -1)
+            schedule.record_success()
 
         except Exception as loopEx:
             logger.critical(f"{name}: {loopEx} occurred. Cleaning up...")
             traceback.print_exc(file=sys.stdout)
 
             # clean up
-            source.cleanup()
-            target.cleanup()
+            tracker.flush()
+            publish_metrics(name)
+            if config.SCOPED_RESTORE:
+                source.restore()
+                target.restore()
+            else:
+                source.cleanup()
+                target.cleanup()
 
+            delay = schedule.failure_delay(loopEx)
             logger.critical(f"{name}: Cleaned up error. Retrying...")
-            logger.critical(f"{name}: Encountered error...resume in 60 seconds")
-            sleep(60)
+            logger.critical(f"{name}: Encountered error...resume in {delay:.0f} seconds or on trigger")
+            web.wait_for_trigger(name, timeout=delay)
 
     logger.info(f"Stopping revision tracker ({name}...")
 
 
+def save_synced_revisions(name, synced_revs, last_src_tracked_rev, last_tgt_tracked_rev, position):
+    """Record synced (source, target) revisions and move the position, keeping the batch start and end points"""
+    for rev, tgt_rev in synced_revs:
+        tracker.set_revision_status(name, rev, "synced", tgt_rev)
+        tracker.map_revision(name, rev, tgt_rev)
+    synced_revs.clear()
+    tracker.set_last_revision(name, last_src_tracked_rev, last_tgt_tracked_rev, position)
+
+
+def publish_metrics(name):
+    """worker processes hand their metrics to the web process through snapshot files"""
+    if config.USE_PROCESS_PER_SYNC:
+        metrics.save_snapshot(config.metrics_dir, name)
+
+
 def create_thread(args):
     return threading.Thread(target=start_revision_tracker, args=args, daemon=True)
 
 
+def run_sync_process(sync, trigger_counter, trigger_event):
+    """worker process entry point: build the trackers for one sync config and run its revision tracker"""
+    web.initialize(sync['name'], shared_counter=trigger_counter, shared_event=trigger_event)
+    trk = setup.create_tracker_setup(sync)
+    start_revision_tracker(trk.name, trk.src, trk.tgt)
+
+
+def create_process(sync, trigger):
+    return multiprocessing.Process(target=run_sync_process, args=(sync, *trigger),
+                                   name=f"sync-{sync['name']}", daemon=True)
+
+
+def supervise():
+    """restart worker processes that have died"""
+    while True:
+        sleep(config.WORKER_RESTART_DELAY)
+        for name, (process, sync, trigger) in list(workers.items()):
+            if process.is_alive():
+                continue
+
+            logger.critical(f"{name}: worker process exited with code {process.exitcode}, restarting")
+            process = create_process(sync, trigger)
+            workers[name] = (process, sync, trigger)
+            process.start()
+
+
 def run():
     setup.run()
-    # initialize trackers
-    trackers = setup.get_trackers()
-    for trk in trackers:
-        web.initialize(trk.name)
-        threads.append(create_thread([trk.name, trk.src, trk.tgt]))
+    if config.USE_PROCESS_PER_SYNC:
+        # one process per sync pair, triggers reach them through the shared counters and events
+        for sync in config.sync_configs:
+            trigger = web.initialize(sync['name'])
+            workers[sync['name']] = (create_process(sync, trigger), sync, trigger)
+        for process, _, __ in workers.values():
+            process.start()
+        threads.append(threading.Thread(target=supervise, daemon=True))
+    else:
+        # initialize trackers
+        trackers = setup.get_trackers()
+        for trk in trackers:
+            web.initialize(trk.name)
+            threads.append(create_thread([trk.name, trk.src, trk.tgt]))
     # start all worker threads
     for t in threads:
         t.start()
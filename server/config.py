@@ -10,13 +10,111 @@ COMPANY_DOMAIN = "eztaxreturn.com"
 DUMMY_SVN = False
 USE_SVN_PATCH_FORMAT = True
 USE_PATCH_TOOL_FOR_SVN = False
+# git=>svn: commit every revision as one 'svnmucc' transaction against the repository instead of patching the
+# working copy (svn:author/svn:date are fixed up afterwards where the pre-revprop-change hook allows it)
+USE_SVNMUCC_FOR_SVN = False
 
 DUMMY_GIT = False
 USE_PATCH_TOOL_FOR_GIT = False
 
+# svn=>git: write commits through a long-running 'git fast-import' instead of patching the working tree.
+# Refs and the sync position move every FAST_IMPORT_CHECKPOINT_INTERVAL commits, raise it for backfills at the cost
+# of re-syncing the revisions since the last checkpoint after an error or a crash. FAST_IMPORT_READ_WORKERS files are
+# read from svn at once.
+USE_FAST_IMPORT_FOR_GIT = False
+FAST_IMPORT_CHECKPOINT_INTERVAL = 1
+FAST_IMPORT_READ_WORKERS = 8
+
 # trigger
 USE_TRIGGERS_TO_INITIATE_SYNC = False
 
+# run every sync pair in its own worker process (restarted if it dies) instead of a thread of the web process
+USE_PROCESS_PER_SYNC = False
+WORKER_RESTART_DELAY = 10
+
+# apply revisions in-process from the parsed diff (utils.patch_apply) instead of writing a patch file for
+# 'git apply'/'svn patch'. Hunks may match with up to APPLY_FUZZ lines of their context left out, files whose hunks
+# do not apply are copied from the source by the verification. Streamed diffs (STREAM_DIFFS) keep using patch files
+USE_APPLY_ENGINE = False
+APPLY_FUZZ = 0
+
+# binary files are copied from the source command's output (e.g. 'svn cat') to the target file in chunks of
+# BLOB_CHUNK_SIZE bytes, whatever their size
+BLOB_CHUNK_SIZE = 1024 * 1024
+# files copied from a source tracker at once (binaries of a revision, files copied after a failed verification),
+# by tracker type; a tracker created with 'transfer_workers=N' uses N instead
+TRANSFER_WORKERS = {'Git': 8, 'Svn': 4}
+
+# most svn log entries cached per tracker; a target only adds to the cache (see SvnTracker.get_log_entry), it is
+# emptied when a miss finds it full
+SVN_LOG_CACHE_SIZE = 10000
+
+# number of files compared concurrently when verifying an applied revision
+VERIFY_WORKERS = 8
+
+# status checks and git staging only look at the paths a revision touches (its changelist and the files and rename
+# targets of its diff), SCOPED_STATUS_BATCH_SIZE paths per command. False (or a scoped check that finds nothing)
+# falls back to scanning the whole working tree
+SCOPED_STATUS = True
+SCOPED_STATUS_BATCH_SIZE = 500
+
+# after an error, restore only the paths of the revision that failed; the full cleanup (which walks the whole working
+# tree) only runs when locks, unfinished operations or changes remain afterwards
+SCOPED_RESTORE = True
+
+# diffs: stream 'git diff'/'svn diff' output through the converters into the patch file instead of holding
+# whole diffs in memory, reading and writing at most DIFF_STREAM_BUFFER_SIZE bytes at a time
+STREAM_DIFFS = False
+DIFF_STREAM_BUFFER_SIZE = 1024 * 1024
+
+# revisions fetched ahead (diff, metadata and binaries) while the current one is applied, 0 to disable
+PREFETCH_DEPTH = 4
+# most bytes of binary files held in memory by the prefetch at once
+PREFETCH_BLOB_BUDGET = 256 * 1024 * 1024
+
+# scheduling: an idle sync polls at an interval derived from its commit rate over the last POLL_RATE_WINDOW
+# seconds, growing by POLL_IDLE_GROWTH for every idle pass in a row, kept between POLL_INTERVAL_MIN/MAX seconds
+POLL_INTERVAL_MIN = 5
+POLL_INTERVAL_MAX = 300
+POLL_RATE_WINDOW = 60 * 60
+POLL_IDLE_GROWTH = 1.5
+
+# repeated failures back off exponentially from RETRY_BACKOFF_BASE to RETRY_BACKOFF_MAX seconds, with up to
+# RETRY_JITTER of each delay randomized so failing syncs do not retry in lockstep
+RETRY_BACKOFF_BASE = 30
+RETRY_BACKOFF_MAX = 30 * 60
+RETRY_JITTER = 0.5
+
+# tracing: write a span for every tracker method and subprocess of each revision to traces_dir/<sync>.jsonl
+TRACE_REVISIONS = False
+# profile the next N revisions of a sync with 'cprofile' or 'sampling', e.g. {'my-sync': ('cprofile', 5)},
+# the output lands in profiles_dir (also available on demand with POST /profile/<name>)
+PROFILE_REVISIONS = {}
+
+# logging: records are written by a background thread, at most LOG_QUEUE_SIZE wait for it (more are dropped and
+# counted). Messages are cut to LOG_MAX_MESSAGE_LENGTH characters and loggers in LOG_RATE_LIMITS, given as
+# {'<logger name>': (records, seconds)} and covering the loggers below them, are limited to that many records below
+# ERROR per window. Rotated logs are compressed with LOG_COMPRESSION ('gz', 'zip' or None)
+ASYNC_LOGGING = True
+LOG_QUEUE_SIZE = 10000
+LOG_MAX_MESSAGE_LENGTH = 16 * 1024
+LOG_RATE_LIMITS = {'repo': (500, 10), 'utils': (500, 10)}
+LOG_COMPRESSION = 'gz'
+
+# transient errors (lock contention) are retried after TRANSIENT_RETRY_DELAY seconds, up to TRANSIENT_RETRY_LIMIT
+# times in a row before they back off like any other failure
+TRANSIENT_RETRY_DELAY = 2
+TRANSIENT_RETRY_LIMIT = 5
+TRANSIENT_ERROR_PATTERNS = [
+    "index.lock",
+    "another git process seems to be running",
+    "is already locked",
+    "E155004",  # svn: working copy locked
+    "E155037",  # svn: previous operation has not finished
+    "E160028",  # svn: out of date, someone committed in between
+    "database is locked",
+]
+
 # app root
 app_root_dir = "c:/work/repo/git2svn-sync/" or os.getcwd().replace("\\", "/")
 
@@ -25,10 +123,32 @@ default_sync_mode = 'svn=>git'
 
 # patches
 patches_dir = f"{app_root_dir}/output/patches/"
+# applied patches are archived compressed (zstd when the 'zstandard' package is installed, else gzip) and
+# content-addressed in patch_archive_dir, indexed by sync and revision, instead of staying in patches_dir as
+# '<rev>.txt' files (read them back with 'python -m utils.patch_archive' or GET /patches/<name>/<rev>).
+# Retention, None for no limit: age in days, newest patches kept per sync, compressed bytes of the whole archive
+patch_archive_dir = f"{app_root_dir}/output/patch_archive/"
+ARCHIVE_PATCHES = True
+PATCH_RETENTION_DAYS = 365
+PATCH_RETENTION_COUNT = None
+PATCH_RETENTION_BYTES = 10 * 1024 ** 3
 
 # tracker history
 tracker_dir = f"{app_root_dir}/output/history/"
 
+# metrics snapshots of sync worker processes, merged into /metrics by the web process
+metrics_dir = f"{app_root_dir}/output/metrics/"
+
+# per-revision traces and profiles
+traces_dir = f"{app_root_dir}/output/traces/"
+profiles_dir = f"{app_root_dir}/output/profiles/"
+
+# sync state (checkpoints, pending queues, revision status), writes are group-committed every
+# STATE_GROUP_COMMIT_SIZE writes or STATE_GROUP_COMMIT_DELAY seconds, checkpoints are committed and synced right away
+STATE_DB = f"{tracker_dir}sync_state.db"
+STATE_GROUP_COMMIT_SIZE = 64
+STATE_GROUP_COMMIT_DELAY = 1.0
+
 # git settings
 git_pull_timeout = 60000
 
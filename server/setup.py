@@ -1,4 +1,4 @@
-from typing import List, NamedTuple
+from typing import List, NamedTuple, Optional
 
 from server import config
 
@@ -6,7 +6,9 @@ from utils import file_utils
 
 from repo.git_tracker import TrackerBase
 from repo.git_tracker import GitTracker
+from repo.git_fast_import_tracker import GitFastImportTracker
 from repo.svn_tracker import SvnTracker
+from repo.svn_mucc_tracker import SvnMuccTracker
 
 from utils.logger import get_logger
 
@@ -25,23 +27,35 @@ def get_trackers(**kwargs) -> List[TrackerSetup]:
     trackers: List[TrackerSetup] = []
     # use sync configs to create svn/git watchers
     for sync in config.sync_configs:
-        sync_name = sync['name']
-        if file_utils.is_git_to_svn_mode(sync['mode']):
-            src = GitTracker(sync_name, sync['source_url'], sync['source_branch'], **kwargs)
-            tgt = SvnTracker(sync_name, sync['target_url'], sync['target_branch'], **kwargs)
-            trackers.append(TrackerSetup(sync_name, sync['mode'], src, tgt))
-
-        elif file_utils.is_svn_to_git_mode(sync['mode']):
-            src = SvnTracker(sync_name, sync['source_url'], sync['source_branch'], **kwargs)
-            tgt = GitTracker(sync_name, sync['target_url'], sync['target_branch'], **kwargs)
-            trackers.append(TrackerSetup(sync_name, sync['mode'], src, tgt))
+        trk = create_tracker_setup(sync, **kwargs)
+        if trk:
+            trackers.append(trk)
 
     return trackers
 
 
+def create_tracker_setup(sync, **kwargs) -> Optional[TrackerSetup]:
+    """create the svn/git watchers for a single sync config"""
+    sync_name = sync['name']
+    if file_utils.is_git_to_svn_mode(sync['mode']):
+        src = GitTracker(sync_name, sync['source_url'], sync['source_branch'], **kwargs)
+        svn_tracker = SvnMuccTracker if config.USE_SVNMUCC_FOR_SVN else SvnTracker
+        tgt = svn_tracker(sync_name, sync['target_url'], sync['target_branch'], **kwargs)
+        return TrackerSetup(sync_name, sync['mode'], src, tgt)
+
+    elif file_utils.is_svn_to_git_mode(sync['mode']):
+        src = SvnTracker(sync_name, sync['source_url'], sync['source_branch'], **kwargs)
+        git_tracker = GitFastImportTracker if config.USE_FAST_IMPORT_FOR_GIT else GitTracker
+        tgt = git_tracker(sync_name, sync['target_url'], sync['target_branch'], **kwargs)
+        return TrackerSetup(sync_name, sync['mode'], src, tgt)
+
+    return None
+
+
 def setup_folders():
     logger.info("Creating patch directories")
-    folders = [config.patches_dir, config.tracker_dir]
+    folders = [config.patches_dir, config.patch_archive_dir, config.tracker_dir, config.metrics_dir,
+               config.traces_dir, config.profiles_dir]
 
     for fol in folders:
         logger.info(f"Creating folder: {fol}")
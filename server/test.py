@@ -24,8 +24,6 @@ def setup_folders():
 
 
 def test_diffs(svn: SvnTracker, git: GitTracker):
-    from utils import diff_tools
-
     logger.info("Running tests")
     # svn2 = SvnTracker(svn.name, "C:\svnrepo-test", "test")
     #
@@ -53,9 +51,10 @@ def test_diffs(svn: SvnTracker, git: GitTracker):
     # Test revision diff for git->svn
     rev = "d19be7a46d5b9742105ef59dcbe834fd1ed4c288"
     date, msg, author, diff, files = git.get_diff(rev)
-    path, fdiff = svn.format_and_save(rev, diff)
-    renames = diff_tools.git_get_rename_files(diff)
-    print(fdiff)
+    path, model = svn.format_and_save(rev, diff)
+    renames = model.rename_files()
+    with open(path, "r", encoding="utf-8-sig") as patch_file:
+        print(patch_file.read())
     print(f"files are: {', '.join(map(lambda x: x['to'], renames))}")
 
 
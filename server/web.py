@@ -1,25 +1,45 @@
-import threading
-from flask import Flask
+import multiprocessing
+from flask import Flask, Response, request
 
+from server import config
+from utils import tracker, metrics, tracing, patch_archive
 from utils.logger import get_logger
 
-_lock = threading.Lock()
 app = Flask("git2svn-sync")
 logger = get_logger(__name__)
 
+# trigger counters and wakeup events are process-shared so sync workers running in their own process see them too
 trigger_counters = {}
+trigger_events = {}
 
 
 def has_trigger_for(name):
     return lambda *args, **kwargs: get_trigger_counter(name).get('counter') > 0
 
 
+def wait_for_trigger(name, timeout=None):
+    """Block until a trigger for 'name' arrives (or timeout seconds pass), True if one did"""
+    return trigger_events[name].wait(timeout)
+
+
 def run():
     app.run(host="0.0.0.0", port=5001)
 
 
-def initialize(trigger_name, counter=0):
-    trigger_counters[trigger_name] = counter
+def initialize(trigger_name, counter=0, shared_counter=None, shared_event=None):
+    """
+    Register the trigger counter and wakeup event for a sync
+
+    :param shared_counter: an existing counter (multiprocessing.Value) to use, e.g. one created by the supervisor
+    :param shared_event: an existing wakeup event (multiprocessing.Event) to use
+    :return: the shared counter and event, to hand to a worker process
+    """
+    trigger_counters[trigger_name] = shared_counter if shared_counter is not None \
+        else multiprocessing.Value('i', counter)
+    trigger_events[trigger_name] = shared_event if shared_event is not None else multiprocessing.Event()
+    if counter > 0:
+        trigger_events[trigger_name].set()
+    return trigger_counters[trigger_name], trigger_events[trigger_name]
 
 
 @app.route("/")
@@ -27,15 +47,22 @@ def home():
     return "Git <=> SVN Sync Home"
 
 
+@app.route("/metrics")
+def get_metrics():
+    snapshots_dir = config.metrics_dir if config.USE_PROCESS_PER_SYNC else None
+    return Response(metrics.render(snapshots_dir), mimetype="text/plain; version=0.0.4")
+
+
 @app.route("/trigger/<name>", methods=['POST'])
 def trigger(name):
     logger.info(f"Received trigger for '{name}'")
     if trigger_counters.__contains__(name):
-        with _lock:
-            count = trigger_counters[name]
-            logger.info(f"Current counter for '{name}' = {count}")
-            trigger_counters[name] = count + 1
-            logger.debug(f"Incremented counted to {trigger_counters[name]}")
+        counter = trigger_counters[name]
+        with counter.get_lock():
+            logger.info(f"Current counter for '{name}' = {counter.value}")
+            counter.value += 1
+            trigger_events[name].set()
+            logger.debug(f"Incremented counted to {counter.value}")
             return {'status': 'success'}
     return {'status': 'error', 'message': f'{name} not found'}
 
@@ -44,8 +71,9 @@ def trigger(name):
 def get_trigger_counter(name):
     logger.debug("Retrieving trigger counter")
     if trigger_counters.__contains__(name):
-        with _lock:
-            return {'name': name, 'counter': trigger_counters[name]}
+        counter = trigger_counters[name]
+        with counter.get_lock():
+            return {'name': name, 'counter': counter.value}
     return {'name': name, 'counter': 0}
 
 
@@ -53,8 +81,67 @@ def get_trigger_counter(name):
 def clear_trigger_counter(name):
     logger.debug("Clearing trigger counter")
     if trigger_counters.__contains__(name):
-        with _lock:
-            count = trigger_counters[name]
-            trigger_counters[name] = 0
+        counter = trigger_counters[name]
+        with counter.get_lock():
+            count = counter.value
+            counter.value = 0
+            trigger_events[name].clear()
             logger.info(f"Cleared trigger counter, was {count}")
-    return {'name': name, 'counter': trigger_counters.get(name)}
+            return {'name': name, 'counter': counter.value}
+    return {'name': name, 'counter': None}
+
+
+@app.route("/map/<name>/<rev>", methods=['GET'])
+def get_revision_mapping(name, rev):
+    """source <=> target revision lookup, 'rev' may be either side (git hashes may be abbreviated)"""
+    mappings = tracker.lookup_revision(name, rev)
+    if not mappings:
+        return {'status': 'error', 'message': f"'{rev}' is not mapped for {name}"}, 404
+    if len(mappings) > 1:
+        return {'status': 'error', 'message': f"'{rev}' is ambiguous for {name}"}, 409
+
+    src_rev, target_rev = mappings[0]
+    return {'name': name, 'source': src_rev, 'target': target_rev}
+
+
+@app.route("/map/<name>", methods=['POST'])
+def get_revision_mappings(name):
+    """bulk lookup: a JSON list of revisions, answered with {rev: {'source', 'target'} or None}"""
+    result = {}
+    for rev in request.get_json(force=True) or []:
+        mappings = tracker.lookup_revision(name, rev)
+        result[str(rev)] = {'source': mappings[0][0], 'target': mappings[0][1]} if len(mappings) == 1 else None
+    return {'name': name, 'revisions': result}
+
+
+@app.route("/profile/<name>", methods=['POST'])
+def profile_revisions(name):
+    """profile the next 'revisions' revisions of a sync with 'mode' (cprofile or sampling), from the query or JSON"""
+    params = {**request.args, **(request.get_json(silent=True) or {})}
+    try:
+        tracing.ProfileRequests(config.profiles_dir).request(name, int(params.get('revisions', 1)),
+                                                             params.get('mode', "cprofile"))
+    except ValueError as e:
+        return {'status': 'error', 'message': str(e)}, 400
+    return {'status': 'success', 'name': name, 'profiles': config.profiles_dir}
+
+
+@app.route("/patches/<name>", methods=['GET'])
+def list_patches(name):
+    """the archived patches of a sync, oldest first"""
+    return {'name': name, 'patches': [patch._asdict() for patch in archive().list(name)]}
+
+
+@app.route("/patches/<name>/<rev>", methods=['GET'])
+def get_patch(name, rev):
+    """the archived patch of a revision, as it was applied"""
+    contents = archive().read(name, rev)
+    if contents is None:
+        return {'status': 'error', 'message': f"No patch archived for {name}@{rev}"}, 404
+    return Response(contents, mimetype="text/plain; charset=utf-8")
+
+
+def archive():
+    return patch_archive.get_archive(config.patch_archive_dir, retention_days=config.PATCH_RETENTION_DAYS,
+                                     retention_count=config.PATCH_RETENTION_COUNT,
+                                     retention_bytes=config.PATCH_RETENTION_BYTES)
@@ -0,0 +1,109 @@
+import subprocess
+
+import pytest
+
+from utils.git_fast_import import FastImportStream, FileChange, EXECUTABLE_MODE
+
+IDENT = "Sync Test <sync@example.com> 1700000000 +0000"
+
+
+@pytest.fixture
+def bare_repo(tmp_path):
+    path = tmp_path / "target.git"
+    subprocess.run(["git", "init", "--quiet", "--bare", str(path)], check=True)
+    return path
+
+
+def git(repo, *args):
+    return subprocess.run(["git", *args], cwd=repo, check=True, capture_output=True, text=True).stdout
+
+
+@pytest.mark.parametrize("interval", [1, 2, 5])
+def test_commits_chain_across_checkpoints(bare_repo, interval):
+    stream = FastImportStream(bare_repo, checkpoint_interval=interval)
+    head = None
+    heads = []
+    try:
+        for i in range(7):
+            changes = [FileChange(f"file{i}.txt", f"revision {i}\n".encode()),
+                       FileChange("run.sh", f"echo {i}\n".encode(), EXECUTABLE_MODE)]
+            if i:
+                changes.append(FileChange(f"file{i - 1}.txt", None))
+            head = stream.commit("refs/heads/main", head, IDENT, IDENT, f"revision {i}", changes)
+            heads.append(head)
+        stream.flush()
+    finally:
+        stream.close()
+
+    assert git(bare_repo, "rev-list", "refs/heads/main").split() == heads[::-1]
+    assert git(bare_repo, "ls-tree", "--name-only", "refs/heads/main").split() == ["file6.txt", "run.sh"]
+    assert git(bare_repo, "show", "refs/heads/main:run.sh") == "echo 6\n"
+
+
+def test_continues_from_checkpointed_branch(bare_repo):
+    first = FastImportStream(bare_repo, checkpoint_interval=3)
+    try:
+        head = first.commit("refs/heads/main", None, IDENT, IDENT, "root", [FileChange("a.txt", b"a\n")])
+    finally:
+        first.close()
+
+    # a new process only knows the parent by its hash
+    second = FastImportStream(bare_repo, checkpoint_interval=3)
+    try:
+        head = second.commit("refs/heads/main", head, IDENT, IDENT, "child", [FileChange("b.txt", b"b\n")])
+        head = second.commit("refs/heads/main", head, IDENT, IDENT, "grandchild", [FileChange("a.txt", None)])
+        second.flush()
+    finally:
+        second.close()
+
+    assert git(bare_repo, "log", "--format=%s", "refs/heads/main").split() == ["grandchild", "child", "root"]
+    assert git(bare_repo, "ls-tree", "--name-only", "refs/heads/main").split() == ["b.txt"]
+
+
+class FakeSource:
+    """an svn source whose binary files were read ahead by the prefetcher"""
+
+    def __init__(self, files, prefetched):
+        self.files = files
+        self.prefetched = prefetched
+        self.cat_files = []
+
+    def get_changed_files(self, rev):
+        return [], sorted(self.files)
+
+    def get_file_properties(self, rev, files):
+        return {}
+
+    def take_prefetched(self, rev, file):
+        return self.prefetched.pop((rev, file), None)
+
+    def cat_file(self, rev, file):
+        self.cat_files.append(file)
+        return self.files[file]
+
+
+def test_tracker_commits_prefetched_files(bare_repo, monkeypatch):
+    from repo.git_fast_import_tracker import GitFastImportTracker
+
+    monkeypatch.setenv("GIT_COMMITTER_NAME", "Sync Test")
+    monkeypatch.setenv("GIT_COMMITTER_EMAIL", "sync@example.com")
+
+    stream = FastImportStream(bare_repo)
+    try:
+        stream.commit("refs/heads/main", None, IDENT, IDENT, "root", [FileChange("a.txt", b"a\n")])
+    finally:
+        stream.close()
+
+    tracker = GitFastImportTracker("fast-import", str(bare_repo), "main")
+    source = FakeSource({"a.txt": b"b\n", "image.png": b"\x89PNG"}, {("7", "image.png"): bytearray(b"\x89PNG")})
+    try:
+        _, head = tracker.commit(1700000000, "message", "someone", "7", None, src=source)
+        tracker.stream.flush()
+        assert tracker.get_file(head, "image.png", is_binary=True) == b"\x89PNG"
+    finally:
+        tracker.stream.close()
+        tracker.blob_readers.close()
+
+    assert source.cat_files == ["a.txt"]
+    assert git(bare_repo, "rev-parse", "refs/heads/main").strip() == head
+    assert git(bare_repo, "show", "refs/heads/main:a.txt") == "b\n"
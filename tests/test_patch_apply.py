@@ -0,0 +1,212 @@
+import os
+import random
+import subprocess
+
+import pytest
+
+from utils.diff_tools import parse_diff
+from utils.patch_apply import Hunk, apply_diff, patch_lines
+
+GIT_ENV = dict(os.environ, GIT_AUTHOR_NAME="Sync Test", GIT_AUTHOR_EMAIL="sync@example.com",
+               GIT_COMMITTER_NAME="Sync Test", GIT_COMMITTER_EMAIL="sync@example.com")
+
+
+def hunk(old_start, *lines):
+    """Hunk from ' context', '-removed', '+added' strings, '\\r' at the end for CRLF, '$' for no newline at EOF"""
+    parsed = []
+    for line in lines:
+        tag, text = line[0], line[1:]
+        eol = None if text.endswith("$") else "\r\n" if text.endswith("\r") else "\n"
+        parsed.append((tag, text.rstrip("$\r"), eol))
+    return Hunk(f"@@ -{old_start} @@", old_start, parsed)
+
+
+def numbered(count, eol="\n"):
+    return [f"line {i}{eol}" for i in range(1, count + 1)]
+
+
+def test_hunk_at_its_position():
+    patched, rejected = patch_lines(numbered(5), [hunk(2, " line 2", "-line 3", "+three", " line 4")])
+    assert rejected == []
+    assert patched == ["line 1\n", "line 2\n", "three\n", "line 4\n", "line 5\n"]
+
+
+def test_hunk_found_at_an_offset_moves_the_following_hunks():
+    lines = ["new a\n", "new b\n"] + numbered(20)
+    hunks = [hunk(3, " line 3", "-line 4", "+four", " line 5"), hunk(15, " line 15", "-line 16", " line 17")]
+    patched, rejected = patch_lines(lines, hunks)
+    assert rejected == []
+    assert patched[5] == "four\n"
+    assert "line 16\n" not in patched and len(patched) == 21
+
+
+def test_fuzz_leaves_out_context_that_does_not_match():
+    lines = numbered(6)
+    changed = hunk(2, " changed context", "-line 3", "+three", " line 4")
+    assert patch_lines(lines, [changed])[1] == [changed.header]
+
+    patched, rejected = patch_lines(lines, [changed], fuzz=1)
+    assert rejected == []
+    assert patched == ["line 1\n", "line 2\n", "three\n", "line 4\n", "line 5\n", "line 6\n"]
+
+
+def test_rejected_hunk_leaves_lines_alone():
+    lines = numbered(4)
+    patched, rejected = patch_lines(lines, [hunk(2, "-not in the file", "+x")])
+    assert rejected == ["@@ -2 @@"] and patched == lines
+
+
+def test_ignore_whitespace_matches_reindented_lines():
+    lines = ["def f():\n", "\treturn  1\n"]
+    changed = hunk(1, " def f():", "-    return 1", "+    return 2")
+    assert patch_lines(lines, [changed])[1] == [changed.header]
+    assert patch_lines(lines, [changed], ignore_whitespace=True) == (["def f():\n", "    return 2\n"], [])
+
+
+def test_no_newline_at_end_of_file():
+    patched, _ = patch_lines(["a\n", "b"], [hunk(1, " a", "-b$", "+b", "+c$")])
+    assert patched == ["a\n", "b\n", "c"]
+
+    patched, _ = patch_lines(["a\n", "b\n"], [hunk(1, " a", "-b", "+b$")])
+    assert patched == ["a\n", "b"]
+
+
+def test_added_lines_keep_their_own_endings():
+    lines = ["crlf\r\n", "lf\n", "end\r\n"]
+    patched, _ = patch_lines(lines, [hunk(2, "-lf", "+new lf", "+new crlf\r", " end\r")])
+    assert patched == ["crlf\r\n", "new lf\n", "new crlf\r\n", "end\r\n"]
+
+
+def test_endings_lost_in_the_diff_follow_the_file():
+    patched, _ = patch_lines(["a\r\n", "b\r\n"], [hunk(1, " a", "-b", "+c")], cr_stripped=True)
+    assert patched == ["a\r\n", "c\r\n"]
+
+
+def write(root, path, contents):
+    full_path = os.path.join(root, path)
+    os.makedirs(os.path.dirname(full_path), exist_ok=True)
+    with open(full_path, "wb") as file_to_write:
+        file_to_write.write(contents)
+
+
+def read(root, path):
+    with open(os.path.join(root, path), "rb") as file_to_read:
+        return file_to_read.read()
+
+
+def test_apply_diff_new_deleted_renamed_and_binary(tmp_path):
+    write(tmp_path, "old.txt", b"1\n2\n3\n")
+    write(tmp_path, "gone.txt", b"bye\n")
+    diff = "\n".join([
+        "diff --git old.txt dir/new.txt", "similarity index 80%", "rename from old.txt", "rename to dir/new.txt",
+        "--- old.txt", "+++ dir/new.txt", "@@ -1,3 +1,3 @@", " 1", "-2", "+two", " 3",
+        "diff --git gone.txt gone.txt", "deleted file mode 100644", "--- gone.txt", "+++ /dev/null",
+        "@@ -1 +0,0 @@", "-bye",
+        "diff --git run.sh run.sh", "new file mode 100755", "--- /dev/null", "+++ run.sh", "@@ -0,0 +1 @@",
+        "+echo hi",
+        "diff --git logo.png logo.png", "new file mode 100644", "Binary files /dev/null and logo.png differ", ""])
+
+    result = apply_diff(parse_diff(diff), str(tmp_path))
+
+    assert result.rejected == {}
+    assert read(tmp_path, "dir/new.txt") == b"1\ntwo\n3\n" and not os.path.exists(tmp_path / "old.txt")
+    assert result.renamed == [("old.txt", "dir/new.txt")]
+    assert result.deleted == ["gone.txt"] and not os.path.exists(tmp_path / "gone.txt")
+    assert result.created == ["run.sh"] and read(tmp_path, "run.sh") == b"echo hi\n"
+    assert result.modes == {"run.sh": "100755"}
+    if os.name == "posix":
+        assert os.stat(tmp_path / "run.sh").st_mode & 0o100
+    assert result.skipped == ["logo.png"]
+    assert set(result.digests) == {"dir/new.txt", "run.sh"}
+
+
+def test_apply_diff_rejects_paths_outside_the_tree(tmp_path):
+    root = tmp_path / "root"
+    root.mkdir()
+    diff = "\n".join(["diff --git ../escape.txt ../escape.txt", "new file mode 100644", "--- /dev/null",
+                      "+++ ../escape.txt", "@@ -0,0 +1 @@", "+x", ""])
+
+    result = apply_diff(parse_diff(diff), str(root))
+
+    assert "../escape.txt" in result.rejected
+    assert not os.path.exists(tmp_path / "escape.txt")
+
+
+def test_apply_diff_leaves_a_file_with_rejected_hunks_untouched(tmp_path):
+    write(tmp_path, "a.txt", b"1\n2\n3\n")
+    diff = "\n".join(["diff --git a.txt a.txt", "--- a.txt", "+++ a.txt", "@@ -1,2 +1,2 @@", " 1", "-2", "+two",
+                      "@@ -3 +3 @@", "-not there", "+x", ""])
+
+    result = apply_diff(parse_diff(diff), str(tmp_path))
+
+    assert result.rejected == {"a.txt": ["@@ -3 +3 @@"]}
+    assert read(tmp_path, "a.txt") == b"1\n2\n3\n"
+
+
+def random_text(rng):
+    """text lines from a small vocabulary (so hunks find repeated context), with LF, CRLF or mixed endings"""
+    endings = rng.choice([["\n"], ["\r\n"], ["\n", "\r\n"]])
+    lines = [f"{rng.choice(['alpha', 'beta', 'gamma', 'delta'])} {rng.randint(0, 5)}{rng.choice(endings)}"
+             for _ in range(rng.randint(0, 60))]
+    if lines and rng.random() < 0.2:
+        lines[-1] = lines[-1].rstrip("\r\n")
+    return lines, endings
+
+
+def edit(rng, lines, endings):
+    lines = list(lines)
+    for _ in range(rng.randint(1, 6)):
+        at = rng.randint(0, len(lines))
+        removed = rng.randint(0, min(3, len(lines) - at))
+        added = [f"edit {rng.randint(0, 999)}{rng.choice(endings)}" for _ in range(rng.randint(0, 3))]
+        lines[at:at + removed] = added
+    if lines and rng.random() < 0.1:
+        lines[-1] = lines[-1].rstrip("\r\n")
+    return lines
+
+
+def git(repo, *args):
+    return subprocess.run(["git", *args], cwd=repo, env=GIT_ENV, check=True, capture_output=True).stdout
+
+
+@pytest.mark.parametrize("seed", range(40))
+def test_matches_git_on_generated_revisions(tmp_path, seed):
+    rng = random.Random(seed)
+    repo = tmp_path / "repo"
+    repo.mkdir()
+    git(repo, "init", "--quiet")
+    git(repo, "config", "core.autocrlf", "false")
+
+    files = {}
+    for i in range(rng.randint(1, 6)):
+        lines, endings = random_text(rng)
+        files[f"src/file{i}.txt"] = (lines, endings)
+        write(repo, f"src/file{i}.txt", "".join(lines).encode())
+    git(repo, "add", "-A")
+    git(repo, "commit", "--quiet", "--allow-empty", "-m", "before")
+    before = tmp_path / "before"
+    git(repo, "worktree", "add", "--quiet", "--detach", str(before), "HEAD")
+
+    for path, (lines, endings) in files.items():
+        action = rng.random()
+        if action < 0.1:
+            os.remove(repo / path)
+        elif action < 0.2:
+            os.rename(repo / path, repo / f"{path}.moved")
+            write(repo, f"{path}.moved", "".join(edit(rng, lines, endings) if rng.random() < 0.5 else lines).encode())
+        else:
+            write(repo, path, "".join(edit(rng, lines, endings)).encode())
+    if rng.random() < 0.3:
+        write(repo, "src/added.txt", "".join(random_text(rng)[0]).encode())
+    git(repo, "add", "-A")
+    git(repo, "commit", "--quiet", "--allow-empty", "-m", "after")
+
+    diff = git(repo, "diff", "--no-prefix", "--binary", "-M", "HEAD~1", "HEAD").decode("utf-8", "surrogateescape")
+    result = apply_diff(parse_diff(diff), str(before))
+
+    assert result.rejected == {}
+    for path in git(repo, "ls-files").decode().split():
+        assert read(before, path) == read(repo, path), path
+    for path in files:
+        if not os.path.exists(repo / path):
+            assert not os.path.exists(before / path)
@@ -0,0 +1,104 @@
+import os
+
+import pytest
+
+from utils import patch_archive
+from utils.patch_archive import PatchArchive
+
+DAY = 24 * 60 * 60
+
+
+@pytest.fixture
+def archive(tmp_path):
+    # retention is set by each test once its patches are in, so that put() does not prune them on the way
+    archive = PatchArchive(str(tmp_path / "archive"), prune_interval=float("inf"))
+    yield archive
+    archive._connection.close()
+
+
+def stored_objects(archive):
+    return sorted(name for _, __, names in os.walk(os.path.join(archive.directory, "objects")) for name in names)
+
+
+def test_size_retention_counts_shared_objects_once(archive):
+    shared = archive.put("sync", "1", "shared patch\n" * 100, created=1)
+    archive.put("other", "7", "shared patch\n" * 100, created=2)
+    archive.put("sync", "2", "newer patch\n" * 10, created=3)
+    sizes = {patch.digest: patch.stored_size for patch in archive.list()}
+
+    # both revisions of the shared patch fit as a single object
+    archive.retention_bytes = sum(sizes.values())
+    assert archive.prune() == 0
+
+    # dropping only the oldest reference frees nothing, so the other one goes too, and then the object
+    archive.retention_bytes = sum(sizes.values()) - 1
+    assert archive.prune() == 2
+    assert [(patch.name, patch.rev) for patch in archive.list()] == [("sync", "2")]
+    assert not any(name.startswith(shared) for name in stored_objects(archive))
+    assert len(stored_objects(archive)) == 1
+
+
+def test_count_retention_is_per_sync(archive):
+    for rev in range(1, 5):
+        archive.put("busy", str(rev), f"patch {rev}\n", created=rev)
+    archive.put("quiet", "1", "patch 1\n", created=1)
+
+    archive.retention_count = 2
+    assert archive.prune() == 2
+
+    assert [(patch.name, patch.rev) for patch in archive.list()] == [("quiet", "1"), ("busy", "3"), ("busy", "4")]
+    # "busy" revision 1 shared its object with "quiet", which still refers to it
+    assert archive.read("quiet", "1") == b"patch 1\n" and archive.read("busy", "1") is None
+    assert len(stored_objects(archive)) == 3
+
+
+def test_days_retention(archive):
+    now = 1000 * DAY
+    archive.put("sync", "1", "old\n", created=now - 10 * DAY)
+    archive.put("sync", "2", "recent\n", created=now - DAY)
+
+    archive.retention_days = 7
+    assert archive.prune(now) == 1
+    assert [patch.rev for patch in archive.list("sync")] == ["2"]
+
+
+def test_gzip_objects_read_back(archive, tmp_path, monkeypatch):
+    monkeypatch.setattr(patch_archive, "zstandard", None)
+    patch_path = tmp_path / "3.txt"
+    patch_path.write_bytes(b"binary \x00\xff patch\n" * 1000)
+
+    archive.put("sync", "1", "café patch\n")
+    archive.put_file("sync", "3", str(patch_path))
+
+    assert all(name.endswith(".gz") for name in stored_objects(archive))
+    assert archive.read("sync", "1") == "café patch\n".encode()
+    assert archive.read("sync", "3") == patch_path.read_bytes()
+    assert archive.read("sync", "2") is None
+
+
+def test_zstd_objects_read_back(archive, monkeypatch):
+    pytest.importorskip("zstandard")
+    archive.put("sync", "1", "zstd patch\n" * 1000)
+
+    # an archive written with gzip before zstandard was installed stays readable
+    monkeypatch.setattr(patch_archive, "zstandard", None)
+    archive.put("sync", "2", "gzip patch\n")
+    monkeypatch.undo()
+
+    assert sorted(name.rsplit(".", 1)[1] for name in stored_objects(archive)) == ["gz", "zst"]
+    assert archive.read("sync", "1") == b"zstd patch\n" * 1000
+    assert archive.read("sync", "2") == b"gzip patch\n"
+
+
+def test_import_leaves_the_live_patch_alone(tmp_path):
+    patches = tmp_path / "patches"
+    patches.mkdir()
+    for name in ("41.txt", "42.txt", "current.txt"):
+        (patches / name).write_text(f"{name}\n")
+
+    assert patch_archive.main(["--archive", str(tmp_path / "archive"), "import", "sync", str(patches)]) == 0
+
+    assert [path.name for path in patches.iterdir()] == ["current.txt"]
+    archive = PatchArchive(str(tmp_path / "archive"))
+    assert sorted(patch.rev for patch in archive.list("sync")) == ["41", "42"]
+    assert archive.read("sync", "42") == b"42.txt\n"
@@ -0,0 +1,55 @@
+import json
+from concurrent.futures import ThreadPoolExecutor
+
+from repo.tracker_base import in_caller_context
+from utils import metrics, tracing
+
+
+def test_pool_threads_keep_sync_usage_and_trace(tmp_path):
+    def work(i):
+        with tracing.subprocess_span(["svn", "cat", str(i)]):
+            metrics.record_subprocess("svn", 10)
+        return metrics.current_sync()
+
+    metrics.set_current_sync("pool-sync")
+    try:
+        with metrics.track_revision(metrics.RevisionUsage()) as usage, \
+                tracing.revision_trace(f"{tmp_path}/", "pool-sync", "42"):
+            with ThreadPoolExecutor(max_workers=4) as pool:
+                syncs = list(pool.map(in_caller_context(work), range(20)))
+    finally:
+        metrics.set_current_sync("")
+
+    assert syncs == ["pool-sync"] * 20
+    assert (usage.subprocesses, usage.bytes) == (20, 200)
+
+    spans = [json.loads(line) for line in (tmp_path / "pool-sync.jsonl").read_text().splitlines()]
+    revision = next(span for span in spans if span['kind'] == "revision")
+    subprocesses = [span for span in spans if span['kind'] == "subprocess"]
+    assert len(subprocesses) == 20
+    assert all(span['parent'] == revision['id'] and span['rev'] == "42" for span in subprocesses)
+
+
+def test_concurrent_copies_count_towards_the_revision():
+    from repo.tracker_base import TrackerBase, TransferError
+
+    class Source:
+        type = "Fake"
+        transfer_workers = 4
+
+    def copy(file):
+        metrics.record_subprocess("git", len(file))
+        if file.startswith("bad"):
+            raise OSError(f"cannot read {file}")
+
+    files = [f"file{i}" for i in range(10)] + ["bad1", "bad2"]
+    with metrics.track_revision(metrics.RevisionUsage()) as usage:
+        try:
+            TrackerBase.copy_concurrently("7", Source(), files, copy)
+        except TransferError as e:
+            errors = e.errors
+        else:
+            errors = {}
+
+    assert sorted(errors) == ["bad1", "bad2"]
+    assert usage.subprocesses == 12
@@ -0,0 +1,34 @@
+import os
+import subprocess
+
+from repo.git_tracker import GitTracker
+
+GIT_ENV = dict(os.environ, GIT_AUTHOR_NAME="Sync Test", GIT_AUTHOR_EMAIL="sync@example.com",
+               GIT_COMMITTER_NAME="Sync Test", GIT_COMMITTER_EMAIL="sync@example.com")
+
+
+def test_files_larger_than_the_budget_are_streamed_later(tmp_path):
+    repo = tmp_path / "repo"
+    repo.mkdir()
+    subprocess.run(["git", "init", "--quiet"], cwd=repo, check=True)
+    (repo / "small.png").write_bytes(b"s" * 100)
+    (repo / "large.bin").write_bytes(b"l" * 10000)
+    (repo / "other.png").write_bytes(b"o" * 200)
+    subprocess.run(["git", "add", "-A"], cwd=repo, check=True)
+    subprocess.run(["git", "commit", "--quiet", "-m", "binaries"], cwd=repo, env=GIT_ENV, check=True)
+
+    src = GitTracker("prefetch", str(repo), "master", is_test=True)
+    try:
+        files = ["small.png", "large.bin", "missing.png", "other.png"]
+        assert src.get_file_sizes("HEAD", files) == {"small.png": 100, "large.bin": 10000, "other.png": 200}
+
+        src.prefetch_files("HEAD", files, max_bytes=1000)
+        assert src.take_prefetched("HEAD", "large.bin") is None
+        assert src.take_prefetched("HEAD", "missing.png") is None
+        assert src.take_prefetched("HEAD", "small.png") == b"s" * 100
+
+        src.transfer_file("HEAD", "large.bin", str(tmp_path / "large.bin"))
+        assert (tmp_path / "large.bin").read_bytes() == b"l" * 10000
+    finally:
+        src.blob_readers.close()
+        src.objects.close()
@@ -0,0 +1,38 @@
+from utils.tracing import ProfileRequests
+
+
+def test_takes_the_requested_number_of_revisions(tmp_path):
+    requests = ProfileRequests(f"{tmp_path}/")
+    requests.request("sync", 2, "sampling")
+
+    assert requests.get("sync") == {'revisions': 2, 'mode': "sampling"}
+    assert [requests.take("sync") for _ in range(3)] == ["sampling", "sampling", None]
+    assert requests.get("sync") is None and list(tmp_path.iterdir()) == []
+
+
+def test_request_from_another_instance_replaces_the_one_being_taken(tmp_path):
+    worker, web = ProfileRequests(f"{tmp_path}/"), ProfileRequests(f"{tmp_path}/")
+    worker.request("sync", 5)
+    assert worker.take("sync") == "cprofile"
+
+    # the web process asks again while the worker is part way through its request
+    web.request("sync", 1, "sampling")
+    web.request("sync.other", 3)
+
+    assert [worker.take("sync") for _ in range(2)] == ["sampling", None]
+    assert worker.take("sync.other") == "cprofile"
+
+
+def test_request_made_while_a_take_writes_back_is_kept(tmp_path):
+    worker, web = ProfileRequests(f"{tmp_path}/"), ProfileRequests(f"{tmp_path}/")
+    worker.request("sync", 5)
+
+    def write_after_request(path, pending):
+        web.request("sync", 1, "sampling")
+        ProfileRequests._write(path, pending)
+
+    worker._write = write_after_request
+    assert worker.take("sync") == "cprofile"
+    del worker._write
+
+    assert [worker.take("sync") for _ in range(2)] == ["sampling", None]
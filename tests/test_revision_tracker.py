@@ -0,0 +1,113 @@
+import subprocess
+
+import pytest
+
+from repo.tracker_base import TrackerBase
+from utils.git_fast_import import FastImportStream, FileChange
+
+IDENT = "Sync Test <sync@example.com> 1700000000 +0000"
+
+
+class StopSync(BaseException):
+    """ends the revision tracker loop, which only catches Exception"""
+
+
+class FakeSvnSource(TrackerBase):
+    """an svn source adding one file per revision, failing to read the file of 'fail_once' the first time"""
+
+    def __init__(self, revs, fail_once):
+        super().__init__("fake-svn", "Svn", "/nonexistent")
+        self.revs = revs
+        self.fail_once = fail_once
+
+    def get_last_commit(self, with_pull=False):
+        return self.get_log_entry(self.revs[-1])
+
+    @staticmethod
+    def get_log_entry(rev):
+        return type("LogEntry", (), {'revision': rev, 'message': f"revision {rev}"})
+
+    def get_revisions_since(self, rev):
+        return [r for r in self.revs if int(r) > int(rev)]
+
+    def get_diff(self, rev):
+        diff = "\n".join([f"diff --git file{rev}.txt file{rev}.txt", "new file mode 100644", "--- /dev/null",
+                          f"+++ file{rev}.txt", "@@ -0,0 +1 @@", f"+r{rev}", ""])
+        return 1700000000 + int(rev), f"revision {rev}", "someone", diff, [f"file{rev}.txt"]
+
+    def get_changed_files(self, rev):
+        return [], [f"file{rev}.txt"]
+
+    def get_file_properties(self, rev, files):
+        return {}
+
+    def cat_file(self, rev, file):
+        if rev in self.fail_once:
+            self.fail_once.remove(rev)
+            raise IOError(f"svn: E170013: Unable to connect while reading {file}@{rev}")
+        return f"r{rev}\n".encode()
+
+
+def git(repo, *args):
+    return subprocess.run(["git", *args], cwd=repo, check=True, capture_output=True, text=True).stdout
+
+
+@pytest.fixture
+def target_repo(tmp_path, monkeypatch):
+    monkeypatch.setenv("GIT_COMMITTER_NAME", "Sync Test")
+    monkeypatch.setenv("GIT_COMMITTER_EMAIL", "sync@example.com")
+    path = tmp_path / "target.git"
+    subprocess.run(["git", "init", "--quiet", "--bare", str(path)], check=True)
+    stream = FastImportStream(path)
+    try:
+        root = stream.commit("refs/heads/main", None, IDENT, IDENT, "root", [FileChange("README", b"synced\n")])
+        stream.commit("refs/heads/main", root, IDENT, IDENT, "initial", [FileChange(".gitignore", b"*.tmp\n")])
+    finally:
+        stream.close()
+    return path
+
+
+def test_position_follows_fast_import_checkpoints(tmp_path, target_repo, monkeypatch):
+    from server import app, config, web
+    from utils import tracker
+    from repo.git_fast_import_tracker import GitFastImportTracker
+
+    monkeypatch.setattr("repo.git_fast_import_tracker.FAST_IMPORT_CHECKPOINT_INTERVAL", 5)
+    monkeypatch.setattr(tracker, "STATE_DB", str(tmp_path / "sync_state.db"))
+    monkeypatch.setattr(config, "profiles_dir", f"{tmp_path}/")
+    monkeypatch.setattr(config, "PREFETCH_DEPTH", 0)
+    monkeypatch.setattr(config, "SCOPED_RESTORE", True)
+    monkeypatch.setattr(config, "USE_TRIGGERS_TO_INITIATE_SYNC", False)
+
+    name = "fast-import-sync"
+    tracker.set_last_revision(name, "0", "root", 0)
+    source = FakeSvnSource(["1", "2", "3", "4"], fail_once=["4"])
+    target = GitFastImportTracker(name, str(target_repo), "main")
+
+    waits = []
+
+    def wait_for_trigger(sync, timeout=None):
+        # revisions 1 to 3 went into the stream before revision 4 failed, none of them was checkpointed
+        waits.append((tracker.get_last_revision(name), int(git(target_repo, "rev-list", "--count", "main")),
+                      tracker.get_revision_status(name, "1")))
+        if len(waits) == 2:
+            raise StopSync()
+        return False
+
+    monkeypatch.setattr(web, "wait_for_trigger", wait_for_trigger)
+    try:
+        with pytest.raises(StopSync):
+            app.start_revision_tracker(name, source, target)
+    finally:
+        target.stream.close()
+        target.blob_readers.close()
+
+    (position, commits, status), (final_position, final_commits, _) = waits
+    assert tuple(position) == ("0", "root", 0) and commits == 2 and status is None
+    assert tracker.get_revision_status(name, "4")[0] == "synced"
+
+    # the second pass synced all four, each mapped to the commit on the branch
+    assert final_position[0] == "4" and final_position[2] == -1
+    heads = git(target_repo, "rev-list", "main").split()
+    assert final_commits == len(heads) == 6 and final_position[1] == heads[0]
+    assert [tracker.lookup_revision(name, rev)[0][1] for rev in ("4", "3", "2", "1")] == heads[:4]
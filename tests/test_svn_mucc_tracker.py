@@ -0,0 +1,106 @@
+import os
+import shutil
+import stat
+import subprocess
+import tarfile
+from datetime import datetime, timezone
+
+import pytest
+
+pytestmark = pytest.mark.skipif(not all(shutil.which(tool) for tool in ("svn", "svnadmin", "svnmucc")),
+                                reason="needs svn, svnadmin and svnmucc")
+
+GIT_ENV = {"GIT_AUTHOR_NAME": "Sync Test", "GIT_AUTHOR_EMAIL": "sync@example.com",
+           "GIT_COMMITTER_NAME": "Sync Test", "GIT_COMMITTER_EMAIL": "sync@example.com"}
+
+BINARY = bytes(range(256)) * 64
+
+
+def run(cwd, *cmd):
+    return subprocess.run(cmd, cwd=cwd, check=True, capture_output=True, text=True).stdout
+
+
+def write(root, path, contents, executable=False):
+    full_path = os.path.join(root, path)
+    os.makedirs(os.path.dirname(full_path), exist_ok=True)
+    with open(full_path, "wb") as file_to_write:
+        file_to_write.write(contents)
+    if executable:
+        os.chmod(full_path, os.stat(full_path).st_mode | stat.S_IXUSR)
+
+
+@pytest.fixture
+def repos(tmp_path, monkeypatch):
+    """a git source and an svn target (file://) holding the same tree, the svn one allowing revprop changes"""
+    for name, value in GIT_ENV.items():
+        monkeypatch.setenv(name, value)
+
+    git_path = tmp_path / "git"
+    git_path.mkdir()
+    run(git_path, "git", "init", "--quiet")
+    for path, contents in (("a.txt", b"a\n"), ("dir/b.txt", b"b\n" * 20), ("old/c.txt", b"c\n"),
+                           ("images/logo.bin", BINARY)):
+        write(git_path, path, contents)
+    run(git_path, "git", "add", "-A")
+    run(git_path, "git", "commit", "--quiet", "-m", "initial")
+    export = tmp_path / "export"
+    export.mkdir()
+    run(git_path, "git", "archive", "--format=tar", "-o", str(tmp_path / "tree.tar"), "HEAD")
+    with tarfile.open(tmp_path / "tree.tar") as tree:
+        tree.extractall(export)
+
+    svn_repo = tmp_path / "svnrepo"
+    run(tmp_path, "svnadmin", "create", str(svn_repo))
+    hook = svn_repo / "hooks" / "pre-revprop-change"
+    hook.write_text("#!/bin/sh\nexit 0\n")
+    hook.chmod(0o755)
+    url = f"file://{svn_repo}/trunk"
+    run(tmp_path, "svn", "import", "--quiet", "-m", "initial", str(export), url)
+    run(tmp_path, "svn", "checkout", "--quiet", url, str(tmp_path / "wc"))
+
+    staging = tmp_path / "patches"
+    (staging / "mucc").mkdir(parents=True)
+    monkeypatch.setattr("repo.svn_mucc_tracker.patches_dir", f"{staging}/")
+    return git_path, url, tmp_path / "wc"
+
+
+def test_commit_rename_delete_binary_and_revprops(repos):
+    from repo.git_tracker import GitTracker
+    from repo.svn_mucc_tracker import SvnMuccTracker
+
+    git_path, url, wc = repos
+    run(git_path, "git", "mv", "dir/b.txt", "moved/b.txt")
+    run(git_path, "git", "rm", "--quiet", "old/c.txt")
+    write(git_path, "images/logo.bin", BINARY[::-1])
+    write(git_path, "run.sh", b"#!/bin/sh\necho synced\n", executable=True)
+    run(git_path, "git", "add", "-A")
+    run(git_path, "git", "commit", "--quiet", "-m", "changes")
+    rev = run(git_path, "git", "rev-parse", "HEAD").strip()
+
+    src = GitTracker("mucc-src", str(git_path), "master", is_test=True)
+    tgt = SvnMuccTracker("mucc", str(wc), "trunk")
+    date = datetime(2024, 5, 6, 7, 8, 9, tzinfo=timezone.utc)
+    try:
+        commit_msg, revision = tgt.commit(date, "changes", "someone@example.com", rev, None, src=src)
+    finally:
+        src.blob_readers.close()
+        src.objects.close()
+
+    assert revision == 2
+    assert commit_msg.endswith(f"#Synced from: {rev}")
+    assert sorted(run(wc, "svn", "ls", "-R", url).split()) == [
+        "a.txt", "images/", "images/logo.bin", "moved/", "moved/b.txt", "run.sh"]
+    assert run(wc, "svn", "cat", f"{url}/moved/b.txt") == "b\n" * 20
+    cat = subprocess.run(["svn", "cat", f"{url}/images/logo.bin"], check=True, capture_output=True)
+    assert cat.stdout == BINARY[::-1]
+    assert run(wc, "svn", "propget", "svn:executable", f"{url}/run.sh").strip() == "*"
+
+    # the rename is a copy of the original, with history
+    log = run(wc, "svn", "log", "--verbose", "-r2", url)
+    assert "A /trunk/moved/b.txt (from /trunk/dir/b.txt:1)" in log
+    assert "D /trunk/dir" in log and "D /trunk/old" in log
+
+    # author and date fixed up through revision properties
+    assert run(wc, "svn", "propget", "--revprop", "-r2", "svn:author", url).strip() == "someone"
+    assert run(wc, "svn", "propget", "--revprop", "-r2", "svn:date", url).startswith("2024-05-06T07:08:09")
+
@@ -0,0 +1,52 @@
+import os
+from types import SimpleNamespace
+
+from repo.svn_tracker import SvnTracker
+from utils.diff_tools import parse_diff
+from utils.patch_apply import apply_diff
+
+
+def recording_tracker(path):
+    """an SvnTracker on a plain directory, recording the svn commands it would run"""
+    tracker = SvnTracker.__new__(SvnTracker)
+    tracker.repo = SimpleNamespace(path=str(path))
+    tracker.commands = []
+    tracker.run_svn_command = lambda subcommand, args=(), **kwargs: tracker.commands.append([subcommand] + list(args))
+    return tracker
+
+
+def write(root, path, contents):
+    full_path = os.path.join(root, path)
+    os.makedirs(os.path.dirname(full_path), exist_ok=True)
+    with open(full_path, "wb") as file_to_write:
+        file_to_write.write(contents)
+
+
+def test_emptied_directories_are_removed_and_new_files_keep_their_properties(tmp_path):
+    write(tmp_path, "gone/deep/last.txt", b"x\n")
+    write(tmp_path, "kept/one.txt", b"1\n")
+    write(tmp_path, "kept/two.txt", b"2\n")
+    write(tmp_path, "tool.sh", b"echo\n")
+    diff = "\n".join([
+        "diff --git gone/deep/last.txt gone/deep/last.txt", "deleted file mode 100644", "--- gone/deep/last.txt",
+        "+++ /dev/null", "@@ -1 +0,0 @@", "-x",
+        "diff --git kept/one.txt kept/one.txt", "deleted file mode 100644", "--- kept/one.txt", "+++ /dev/null",
+        "@@ -1 +0,0 @@", "-1",
+        "diff --git new.txt new.txt", "new file mode 100644", "--- /dev/null", "+++ new.txt", "@@ -0,0 +1 @@", "+n",
+        "diff --git tool.sh tool.sh", "old mode 100755", "new mode 100644", ""])
+
+    tracker = recording_tracker(tmp_path)
+    tracker.schedule_changes(apply_diff(parse_diff(diff), str(tmp_path)))
+
+    assert tracker.commands == [["add", "--force", "--parents", "new.txt"],
+                                ["rm", "--force", "gone/deep/last.txt", "kept/one.txt"],
+                                ["rm", "--force", "gone"],
+                                ["propdel", "svn:executable", "tool.sh"]]
+
+
+def test_rename_sources_empty_their_directory(tmp_path):
+    write(tmp_path, "moved/b.txt", b"b\n")
+    os.makedirs(tmp_path / "dir")
+
+    tracker = recording_tracker(tmp_path)
+    assert tracker.emptied_working_copy_directories(["dir/b.txt"]) == ["dir"]
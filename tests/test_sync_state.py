@@ -0,0 +1,81 @@
+import sqlite3
+import time
+
+import pytest
+
+from utils.sync_state import SyncStateStore
+
+
+@pytest.fixture
+def store(tmp_path):
+    store = SyncStateStore(str(tmp_path / "state.db"), group_size=64, group_delay=0.2)
+    yield store
+    store.close()
+
+
+def read_status(store):
+    with sqlite3.connect(store.path, timeout=0) as connection:
+        return connection.execute("SELECT rev, status FROM revision_status").fetchall()
+
+
+def test_buffered_writes_hold_no_lock(store):
+    store.set_revision_status("sync", "1", "synced", "abc")
+
+    # another process can write while the status waits for its group commit
+    connection = sqlite3.connect(store.path, timeout=0, isolation_level=None)
+    try:
+        connection.execute("BEGIN IMMEDIATE")
+        connection.execute("INSERT INTO revision_map (name, src_rev, target_rev) VALUES ('other', '1', 'def')")
+        connection.execute("COMMIT")
+    finally:
+        connection.close()
+    assert read_status(store) == []
+
+
+def test_group_delay_commits_without_further_writes(store):
+    store.set_revision_status("sync", "1", "synced", "abc")
+    store.set_revision_status("sync", "2", "failed")
+    assert read_status(store) == []
+
+    deadline = time.monotonic() + 5
+    while not read_status(store) and time.monotonic() < deadline:
+        time.sleep(0.05)
+    assert sorted(read_status(store)) == [("1", "synced"), ("2", "failed")]
+
+
+def test_checkpoint_commits_buffered_writes_with_it(store):
+    store.set_revision_status("sync", "1", "synced", "abc")
+    store.set_checkpoint("sync", "1", "abc", 1)
+
+    assert read_status(store) == [("1", "synced")]
+    with sqlite3.connect(store.path) as connection:
+        assert connection.execute("SELECT src_rev, position FROM checkpoint").fetchall() == [("1", 1)]
+    # synced with FULL, then back to NORMAL for the group-committed writes
+    assert store._connection.execute("PRAGMA synchronous").fetchone()[0] == 1
+
+
+class FakeTarget:
+    type = "Git"
+
+    def __init__(self, pairs):
+        self.pairs = pairs
+        self.scans = 0
+
+    def get_synced_revisions(self):
+        self.scans += 1
+        return iter(self.pairs)
+
+
+def test_revision_map_is_backfilled_once_even_when_empty(tmp_path, monkeypatch):
+    from utils import tracker
+
+    monkeypatch.setattr(tracker, "STATE_DB", str(tmp_path / "tracker.db"))
+    empty, synced = FakeTarget([]), FakeTarget([("10", "abcdef1234"), ("11", "bcdef12345")])
+
+    tracker.rebuild_revision_map("empty", empty)
+    tracker.rebuild_revision_map("empty", empty)
+    tracker.rebuild_revision_map("synced", synced)
+    tracker.rebuild_revision_map("synced", synced)
+
+    assert empty.scans == 1 and synced.scans == 1
+    assert tracker.lookup_revision("synced", "abcdef1") == [("10", "abcdef1234")]
@@ -1,5 +1,9 @@
-import sys
+import codecs
 import re
+import subprocess
+import unicodedata
+
+from utils import metrics
 
 re_head_svn = re.compile('^Index:')
 re_diff_git = re.compile('^diff --git ([^ ]+) ([^ ]+$)')
@@ -7,12 +11,192 @@ re_diff_file_mode = re.compile('.+ file mode [0-9]+$')
 re_diff_stat = re.compile('^(@@ -[^ ]+ \\+[^ ]+ @@).*$')
 re_sim_index = re.compile('^similarity index [0-9]+%$')
 
+# longest header any converter looks at from the start of a file section
+HEADER_WINDOW = 10
+
+
+class DiffHunk:
+    """A '@@ -a,b +c,d @@' hunk header, positioned by its line index in the diff"""
+    __slots__ = ('index', 'header')
+
+    def __init__(self, index, header):
+        self.index = index
+        self.header = header
+
+
+class FileDiff:
+    """
+    One file section of a diff: either a git section ('diff --git ...') or an svn section ('Index: ...', which
+    may carry its own 'diff --git' line). 'start'/'end' are line indexes into the diff the section came from.
+    """
+    __slots__ = ('start', 'end', 'is_svn', 'old_path', 'new_path', 'is_new', 'is_deleted', 'is_binary',
+                 'similarity', 'rename_from', 'rename_to', 'old_mode', 'new_mode', 'hunks')
+
+    def __init__(self, start, is_svn, old_path, new_path):
+        self.start = start
+        self.end = start + 1
+        self.is_svn = is_svn
+        self.old_path = old_path
+        self.new_path = new_path
+        self.is_new = False
+        self.is_deleted = False
+        self.is_binary = False
+        self.similarity = None
+        self.rename_from = None
+        self.rename_to = None
+        self.old_mode = None
+        self.new_mode = None
+        self.hunks = []
+
+    @property
+    def path(self):
+        if self.rename_to:
+            return self.rename_to
+
+        return self.old_path if self.is_deleted else self.new_path
+
+
+class DiffModel:
+    """The lines of a diff along with the file sections found in them"""
+    __slots__ = ('lines', 'files', 'cr_stripped')
+
+    def __init__(self, lines, files, cr_stripped=False):
+        self.lines = lines
+        self.files = files
+        # carriage returns were removed from the lines, CRLF and LF endings can no longer be told apart
+        self.cr_stripped = cr_stripped
+
+    def binary_files(self):
+        return [f.path for f in self.files if f.is_binary and not f.is_deleted]
+
+    def rename_files(self):
+        return [{'from': f.rename_from, 'to': f.rename_to or f.new_path} for f in self.files if f.rename_from]
+
+
+class DiffScanner:
+    """
+    Classifies diff lines one at a time, building the FileDiff records of a diff in a single pass.
+    Only the first character of most lines is looked at; header lines are parsed until the first hunk.
+
+    :param keep_hunks: record hunks on their FileDiff (turn off for streamed diffs where only files matter)
+    """
+
+    def __init__(self, keep_hunks=True):
+        self.keep_hunks = keep_hunks
+        self.files = []
+        self.index = -1
+        self._file = None
+        self._in_header = False
+        self._attachable = False
+
+    def feed(self, line):
+        """
+        Classify the next line of the diff
+
+        :return: the FileDiff a line starts, the DiffHunk of a hunk header inside a file section, or None
+        """
+        self.index += 1
+        first = line[:1]
+
+        if first == "@":
+            match = re_diff_stat.match(line)
+            if match:
+                self._in_header = False
+                self._attachable = False
+                if self._file is None:
+                    return None
+                hunk = DiffHunk(self.index, match.group(1))
+                if self.keep_hunks:
+                    self._file.hunks.append(hunk)
+                return hunk
+        elif first == "I":
+            if line.startswith("Index:"):
+                path = line[len("Index: "):].rstrip("\r")
+                self._attachable = True
+                return self._start(FileDiff(self.index, True, path, path))
+        elif first == "d":
+            match = re_diff_git.match(line)
+            if match:
+                # svn writes its own 'diff --git' line right below 'Index:' and '====', it belongs to that section
+                if self._attachable and self.index - self._file.start <= 2:
+                    self._attachable = False
+                    return None
+                old_path, new_path = match.group(1).rstrip("\r"), match.group(2).rstrip("\r")
+                if old_path.startswith("a/") and new_path.startswith("b/") and old_path[2:] == new_path[2:]:
+                    old_path, new_path = old_path[2:], new_path[2:]
+                self._attachable = False
+                return self._start(FileDiff(self.index, False, old_path, new_path))
+
+        if self._in_header:
+            self._scan_header(line)
+        return None
+
+    def finish(self):
+        if self._file is not None:
+            self._file.end = self.index + 1
+        self._file = None
+        return self.files
+
+    def _start(self, file):
+        if self._file is not None:
+            self._file.end = file.start
+        self._file = file
+        self._in_header = True
+        self.files.append(file)
+        return file
+
+    def _scan_header(self, line):
+        file = self._file
+        line = line.rstrip("\r")
+        if line.startswith("new file mode"):
+            file.is_new = True
+            file.new_mode = line[len("new file mode "):]
+        elif line.startswith("deleted file mode"):
+            file.is_deleted = True
+            file.old_mode = line[len("deleted file mode "):]
+        elif line.startswith("old mode "):
+            file.old_mode = line[len("old mode "):]
+        elif line.startswith("new mode "):
+            file.new_mode = line[len("new mode "):]
+        elif line.startswith("similarity index "):
+            similarity = line[len("similarity index "):].rstrip("%")
+            file.similarity = int(similarity) if similarity.isdigit() else None
+        elif line.startswith("rename from "):
+            file.rename_from = line[len("rename from "):]
+        elif line.startswith("rename to "):
+            file.rename_to = line[len("rename to "):]
+        elif line.startswith("GIT binary patch") or line.startswith("Binary files ") or \
+                line.startswith("Cannot display: file marked as a binary type."):
+            file.is_binary = True
+            self._in_header = False
+
+
+def parse_diff(diff, strip_cr=False) -> DiffModel:
+    """
+    Parse a git or svn diff into a DiffModel in one pass. Passing an existing DiffModel returns it unchanged.
+
+    :param diff: the diff text (or a DiffModel)
+    :param strip_cr: remove all carriage returns before splitting the diff into lines
+    """
+    if isinstance(diff, DiffModel):
+        if not strip_cr or diff.cr_stripped or diff.lines is None:
+            return diff
+        diff = "\n".join(diff.lines)
+
+    lines = (diff.replace("\r", "") if strip_cr else diff).split("\n")
+    scanner = DiffScanner()
+    for line in lines:
+        scanner.feed(line)
+
+    return DiffModel(lines, scanner.finish(), cr_stripped=strip_cr)
+
 
 def is_git_diff_header(line, i):
     if re_diff_git.match(line[i]):
-        if re_diff_file_mode.match(line[i + 1]):
+        if len(line) > i + 1 and re_diff_file_mode.match(line[i + 1]):
             i += 1
-        if line[i + 1].startswith('index ') and \
+        if len(line) > i + 3 and \
+                line[i + 1].startswith('index ') and \
                 line[i + 2].startswith('--- ') and \
                 line[i + 3].startswith('+++ '):
             return True
@@ -20,7 +204,7 @@ def is_git_diff_header(line, i):
 
 
 def is_git_diff_rename_header(line, i):
-    if re_diff_git.match(line[i]):
+    if re_diff_git.match(line[i]) and len(line) > i + 2:
         if line[i + 1].startswith('similarity index ') and line[i + 2].startswith('rename from '):
             if line[i + 1][len('similarity index '):].startswith("100%"):
                 return True, True
@@ -41,29 +225,23 @@ def is_svn_diff_header(line, i):
 def svn_convert_print_diff_header(line, i, revision):
     lines = []
     num_line = 4
-    print(re_diff_git.sub(r'Index: \2', line[i]))
     lines.append(re_diff_git.sub(r'Index: \2', line[i]))
 
     if re_diff_file_mode.match(line[i + 1]):
         i += 1
         num_line += 1
 
-    print('===================================================================')
     lines.append('===================================================================')
     if line[i + 2] == '--- /dev/null':
         filename = line[i + 3][len('+++ '):]
-        print('--- %s\t(revision 0)' % filename)
         lines.append('--- %s\t(revision 0)' % filename)
     else:
-        print('%s\t(revision %s)' % (line[i + 2], revision))
         lines.append('%s\t(revision %s)' % (line[i + 2], revision))
 
     if line[i + 3] == '+++ /dev/null':
         filename = line[i + 2][len('--- '):]
-        print('+++ %s\t(working copy)' % filename)
         lines.append('+++ %s\t(working copy)' % filename)
     else:
-        print('%s\t(working copy)' % line[i + 3])
         lines.append('%s\t(working copy)' % line[i + 3])
 
     return num_line, lines
@@ -79,10 +257,7 @@ def svn_convert_rename_header(line, i, revision):
     filename = re_diff_git.match(line[i]).group(1)
     rename = re_diff_git.match(line[i]).group(2)
 
-    print(re_diff_git.sub(r'Index: \1', line[i]))
     lines.append(re_diff_git.sub(r'Index: \1', line[i]))
-
-    print('===================================================================')
     lines.append('===================================================================')
     lines.append(f'--- {filename}\t(revision {revision}, rename: {rename})')
     lines.append(f'+++ {filename}\t(working copy)')
@@ -90,38 +265,54 @@ def svn_convert_rename_header(line, i, revision):
     return num_line, lines
 
 
+def svn_convert_section_header(head, revision):
+    """
+    Convert the git header at the top of a file section to its svn form
+
+    :param head: the first lines of the section (at most HEADER_WINDOW)
+    :return: the converted header lines and the number of section lines they replace
+    """
+    if is_git_diff_header(head, 0):
+        num, out = svn_convert_print_diff_header(head, 0, revision)
+        return out, num
+
+    is_rename, no_changes = is_git_diff_rename_header(head, 0)
+    if is_rename and not no_changes:
+        num, out = svn_convert_rename_header(head, 0, revision)
+        return out, num + 1
+
+    return [], 0
+
+
 def svn_format_diff(diff, revision=""):
-    i = 0
+    model = parse_diff(diff)
+    src = model.lines
     lines = []
-    diff_lines = diff.split("\n")
+    pos = 0
 
-    while i < len(diff_lines):
-        if is_git_diff_header(diff_lines, i):
-            num, out = svn_convert_print_diff_header(diff_lines, i, revision)
-            i += num
-            lines += out
-        elif re_diff_stat.match(diff_lines[i]):
-            print(re_diff_stat.sub(r'\1', diff_lines[i]))
-            lines.append("\n" + re_diff_stat.sub(r'\1', diff_lines[i]))
-            i += 1
-        else:
-            is_rename, no_changes = is_git_diff_rename_header(diff_lines, i)
-            if is_rename and not no_changes:
-                num, out = svn_convert_rename_header(diff_lines, i, revision)
-                i += num
-                lines += out
-            elif i == (len(diff_lines) - 1):
-                # last line
-                sys.stdout.write(diff_lines[i])
-                # output += diff_lines[i] + '\n'
-            else:
-                print(diff_lines[i])
-                lines.append(diff_lines[i])
-            i += 1
+    for file in model.files:
+        _svn_pass_through(src, pos, file.start, lines)
+        out, num = svn_convert_section_header(src[file.start:min(file.start + HEADER_WINDOW, file.end)], revision)
+        lines += out
+        pos = min(file.start + num, file.end) if num else file.start
+
+        for hunk in file.hunks:
+            if hunk.index < pos:
+                continue
+            _svn_pass_through(src, pos, hunk.index, lines)
+            lines.append("\n" + hunk.header)
+            pos = hunk.index + 1
+
+    _svn_pass_through(src, pos, len(src), lines)
 
     return lines
 
 
+def _svn_pass_through(src, start, stop, lines):
+    # the very last line of the diff is never written out
+    lines += src[start:min(stop, len(src) - 1)]
+
+
 def git_convert_print_diff_header(line, i, revision):
     lines = []
     num_line = 2
@@ -129,14 +320,14 @@ def git_convert_print_diff_header(line, i, revision):
     filename = line[i][len('Index: '):]
 
     # diff --git node
-    if line[i + 1].startswith("========="):
+    if len(line) > i + 1 and line[i + 1].startswith("========="):
         i += 1
-    if re_diff_git.match(line[i + 1]):
+    if len(line) > i + 1 and re_diff_git.match(line[i + 1]):
         i += 1
         lines.append(f"diff --git a/{filename} b/{filename}")
         num_line += 1
 
-    if re_diff_file_mode.match(line[i + 1]):
+    if len(line) > i + 1 and re_diff_file_mode.match(line[i + 1]):
         i += 1
         lines.append(line[i])
         num_line += 1
@@ -150,7 +341,7 @@ def git_convert_print_diff_header(line, i, revision):
         lines.append(f"index 0000000..{revision} 100644")
         lines.append('--- /dev/null')
         lines.append(f"+++ b/{filename}")
-        if line[i + 1].startswith("GIT binary patch"):
+        if len(line) > i + 2 and line[i + 1].startswith("GIT binary patch"):
             lines.append(line[i + 1])
             lines.append(line[i + 2])
         num_line += 2
@@ -163,91 +354,262 @@ def git_convert_print_diff_header(line, i, revision):
     return num_line, lines
 
 
-def git_format_diff(diff: str, revision=""):
-    i = 0
+def is_git_skipped_section(lines, i):
+    """svn nodes that only delete 'svn:ignore' have no git equivalent and are dropped"""
+    return len(lines) > (i + 8) and lines[i + 6].startswith("Property changes on:") \
+        and lines[i + 8].startswith("Deleted: svn:ignore")
+
+
+def git_format_diff(diff, revision=""):
+    model = parse_diff(diff, strip_cr=True)
+    src = model.lines
     lines = []
-    diff_lines = diff.replace("\r", "").split("\n")
-    skip_node = False
-
-    while i < len(diff_lines):
-        if re_head_svn.match(diff_lines[i]):
-            skip_node = False
-            num, out = git_convert_print_diff_header(diff_lines, i, revision)
-            # print("\n".join(out))
-            if len(diff_lines) > (i + 8) and diff_lines[i + 6].startswith("Property changes on:") \
-                    and diff_lines[i + 8].startswith("Deleted: svn:ignore"):
-                print("Skipping garbage lines")
-                skip_node = True
-                i += num
-            else:
-                i += num
-                lines += out
-        elif skip_node:
-            if i == (len(diff_lines) - 1):
-                # last line
-                lines.append("")
-            i += 1
-        elif re_diff_stat.match(diff_lines[i]):
-            # print(re_diff_stat.sub(r'\1', diff_lines[i]))
-            lines.append(re_diff_stat.sub(r'\1', diff_lines[i]))
-            i += 1
-        else:
-            if i == (len(diff_lines) - 1):
-                # last line
-                sys.stdout.write(diff_lines[i])
-                lines.append(diff_lines[i] + '\n')
-            else:
-                # print(diff_lines[i])
-                lines.append(diff_lines[i])
-            i += 1
+    pos = 0
+
+    for file in model.files:
+        if file.is_svn:
+            _git_pass_through(src, pos, file.start, lines)
+            head = src[file.start:min(file.start + HEADER_WINDOW, file.end)]
+            if is_git_skipped_section(head, 0):
+                pos = file.end
+                if file.end == len(src):
+                    lines.append("")
+                continue
+
+            num, out = git_convert_print_diff_header(head, 0, revision)
+            lines += out
+            pos = min(file.start + num, file.end)
+
+        for hunk in file.hunks:
+            if hunk.index < pos:
+                continue
+            _git_pass_through(src, pos, hunk.index, lines)
+            lines.append(hunk.header)
+            pos = hunk.index + 1
+
+    _git_pass_through(src, pos, len(src), lines)
 
     return lines
 
 
-def git_get_binary_files(diff: str):
-    i = 0
-    files = []
-    diff_lines = diff.replace("\r", "").split("\n")
+def _git_pass_through(src, start, stop, lines):
+    # the very last line of the diff is written out with a trailing newline
+    if stop < len(src):
+        lines += src[start:stop]
+    elif start < stop:
+        lines += src[start:stop - 1]
+        lines.append(src[stop - 1] + '\n')
 
-    while i < len(diff_lines):
-        if re_diff_git.match(diff_lines[i]):
-            if re_diff_file_mode.match(diff_lines[i + 1]) and diff_lines[i + 1].startswith("new file"):
-                if len(diff_lines) > (i + 5) and diff_lines[i + 5].startswith("GIT binary patch"):
-                    files.append(diff_lines[i + 4][len("+++ b/"):])
-                elif len(diff_lines) > (i + 3) and diff_lines[i + 3].startswith("GIT binary patch"):
-                    files.append(re_diff_git.match(diff_lines[i]).group(2))
-            elif diff_lines[i + 1].startswith("index "):
-                if len(diff_lines) > (i + 4) and diff_lines[i + 4].startswith("GIT binary patch"):
-                    files.append(diff_lines[i + 3][len("+++ "):])
 
-        i += 1
+def git_get_binary_files(diff):
+    return parse_diff(diff).binary_files()
+
+
+def git_get_rename_files(diff):
+    return parse_diff(diff).rename_files()
+
+
+def is_empty_diff(diff):
+    """A diff is empty when it holds nothing but non-control whitespace"""
+    if isinstance(diff, DiffStream):
+        return diff.is_empty()
+    if isinstance(diff, DiffModel):
+        return len(diff.lines) == 1 and _is_blank(diff.lines[0])
 
-    return files
-
-
-def git_get_rename_files(diff: str):
-    i = 0
-    files = []
-    diff_lines = diff.replace("\r", "").split("\n")
-
-    while i < len(diff_lines):
-        if re_diff_git.match(diff_lines[i]):
-            if re_sim_index.match(diff_lines[i + 1]):
-                if len(diff_lines) > (i + 2) and diff_lines[i + 2].startswith("rename from"):
-                    from_file = diff_lines[i + 2][len("rename from "):]
-                    if len(diff_lines) > (i + 3):
-                        to_file = diff_lines[i + 3][len("rename to "):]
-                    else:
-                        to_file = diff_lines[i][len(f"diff --git {from_file} "):]
-                    files.append(
-                        {
-                            'from': from_file,
-                            'to': to_file
-                         }
-                    )
+    return _is_blank(str(diff))
 
-        i += 1
 
-    return files
+def _is_blank(text):
+    return all(ch.isspace() and unicodedata.category(ch)[0] != "C" for ch in text)
+
+
+class DiffStream:
+    """
+    A diff produced by a command and read from its stdout in chunks of 'buffer_size' bytes as it is consumed,
+    instead of being held in memory as one string. The command starts on first use and can be consumed once.
 
+    :param strip_final_newline: drop one trailing newline from the output (what GitPython does for 'repo.git.diff')
+    :param check: raise CalledProcessError if the command exits with a non-zero code
+    """
 
+    def __init__(self, cmd, cwd, buffer_size, encoding="utf-8", strip_final_newline=False, check=False):
+        self.cmd = cmd
+        self.cwd = cwd
+        self.buffer_size = buffer_size
+        self.encoding = encoding
+        self.strip_final_newline = strip_final_newline
+        self.check = check
+        self._process = None
+        self._decoder = codecs.getincrementaldecoder(encoding)(errors="surrogateescape")
+        self._read_ahead = []
+
+    def __str__(self):
+        return f"<diff stream: {' '.join(self.cmd)}>"
+
+    def __del__(self):
+        self.close()
+
+    def is_empty(self):
+        for chunk in self._read():
+            self._read_ahead.append(chunk)
+            if not _is_blank(chunk):
+                return False
+
+        return True
+
+    def chunks(self):
+        while self._read_ahead:
+            yield self._read_ahead.pop(0)
+
+        yield from self._read()
+
+    def lines(self, strip_cr=False):
+        """Yield the lines of the diff (as str.split("\\n") would), holding at most one chunk and one line"""
+        parts = []
+        ends_with_newline = False
+        for chunk in self.chunks():
+            if strip_cr:
+                chunk = chunk.replace("\r", "")
+            if not chunk:
+                continue
+
+            split = chunk.split("\n")
+            if len(split) > 1:
+                parts.append(split[0])
+                yield "".join(parts)
+                yield from split[1:-1]
+                parts = []
+            parts.append(split[-1])
+            ends_with_newline = chunk.endswith("\n")
+
+        if not (self.strip_final_newline and ends_with_newline):
+            yield "".join(parts)
+
+    def close(self):
+        if self._process is not None and self._process.poll() is None:
+            self._process.kill()
+            self._process.wait()
+
+    def _read(self):
+        if self._process is None:
+            self._process = subprocess.Popen(self.cmd, stdout=subprocess.PIPE, cwd=self.cwd)
+            metrics.record_subprocess(self.cmd[0])
+        elif self._process.stdout.closed:
+            return
+
+        while True:
+            data = self._process.stdout.read(self.buffer_size)
+            metrics.record_subprocess(self.cmd[0], len(data), started=False)
+            chunk = self._decoder.decode(data, final=not data)
+            if chunk:
+                yield chunk
+            if not data:
+                break
+
+        self._process.stdout.close()
+        if self._process.wait() != 0 and self.check:
+            raise subprocess.CalledProcessError(self._process.returncode, self.cmd)
+
+
+class _PatchWriter:
+    """Writes lines separated by newlines, i.e. what "\\n".join(lines) would produce"""
+
+    def __init__(self, file):
+        self.file = file
+        self.count = 0
+
+    def write(self, line):
+        if self.count:
+            self.file.write("\n")
+        self.file.write(line)
+        self.count += 1
+
+
+def spool_diff(lines, out, convert="", revision=""):
+    """
+    Convert a diff line by line and write it straight to a file. Produces the same output as svn_format_diff or
+    git_format_diff, but only the header of the current file section and the last line are held in memory.
+
+    :param lines: the lines of the diff, e.g. DiffStream.lines()
+    :param out: the text file the converted patch is written to
+    :param convert: "svn" (svn_format_diff), "git" (git_format_diff) or "" to copy the diff unchanged
+    :return: a DiffModel of the input with its file sections but no lines
+    """
+    scanner = DiffScanner(keep_hunks=False)
+    writer = _PatchWriter(out)
+    head = []
+    held = None
+    skipping = False
+
+    def emit(line):
+        nonlocal held
+        if held is not None:
+            writer.write(held[1])
+            held = None
+        writer.write(line)
+
+    def body(index, line, event):
+        nonlocal held
+        if isinstance(event, DiffHunk):
+            emit(f"\n{event.header}" if convert == "svn" else event.header)
+        else:
+            if held is not None:
+                writer.write(held[1])
+            held = (index, line)
+
+    def flush_head():
+        nonlocal skipping
+        file = head[0][2]
+        num = 0
+        head_lines = [line for _, line, __ in head]
+        if convert == "svn":
+            out_lines, num = svn_convert_section_header(head_lines, revision) if not file.is_svn else ([], 0)
+            for line in out_lines:
+                emit(line)
+        elif convert == "git" and file.is_svn:
+            if is_git_skipped_section(head_lines, 0):
+                skipping = True
+                num = len(head)
+            else:
+                num, out_lines = git_convert_print_diff_header(head_lines, 0, revision)
+                for line in out_lines:
+                    emit(line)
+
+        for index, line, event in head[num:]:
+            body(index, line, event)
+        head.clear()
+
+    for line in lines:
+        event = scanner.feed(line)
+        if not convert:
+            writer.write(line)
+            continue
+
+        if isinstance(event, FileDiff):
+            if head:
+                flush_head()
+            skipping = False
+            head.append((scanner.index, line, event))
+        elif head:
+            head.append((scanner.index, line, event))
+        elif not skipping:
+            body(scanner.index, line, event)
+
+        if len(head) == HEADER_WINDOW:
+            flush_head()
+
+    if head:
+        flush_head()
+
+    # the very last line of the diff is never written out by svn_format_diff, and gets a newline in git_format_diff
+    if held is not None:
+        index, line = held
+        if index != scanner.index:
+            writer.write(line)
+        elif convert == "git":
+            writer.write(line + "\n")
+
+    if skipping:
+        writer.write("")
+
+    return DiffModel(None, scanner.finish())
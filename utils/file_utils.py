@@ -1,9 +1,21 @@
 import os
 import errno
+import codecs
+import hashlib
+import shutil
+import tempfile
 import unicodedata
 import time
 import difflib
 
+from utils.logger import get_logger
+
+logger = get_logger(__name__)
+
+# read once, os.umask can only be read by setting it
+_UMASK = os.umask(0o022)
+os.umask(_UMASK)
+
 
 def wait_until(predicate, timeout=False, period=0.25, *args, **kwargs):
     must_end = time.time() + (timeout if timeout else 0)
@@ -29,28 +41,131 @@ def is_content_identical(content1: str, content2: str):
     diff = list(difflib.unified_diff(content1.splitlines(keepends=False), content2.splitlines(keepends=False)))
     diff_str = "\n".join(diff)
     has_no_diff = "" == diff_str
-    print(f"No diff={has_no_diff}: Compare diff is:" + diff_str)
+    logger.debug("No diff=%s: Compare diff is:%s", has_no_diff, diff_str)
     # return "" == "\n".join(filter(lambda l: l.strip(), diff))
     return has_no_diff
 
 
+class NormalizedDigest:
+    """
+    SHA-1 over content normalized the way line-based comparison sees it: a leading UTF-8 BOM is dropped,
+    CRLF/CR line endings become LF and one trailing newline is ignored. Content can be fed in chunks.
+    """
+
+    def __init__(self):
+        self._sha = hashlib.sha1()
+        self._pending = b""
+        self._started = False
+
+    def update(self, chunk: bytes):
+        data = self._pending + chunk
+        if not self._started:
+            if len(data) < len(codecs.BOM_UTF8) and codecs.BOM_UTF8.startswith(data):
+                self._pending = data
+                return
+            if data.startswith(codecs.BOM_UTF8):
+                data = data[len(codecs.BOM_UTF8):]
+            self._started = True
+
+        # hold back trailing line endings, they may be a split CRLF or the final newline
+        keep = 2 if data.endswith(b"\r\n") else 1 if data.endswith((b"\r", b"\n")) else 0
+        self._pending = data[len(data) - keep:]
+        self._sha.update(_normalize_line_endings(data[:len(data) - keep]))
+
+    def hexdigest(self):
+        data = _normalize_line_endings(self._pending)
+        if data.endswith(b"\n"):
+            data = data[:-1]
+
+        sha = self._sha.copy()
+        sha.update(data)
+        return sha.hexdigest()
+
+
+def _normalize_line_endings(data: bytes):
+    return data.replace(b"\r\n", b"\n").replace(b"\r", b"\n")
+
+
+def content_digest(contents, encoding="utf-8"):
+    """Digest of in-memory file contents (str or bytes), see NormalizedDigest"""
+    digest = NormalizedDigest()
+    digest.update(contents.encode(encoding) if isinstance(contents, str) else bytes(contents))
+    return digest.hexdigest()
+
+
+def file_digest(file_path, chunk_size=1024 * 1024):
+    """Digest of a file on disk, see NormalizedDigest. A missing file has the digest of empty content"""
+    digest = NormalizedDigest()
+    if file_exists(file_path):
+        with open(file_path, "rb") as file_to_read:
+            for chunk in iter(lambda: file_to_read.read(chunk_size), b""):
+                digest.update(chunk)
+
+    return digest.hexdigest()
+
+
 def overwrite_file(file_path, contents, encoding="utf-8-sig"):
     binary = False if isinstance(contents, str) else True
     create_folders(file_path)
     if binary:
-        print(f"Writing '{file_path}' with mode 'binary'")
+        logger.debug("Writing '%s' with mode 'binary'", file_path)
         with open(file_path, "wb") as file_to_write:
             file_to_write.write(contents)
             file_to_write.flush()
             file_to_write.close()
     else:
-        print(f"Writing '{file_path}' with mode 'text', encoding={encoding}")
+        logger.debug("Writing '%s' with mode 'text', encoding=%s", file_path, encoding)
         with open(file_path, "w", encoding=encoding) as file_to_write:
             file_to_write.write(contents)
             file_to_write.flush()
             file_to_write.close()
 
 
+def write_atomically(file_path, contents: bytes):
+    """
+    Replace a file in one step: the contents go to a temporary file next to it that is then renamed over it, so
+    readers see the old or the new contents, never a partial write. The permissions of an existing file are kept.
+    """
+    _replace_file(file_path, lambda file_to_write: file_to_write.write(contents))
+
+
+def write_stream_atomically(file_path, stream, chunk_size=1024 * 1024):
+    """
+    Replace a file with what a binary stream yields, copied through one chunk_size buffer so memory use does not
+    depend on the size of the file. The file is only replaced once the stream is read to its end without error.
+    """
+
+    def copy(file_to_write):
+        buffer = bytearray(chunk_size)
+        view = memoryview(buffer)
+        while True:
+            count = stream.readinto(buffer)
+            if not count:
+                break
+            file_to_write.write(view[:count])
+
+    _replace_file(file_path, copy)
+
+
+def _replace_file(file_path, write):
+    create_folders(file_path)
+    fd, temp_path = tempfile.mkstemp(prefix=f".{os.path.basename(file_path)}.", suffix=".tmp",
+                                     dir=os.path.dirname(file_path) or ".")
+    try:
+        with os.fdopen(fd, "wb") as file_to_write:
+            write(file_to_write)
+        if os.path.exists(file_path):
+            shutil.copymode(file_path, temp_path)
+        else:
+            # mkstemp creates files readable by their owner only
+            os.chmod(temp_path, 0o666 & ~_UMASK)
+        os.replace(temp_path, file_path)
+    except BaseException:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+
+
 def create_folders(path):
     if not os.path.exists(os.path.dirname(path)):
         try:
@@ -0,0 +1,253 @@
+import io
+import queue
+import subprocess
+import threading
+
+from utils import metrics
+from utils.logger import get_logger
+
+logger = get_logger(__name__)
+
+
+class CatFileBatch:
+    """
+    A long-lived 'git cat-file --batch' process used to read blobs from a repository.
+    Requests are written as '<rev>:<path>' and answered with a '<sha> <type> <size>' header followed by
+    exactly <size> bytes, so one pipe can serve any number of reads without spawning 'git show' per file.
+    The process is started lazily and restarted if it dies.
+    """
+
+    def __init__(self, repo_path, git_binary="git"):
+        self.repo_path = repo_path
+        self.git_binary = git_binary
+        self._lock = threading.Lock()
+        self._process = None
+
+    def read(self, rev, path):
+        """
+        Read the blob at '<rev>:<path>'
+
+        :return: the raw blob contents, or None if the object does not exist
+        """
+        if "\n" in path:
+            raise ValueError(f"Cannot read '{path}' through 'git cat-file --batch': path contains a newline")
+
+        with self._lock:
+            try:
+                return self._request(f"{rev}:{path}")
+            except OSError as e:
+                # the process died or the pipe is out of sync, restart it and retry once
+                logger.warning(f"'git cat-file --batch' failed for {rev}:{path} ({e}), restarting")
+                self._stop()
+                return self._request(f"{rev}:{path}")
+
+    def open(self, rev, path):
+        """
+        Stream the blob at '<rev>:<path>' out of the pipe instead of reading it whole. Other reads wait until the
+        stream has been read to its end or closed, so it has to be closed.
+
+        :return: a readable binary stream, or None if the object does not exist
+        """
+        if "\n" in path:
+            raise ValueError(f"Cannot read '{path}' through 'git cat-file --batch': path contains a newline")
+
+        self._lock.acquire()
+        try:
+            try:
+                size = self._request_header(f"{rev}:{path}")
+            except OSError as e:
+                logger.warning(f"'git cat-file --batch' failed for {rev}:{path} ({e}), restarting")
+                self._stop()
+                size = self._request_header(f"{rev}:{path}")
+        except BaseException:
+            self._lock.release()
+            raise
+
+        if size is None:
+            self._lock.release()
+            return None
+        return BlobStream(self, f"{rev}:{path}", size)
+
+    def close(self):
+        with self._lock:
+            self._stop()
+
+    def _ensure_started(self):
+        if self._process is not None and self._process.poll() is None:
+            return
+
+        if self._process is not None:
+            logger.warning(f"'git cat-file --batch' exited with code {self._process.returncode}, restarting")
+
+        logger.info(f"Starting 'git cat-file --batch' in {self.repo_path}")
+        self._process = subprocess.Popen([self.git_binary, "cat-file", "--batch"], stdin=subprocess.PIPE,
+                                         stdout=subprocess.PIPE, cwd=f"{self.repo_path}")
+        metrics.record_subprocess("git")
+
+    def _request(self, spec):
+        size = self._request_header(spec)
+        if size is None:
+            return None
+
+        stdout = self._process.stdout
+        contents = stdout.read(size)
+        if len(contents) != size or stdout.read(1) != b"\n":
+            raise IOError(f"'git cat-file --batch' returned a short read for {spec}")
+
+        metrics.record_subprocess("git", len(contents), started=False)
+        return contents
+
+    def _request_header(self, spec):
+        """:return: the size of the blob whose contents follow on stdout, None if the object does not exist"""
+        self._ensure_started()
+        stdin, stdout = self._process.stdin, self._process.stdout
+
+        stdin.write(f"{spec}\n".encode("utf-8"))
+        stdin.flush()
+
+        header = stdout.readline()
+        if not header:
+            raise IOError(f"'git cat-file --batch' closed its output while reading {spec}")
+
+        if header.endswith(b" missing\n") or header.endswith(b" ambiguous\n"):
+            return None
+
+        return int(header.rsplit(b" ", 1)[1])
+
+    def _stop(self, kill=False):
+        if self._process is None:
+            return
+
+        process, self._process = self._process, None
+        try:
+            if kill:
+                process.kill()
+            process.stdin.close()
+            process.wait(timeout=5)
+        except (OSError, subprocess.TimeoutExpired):
+            process.kill()
+            process.wait()
+
+
+class CatFileBatchPool:
+    """
+    Up to 'size' CatFileBatch processes streaming blobs concurrently (see CatFileBatch.open), each one serving a
+    single stream at a time. Processes are started as they are first needed and kept for the next streams.
+    """
+
+    def __init__(self, repo_path, size, git_binary="git"):
+        self.repo_path = repo_path
+        self.git_binary = git_binary
+        self._slots = threading.BoundedSemaphore(max(size, 1))
+        self._idle = queue.LifoQueue()
+
+    def read(self, rev, path):
+        """see CatFileBatch.read"""
+        batch = self._take()
+        try:
+            return batch.read(rev, path)
+        finally:
+            self._give_back(batch)
+
+    def open(self, rev, path):
+        """:return: a readable binary stream of the blob at '<rev>:<path>', or None if the object does not exist"""
+        batch = self._take()
+        try:
+            stream = batch.open(rev, path)
+        except BaseException:
+            self._give_back(batch)
+            raise
+
+        if stream is None:
+            self._give_back(batch)
+            return None
+        stream.on_release = lambda: self._give_back(batch)
+        return stream
+
+    def close(self):
+        while True:
+            try:
+                self._idle.get_nowait().close()
+            except queue.Empty:
+                return
+
+    def _take(self):
+        self._slots.acquire()
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            return CatFileBatch(self.repo_path, self.git_binary)
+
+    def _give_back(self, batch):
+        self._idle.put(batch)
+        self._slots.release()
+
+
+class BlobStream(io.RawIOBase):
+    """
+    One blob read straight from a CatFileBatch pipe, holding the batch lock until it is read to its end or closed.
+    Closing it early stops the process (restarted by the next read), the rest of the blob is never read.
+    """
+
+    def __init__(self, batch: CatFileBatch, spec, size):
+        super().__init__()
+        self.batch = batch
+        self.spec = spec
+        self.remaining = size
+        # called once the batch can serve other reads again
+        self.on_release = None
+        self._released = False
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        if self._released:
+            return 0
+        if self.remaining == 0:
+            self._finish()
+            return 0
+
+        view = memoryview(buffer)[:min(len(buffer), self.remaining)]
+        try:
+            count = self.batch._process.stdout.readinto(view)
+        except OSError:
+            self._abandon()
+            raise
+        if not count:
+            self._abandon()
+            raise IOError(f"'git cat-file --batch' returned a short read for {self.spec}")
+
+        self.remaining -= count
+        metrics.record_subprocess("git", count, started=False)
+        if self.remaining == 0:
+            self._finish()
+        return count
+
+    def close(self):
+        if not self._released:
+            self._abandon()
+        super().close()
+
+    def _finish(self):
+        try:
+            if self.batch._process.stdout.read(1) != b"\n":
+                self._abandon()
+                raise IOError(f"'git cat-file --batch' returned a short read for {self.spec}")
+        except OSError:
+            if not self._released:
+                self._abandon()
+            raise
+        self._release()
+
+    def _abandon(self):
+        # the pipe is in the middle of this blob, the process cannot serve other reads any more
+        self.batch._stop(kill=True)
+        self._release()
+
+    def _release(self):
+        if not self._released:
+            self._released = True
+            self.batch._lock.release()
+            if self.on_release is not None:
+                self.on_release()
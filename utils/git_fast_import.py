@@ -0,0 +1,165 @@
+import subprocess
+import threading
+from typing import Iterable, NamedTuple, Optional
+
+from utils import metrics
+from utils.logger import get_logger
+
+logger = get_logger(__name__)
+
+FILE_MODE = "100644"
+EXECUTABLE_MODE = "100755"
+SYMLINK_MODE = "120000"
+
+
+class FileChange(NamedTuple):
+    """A change to one path of a commit: contents (and mode) for a modified file, None for a deleted path"""
+    path: str
+    data: Optional[bytes]
+    mode: str = FILE_MODE
+
+
+class FastImportStream:
+    """
+    A long-lived 'git fast-import' process used to write commits straight into the object database.
+    Commits are built from full file contents, never touch the working tree or index, and are fast-forwarded onto
+    their branch. Refs are only updated when the stream is checkpointed, which happens every 'checkpoint_interval'
+    commits and on flush(). The process is started lazily and restarted if it dies.
+    """
+
+    def __init__(self, repo_path, git_binary="git", checkpoint_interval=1):
+        self.repo_path = repo_path
+        self.git_binary = git_binary
+        self.checkpoint_interval = max(checkpoint_interval, 1)
+        self._lock = threading.Lock()
+        self._process = None
+        self._mark = 0
+        self._pending = 0
+        # marks of the commits written by the current process, by hash: a commit that was not checkpointed yet can
+        # only be referred to by its mark
+        self._commits = {}
+
+    def commit(self, ref, parent, author, committer, message, changes: Iterable[FileChange]):
+        """
+        Write a commit on top of 'parent' (None for a root commit) and move 'ref' to it
+
+        :param author: '<name> <email> <epoch> <tz>', as is the committer
+        :return: the hash of the new commit
+        """
+        with self._lock:
+            try:
+                self._ensure_started()
+                mark = self._write_commit(ref, parent, author, committer, message, changes)
+                self._pending += 1
+                if self._pending >= self.checkpoint_interval:
+                    self._checkpoint()
+                sha = self._get_mark(mark)
+                self._commits[sha] = mark
+                return sha
+            except OSError:
+                # whatever was not checkpointed is lost along with the process
+                self._stop(kill=True)
+                raise
+
+    @property
+    def pending(self):
+        """commits written since the last checkpoint, lost if the process dies before the next one"""
+        return self._pending
+
+    def flush(self):
+        """Checkpoint the stream so that commits written so far are visible to other git processes"""
+        with self._lock:
+            if self._process is not None and self._pending > 0:
+                self._checkpoint()
+
+    def close(self, kill=False):
+        with self._lock:
+            self._stop(kill=kill)
+
+    def _ensure_started(self):
+        if self._process is not None and self._process.poll() is None:
+            return
+
+        if self._process is not None:
+            logger.warning(f"'git fast-import' exited with code {self._process.returncode}, restarting")
+
+        logger.info(f"Starting 'git fast-import' in {self.repo_path}")
+        self._process = subprocess.Popen([self.git_binary, "fast-import", "--quiet", "--date-format=raw", "--done"],
+                                         stdin=subprocess.PIPE, stdout=subprocess.PIPE, cwd=f"{self.repo_path}")
+        metrics.record_subprocess("git")
+        self._mark = 0
+        self._pending = 0
+        self._commits = {}
+
+    def _write_commit(self, ref, parent, author, committer, message, changes):
+        stdin = self._process.stdin
+
+        # blobs go first so that each file can be written out as soon as it is read
+        files = []
+        for change in changes:
+            if change.data is None:
+                files.append(f"D {quote_path(change.path)}\n".encode("utf-8", errors="surrogateescape"))
+                continue
+
+            self._mark += 1
+            stdin.write(f"blob\nmark :{self._mark}\ndata {len(change.data)}\n".encode("utf-8"))
+            stdin.write(change.data)
+            stdin.write(b"\n")
+            files.append(f"M {change.mode} :{self._mark} {quote_path(change.path)}\n".encode("utf-8",
+                                                                                             errors="surrogateescape"))
+
+        self._mark += 1
+        message = message.encode("utf-8")
+        stdin.write(f"commit {ref}\nmark :{self._mark}\nauthor {author}\ncommitter {committer}\n"
+                    f"data {len(message)}\n".encode("utf-8"))
+        stdin.write(message)
+        stdin.write(b"\n")
+        if parent:
+            parent = f":{self._commits[parent]}" if parent in self._commits else parent
+            stdin.write(f"from {parent}\n".encode("utf-8"))
+        stdin.writelines(files)
+        stdin.write(b"\n")
+
+        return self._mark
+
+    def _checkpoint(self):
+        # the progress line is echoed once the checkpoint is done, making the refs update synchronous
+        self._process.stdin.write(b"checkpoint\n\nprogress checkpoint\n\n")
+        self._process.stdin.flush()
+        self._read_line("checkpoint")
+        self._pending = 0
+
+    def _get_mark(self, mark):
+        self._process.stdin.write(f"get-mark :{mark}\n".encode("utf-8"))
+        self._process.stdin.flush()
+        return self._read_line(f"mark :{mark}")
+
+    def _read_line(self, request):
+        line = self._process.stdout.readline()
+        if not line:
+            raise IOError(f"'git fast-import' closed its output while waiting for {request}")
+        return line.decode("utf-8").rstrip("\n")
+
+    def _stop(self, kill=False):
+        if self._process is None:
+            return
+
+        process, self._process = self._process, None
+        try:
+            if kill:
+                process.kill()
+            else:
+                process.stdin.write(b"done\n")
+                process.stdin.close()
+            process.wait(timeout=60)
+        except (OSError, subprocess.TimeoutExpired):
+            process.kill()
+            process.wait()
+
+
+def quote_path(path):
+    """C-style quote a path for the fast-import stream when it could not be read back as-is"""
+    if not (path.startswith('"') or "\n" in path):
+        return path
+
+    return '"' + path.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") + '"'
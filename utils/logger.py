@@ -1,21 +1,31 @@
+import atexit
 import errno
 import logging
 import os
+import queue
+import shutil
+import threading
 
-from logging.handlers import TimedRotatingFileHandler
+from logging.handlers import TimedRotatingFileHandler, QueueHandler, QueueListener
 
 logs_dir = "output/logs/"
 log_format_full = '%(asctime)s\t%(name)s\t%(levelname)s\t%(message)s'
 log_format_message_only = '%(message)s'
 
 
-def setup_logger(project_name, location: str = "output/logs"):
+def setup_logger(project_name, location: str = "output/logs", asynchronous=True, queue_size=10000,
+                 max_message_length=None, rate_limits=None, compress_mode="gz"):
     """
     Initialize logging for a given project. Will remove other loggers and set up console and file handlers.
     The log file will rotate anytime you start up the application or after midnight
 
     :param project_name: The name of the log file (default location is "output/logs/<project_name>.log")
     :param location: the relative/absolute folder location of the log file relative to the application root
+    :param asynchronous: hand records to a background thread that writes them (see QueueListener), at most queue_size
+                         records wait for it, more are dropped and counted
+    :param max_message_length: truncate longer messages, None to keep them whole
+    :param rate_limits: {logger name (prefix): (records, seconds)}, see RateLimitFilter
+    :param compress_mode: compression of rotated log files, a key of COMPRESSION_SUPPORTED or None
     :return: None
     """
     print("Creating logs directory")
@@ -30,43 +40,208 @@ def setup_logger(project_name, location: str = "output/logs"):
     f_handler = NewRotatingFileHandler(f'{location}/{project_name}.log',
                                        backupCount=10,
                                        encoding="utf-8",
-                                       when='midnight')
+                                       when='midnight',
+                                       compress_mode=compress_mode)
     f_format = logging.Formatter(log_format_full)
     c_handler.setFormatter(f_format)
     f_handler.setFormatter(f_format)
 
+    # dropped records cost nothing more, so limits go first and truncation after
+    filters = []
+    if rate_limits:
+        filters.append(RateLimitFilter(rate_limits))
+    if max_message_length:
+        filters.append(TruncatingFilter(max_message_length))
+
     logging.basicConfig()
     if logging.root.hasHandlers():
         for handler in logging.root.handlers:
             logging.root.removeHandler(handler)
+    stop_listener()
 
     logging.root.setLevel(logging.INFO)
-    logging.root.addHandler(c_handler)
-    logging.root.addHandler(f_handler)
+    if asynchronous:
+        handlers = [DroppingQueueHandler(queue.Queue(queue_size))]
+        start_listener(handlers[0], c_handler, f_handler)
+    else:
+        handlers = [c_handler, f_handler]
+
+    for handler in handlers:
+        for log_filter in filters:
+            handler.addFilter(log_filter)
+        logging.root.addHandler(handler)
+
+
+class TruncatingFilter(logging.Filter):
+    """Cuts messages (arguments included) down to max_length characters"""
+
+    def __init__(self, max_length):
+        super().__init__()
+        self.max_length = max_length
+
+    def filter(self, record):
+        message = record.getMessage()
+        if len(message) > self.max_length:
+            record.msg = f"{message[:self.max_length]}... [{len(message) - self.max_length} characters truncated]"
+            record.args = None
+        return True
+
+
+class RateLimitFilter(logging.Filter):
+    """
+    Lets at most 'records' records per 'seconds' through from the loggers of each limit, errors always pass.
+    A limit applies to a logger name and every logger below it (e.g. 'repo' covers 'repo.git_tracker'), the longest
+    matching name wins. The first record let through after some were dropped says how many.
+    """
+
+    def __init__(self, limits):
+        super().__init__()
+        self.limits = limits
+        self._windows = {}
+        self._prefixes = {}
+        self._lock = threading.Lock()
+
+    def filter(self, record):
+        if record.levelno >= logging.ERROR:
+            return True
+
+        prefix = self._prefix(record.name)
+        if prefix is None:
+            return True
+
+        records, seconds = self.limits[prefix]
+        with self._lock:
+            start, count, dropped = self._windows.get(prefix, (record.created, 0, 0))
+            if record.created - start >= seconds:
+                start, count = record.created, 0
+            if count >= records:
+                self._windows[prefix] = (start, count, dropped + 1)
+                return False
+            self._windows[prefix] = (start, count + 1, 0)
+
+        if dropped:
+            record.msg = f"[{dropped} records of '{prefix}' dropped by its rate limit] {record.getMessage()}"
+            record.args = None
+        return True
+
+    def _prefix(self, name):
+        if name not in self._prefixes:
+            matches = [prefix for prefix in self.limits if name == prefix or name.startswith(f"{prefix}.")]
+            self._prefixes[name] = max(matches, key=len) if matches else None
+        return self._prefixes[name]
+
+
+class DroppingQueueHandler(QueueHandler):
+    """A QueueHandler that drops records while its (bounded) queue is full instead of failing, and says so later"""
+
+    def __init__(self, records_queue):
+        super().__init__(records_queue)
+        self.dropped = 0
+
+    def enqueue(self, record):
+        try:
+            if self.dropped:
+                self.queue.put_nowait(self.prepare(logging.makeLogRecord(
+                    {'name': __name__, 'levelno': logging.WARNING, 'levelname': "WARNING",
+                     'msg': f"{self.dropped} log records dropped, the log writer could not keep up"})))
+                self.dropped = 0
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+class _Listener(QueueListener):
+    def enqueue_sentinel(self):
+        # waits for room, unlike the records the sentinel must not be dropped
+        self.queue.put(self._sentinel, timeout=5)
+
+
+_listener = None
+_queue_handler = None
+
+
+def start_listener(queue_handler, *handlers):
+    """Start the background thread writing what queue_handler queues to the handlers"""
+    global _listener, _queue_handler
+    _queue_handler = queue_handler
+    _listener = _Listener(queue_handler.queue, *handlers, respect_handler_level=True)
+    _listener.start()
+
+
+def stop_listener():
+    """Write out the queued records and stop the background thread, if there is one"""
+    global _listener
+    if _listener is not None:
+        try:
+            _listener.stop()
+        except queue.Full:
+            pass
+        _listener = None
+
+
+def _restart_listener_in_child():
+    # a forked process only has the thread that forked, the listener has to be started again (on a fresh queue)
+    if _listener is not None:
+        _queue_handler.queue = queue.Queue(_queue_handler.queue.maxsize)
+        start_listener(_queue_handler, *_listener.handlers)
+
+
+atexit.register(stop_listener)
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_restart_listener_in_child)
 
 
 class NewRotatingFileHandler(TimedRotatingFileHandler):
     def __init__(self, *args, **kws):
+        self.compress_mode = None
+        self.compress_cls = None
         if kws.__contains__('compress_mode'):
             compress_mode = kws.pop('compress_mode')
-            try:
-                self.compress_cls = COMPRESSION_SUPPORTED[compress_mode]
-            except KeyError:
-                raise ValueError('"%s" compression method not supported.' % compress_mode)
+            if compress_mode is not None:
+                try:
+                    self.compress_cls = COMPRESSION_SUPPORTED[compress_mode]
+                    self.compress_mode = compress_mode
+                except KeyError:
+                    raise ValueError('"%s" compression method not supported.' % compress_mode)
 
         super(NewRotatingFileHandler, self).__init__(*args, **kws)
 
     def doRollover(self):
         super(NewRotatingFileHandler, self).doRollover()
 
-        # # Compress the old log.
-        # yesterday = date.today() - timedelta(days=1)
-        # old_log = self.baseFilename + yesterday.strftime("%Y-%m-%d")
-        # with open(old_log) as log:
-        #     with self.compress_cls.open(old_log + '.gz', 'wb') as comp_log:
-        #         comp_log.writelines(log)
-        #
-        # os.remove(old_log)
+        if self.compress_cls is None:
+            return
+
+        # Compress the old log(s) on their own thread, along with any left uncompressed (e.g. by a crash)
+        directory, base_name = os.path.split(self.baseFilename)
+        old_logs = [os.path.join(directory, name) for name in os.listdir(directory)
+                    if name.startswith(f"{base_name}.") and self.extMatch.match(name[len(base_name) + 1:]) and
+                    not name.endswith(tuple(f".{mode}" for mode in COMPRESSION_SUPPORTED))]
+        if old_logs:
+            threading.Thread(target=compress_logs, args=(self.compress_mode, old_logs), name="log-compression",
+                             daemon=True).start()
+
+
+_compress_lock = threading.Lock()
+
+
+def compress_logs(compress_mode, paths):
+    """Replace log files by their '.gz' or '.zip' compressed copy"""
+    with _compress_lock:
+        for path in paths:
+            if not os.path.exists(path):
+                continue
+            try:
+                if compress_mode == 'zip':
+                    with zipfile.ZipFile(f"{path}.zip", "w", zipfile.ZIP_DEFLATED) as comp_log:
+                        comp_log.write(path, os.path.basename(path))
+                else:
+                    with open(path, "rb") as log, gzip.open(f"{path}.gz", "wb") as comp_log:
+                        shutil.copyfileobj(log, comp_log)
+                os.remove(path)
+            except OSError as e:
+                # compressed by an earlier rollover already, or not writable
+                logging.getLogger(__name__).warning(f"Could not compress {path}: {e}")
 
 
 def get_logger(name):
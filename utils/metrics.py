@@ -0,0 +1,231 @@
+import bisect
+import functools
+import glob
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+from utils.logger import get_logger
+
+logger = get_logger(__name__)
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600)
+COUNT_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 5000)
+BYTES_BUCKETS = tuple(1024 * 4 ** i for i in range(11))
+
+
+class Registry:
+    """
+    Counters and histograms keyed by metric name and label values, rendered in the Prometheus text format.
+    Snapshots of other registries (e.g. from worker processes) can be merged in when rendering.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._help = {}
+        self._types = {}
+        self._buckets = {}
+        self._counters = {}
+        self._histograms = {}
+
+    def counter(self, name, help_text):
+        self._help[name] = help_text
+        self._types[name] = "counter"
+
+    def histogram(self, name, help_text, buckets):
+        self._help[name] = help_text
+        self._types[name] = "histogram"
+        self._buckets[name] = tuple(buckets)
+
+    def inc(self, name, labels, value=1):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def observe(self, name, labels, value):
+        key = (name, tuple(sorted(labels.items())))
+        buckets = self._buckets[name]
+        with self._lock:
+            counts, total = self._histograms.get(key, ([0] * (len(buckets) + 1), 0))
+            counts[bisect.bisect_left(buckets, value)] += 1
+            self._histograms[key] = (counts, total + value)
+
+    def snapshot(self):
+        with self._lock:
+            return {'counters': [[name, list(labels), value] for (name, labels), value in self._counters.items()],
+                    'histograms': [[name, list(labels), list(counts), total]
+                                   for (name, labels), (counts, total) in self._histograms.items()]}
+
+    def render(self, snapshots=()):
+        counters, histograms = {}, {}
+        for snapshot in [self.snapshot()] + list(snapshots):
+            for name, labels, value in snapshot['counters']:
+                key = (name, tuple(map(tuple, labels)))
+                counters[key] = counters.get(key, 0) + value
+            for name, labels, counts, total in snapshot['histograms']:
+                key = (name, tuple(map(tuple, labels)))
+                merged, merged_total = histograms.get(key, ([0] * len(counts), 0))
+                histograms[key] = ([a + b for a, b in zip(merged, counts)], merged_total + total)
+
+        lines = []
+        for name in sorted(self._types):
+            lines.append(f"# HELP {name} {self._help[name]}")
+            lines.append(f"# TYPE {name} {self._types[name]}")
+            if self._types[name] == "counter":
+                for (metric, labels), value in sorted(counters.items()):
+                    if metric == name:
+                        lines.append(f"{name}{format_labels(labels)} {value}")
+                continue
+
+            for (metric, labels), (counts, total) in sorted(histograms.items()):
+                if metric != name:
+                    continue
+                cumulative = 0
+                for bound, count in zip(self._buckets[name] + ("+Inf",), counts):
+                    cumulative += count
+                    lines.append(f"{name}_bucket{format_labels(labels + (('le', str(bound)),))} {cumulative}")
+                lines.append(f"{name}_sum{format_labels(labels)} {total}")
+                lines.append(f"{name}_count{format_labels(labels)} {cumulative}")
+
+        return "\n".join(lines) + "\n"
+
+
+def format_labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{k}="{escape_label(v)}"' for k, v in labels) + "}"
+
+
+def escape_label(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+registry = Registry()
+registry.counter("sync_passes_total", "Passes of the revision tracker loop")
+registry.counter("sync_revisions_total", "Source revisions processed, by result (committed, empty, failed)")
+registry.counter("sync_stage_errors_total", "Tracker stages that raised")
+registry.histogram("sync_stage_seconds", "Wall time of tracker stages", LATENCY_BUCKETS)
+registry.counter("sync_subprocesses_total", "Subprocesses started, by program")
+registry.counter("sync_subprocess_bytes_total", "Bytes read from subprocess output, by program")
+registry.histogram("sync_revision_subprocesses", "Subprocesses started while syncing one revision", COUNT_BUCKETS)
+registry.histogram("sync_revision_subprocess_bytes", "Subprocess output bytes read while syncing one revision",
+                   BYTES_BUCKETS)
+
+_context = threading.local()
+
+
+class RevisionUsage:
+    """Subprocess usage accumulated while fetching and syncing one revision"""
+
+    def __init__(self):
+        self.subprocesses = 0
+        self.bytes = 0
+        # pool threads of the revision add to it concurrently (see in_context)
+        self._lock = threading.Lock()
+
+    def add(self, subprocesses, output_bytes):
+        with self._lock:
+            self.subprocesses += subprocesses
+            self.bytes += output_bytes
+
+
+def set_current_sync(name):
+    """Attribute metrics recorded on this thread to a sync"""
+    _context.sync = name
+
+
+def current_sync():
+    return getattr(_context, 'sync', "")
+
+
+def current_context():
+    """The sync and revision usage of this thread, for work handed to other threads (see in_context)"""
+    return current_sync(), getattr(_context, 'usage', None)
+
+
+@contextmanager
+def in_context(context):
+    """Attribute metrics recorded on this thread to the sync and revision of current_context() on another one"""
+    previous = current_context()
+    _context.sync, _context.usage = context
+    try:
+        yield
+    finally:
+        _context.sync, _context.usage = previous
+
+
+@contextmanager
+def track_revision(usage: RevisionUsage):
+    """Add subprocesses run on this thread to 'usage' while in the block"""
+    previous = getattr(_context, 'usage', None)
+    _context.usage = usage
+    try:
+        yield usage
+    finally:
+        _context.usage = previous
+
+
+def record_subprocess(program, output_bytes=0, started=True):
+    labels = {'sync': current_sync(), 'program': program}
+    if started:
+        registry.inc("sync_subprocesses_total", labels)
+    if output_bytes:
+        registry.inc("sync_subprocess_bytes_total", labels, output_bytes)
+
+    usage = getattr(_context, 'usage', None)
+    if usage is not None:
+        usage.add(1 if started else 0, output_bytes)
+
+
+def record_revision(name, result, usage: RevisionUsage = None):
+    registry.inc("sync_revisions_total", {'sync': name, 'result': result})
+    if usage is not None:
+        registry.observe("sync_revision_subprocesses", {'sync': name}, usage.subprocesses)
+        registry.observe("sync_revision_subprocess_bytes", {'sync': name}, usage.bytes)
+
+
+def record_pass(name):
+    registry.inc("sync_passes_total", {'sync': name})
+
+
+def timed_stage(stage, method):
+    """Wrap a tracker method so that its wall time is recorded as a stage of the tracker's sync"""
+
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        labels = {'sync': getattr(self, 'name', ""), 'tracker': getattr(self, 'type', ""), 'stage': stage}
+        start = time.perf_counter()
+        try:
+            return method(self, *args, **kwargs)
+        except Exception:
+            registry.inc("sync_stage_errors_total", labels)
+            raise
+        finally:
+            registry.observe("sync_stage_seconds", labels, time.perf_counter() - start)
+
+    wrapper.timed_stage = stage
+    return wrapper
+
+
+def save_snapshot(directory, name):
+    """Write the metrics of a sync worker process where the web process picks them up (process-per-sync mode)"""
+    path = f"{directory}{name}.json"
+    with open(f"{path}.tmp", "w") as snapshot_file:
+        json.dump(registry.snapshot(), snapshot_file)
+    os.replace(f"{path}.tmp", path)
+
+
+def render(directory=None):
+    """The metrics of this process, plus the snapshots of the worker processes found in 'directory'"""
+    snapshots = []
+    for path in glob.glob(f"{directory}*.json") if directory else []:
+        try:
+            with open(path) as snapshot_file:
+                snapshots.append(json.load(snapshot_file))
+        except (OSError, ValueError) as e:
+            logger.warning(f"Skipping metrics snapshot {path}: {e}")
+
+    return registry.render(snapshots)
+
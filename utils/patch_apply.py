@@ -0,0 +1,264 @@
+"""
+In-process apply of a parsed diff (see diff_tools.DiffModel) to a working tree, instead of writing a patch file and
+running 'git apply' or 'svn patch' on it.
+
+Hunks are matched exactly (at their position or the nearest offset where their lines are found); with fuzz N up to N
+lines of leading and trailing context may be left out of the match, as GNU patch does. A file is only written when all
+of its hunks apply, atomically, otherwise it is left untouched and its rejected hunks are reported. Binary files are
+skipped: their contents are not in the diff and have to come from the source repository.
+"""
+import os
+import re
+from typing import List
+
+from utils import file_utils
+from utils.diff_tools import DiffModel, FileDiff
+from utils.logger import get_logger
+
+logger = get_logger(__name__)
+
+re_hunk_range = re.compile(r'^@@ -(\d+)(?:,(\d+))? \+(\d+)(?:,(\d+))? @@')
+
+EXECUTABLE_MODE = "100755"
+
+
+class ApplyResult:
+    """What apply_diff did to the working tree, paths are relative to it"""
+
+    def __init__(self):
+        # content digest (file_utils.content_digest) of every file written
+        self.digests = {}
+        self.created = []
+        self.deleted = []
+        # (from, to) pairs
+        self.renamed = []
+        # new git file mode of files whose mode changed (or new files)
+        self.modes = {}
+        # git file mode of the files in 'modes' before the change, None for new files
+        self.old_modes = {}
+        # hunk headers (or the reason the whole file failed) of files left untouched
+        self.rejected = {}
+        # binary files, to be fetched from the source
+        self.skipped = []
+
+    def __str__(self):
+        return (f"{len(self.digests)} written ({len(self.created)} new), {len(self.deleted)} deleted, "
+                f"{len(self.renamed)} renamed, {len(self.skipped)} binary skipped, {len(self.rejected)} rejected")
+
+
+class Hunk:
+    """The lines of one hunk: (tag, text, eol) with tag ' ', '-' or '+' and eol None for a line without newline"""
+
+    def __init__(self, header, old_start, lines):
+        self.header = header
+        self.lines = lines
+        # index of the first old line, an empty old side starts after line 'old_start'
+        self.start = old_start - 1 if any(tag != "+" for tag, _, __ in lines) else old_start
+
+    def old_lines(self):
+        return [text for tag, text, _ in self.lines if tag != "+"]
+
+    def context(self):
+        """the number of context lines before the first and after the last change"""
+        tags = [tag for tag, _, __ in self.lines]
+        leading = next((i for i, tag in enumerate(tags) if tag != " "), len(tags))
+        trailing = next((i for i, tag in enumerate(reversed(tags)) if tag != " "), len(tags))
+        return leading, trailing
+
+
+def read_hunks(model: DiffModel, file: FileDiff) -> List[Hunk]:
+    """The hunks of a file section, their bodies read from the diff lines by the counts in their headers"""
+    hunks = []
+    for i, hunk in enumerate(file.hunks):
+        match = re_hunk_range.match(hunk.header)
+        old_count = int(match.group(2)) if match.group(2) is not None else 1
+        new_count = int(match.group(4)) if match.group(4) is not None else 1
+        stop = file.hunks[i + 1].index if i + 1 < len(file.hunks) else file.end
+
+        lines = []
+        index = hunk.index + 1
+        while index < stop and (old_count > 0 or new_count > 0):
+            line = model.lines[index]
+            # some tools strip the space of empty context lines
+            tag, text = (line[0], line[1:]) if line else (" ", "")
+            if tag == "\\":
+                index += 1
+                continue
+            if tag not in " -+":
+                break
+
+            eol = "\r\n" if text.endswith("\r") else "\n"
+            lines.append((tag, text[:-1] if eol == "\r\n" else text, eol))
+            old_count -= tag != "+"
+            new_count -= tag != "-"
+            index += 1
+
+            if index < stop and model.lines[index].startswith("\\"):
+                lines[-1] = (tag, lines[-1][1], None)
+                index += 1
+
+        if old_count > 0 or new_count > 0:
+            raise ValueError(f"truncated hunk {hunk.header}")
+        hunks.append(Hunk(hunk.header, int(match.group(1)), lines))
+
+    return hunks
+
+
+def patch_lines(lines: List[str], hunks: List[Hunk], fuzz=0, ignore_whitespace=False, cr_stripped=False):
+    """
+    Apply hunks to the lines of a file (line endings included). Added lines keep the line ending they have in the
+    diff, unless its carriage returns were stripped: they then get the ending of the first line of the file.
+
+    :return: the patched lines and the headers of the hunks that could not be placed
+    """
+    normalize = _normalize_whitespace if ignore_whitespace else _strip_eol
+    keys = [normalize(line) for line in lines]
+    default_eol = "\r\n" if cr_stripped and lines and lines[0].endswith("\r\n") else "\n"
+
+    result = []
+    rejected = []
+    position = 0
+    offset = 0
+    for hunk in hunks:
+        found = _locate(keys, hunk, position, offset, fuzz, normalize)
+        if found is None:
+            rejected.append(hunk.header)
+            continue
+
+        at, skip_leading, skip_trailing = found
+        result.extend(lines[position:at])
+        body = hunk.lines[skip_leading:len(hunk.lines) - skip_trailing]
+        current = at
+        for tag, text, eol in body:
+            if tag == " ":
+                result.append(lines[current])
+                current += 1
+            elif tag == "-":
+                current += 1
+            else:
+                result.append(text + (default_eol if eol == "\n" else eol or ""))
+
+        offset = at - skip_leading - hunk.start
+        position = current
+
+    result.extend(lines[position:])
+    return result, rejected
+
+
+def _locate(keys, hunk: Hunk, position, offset, fuzz, normalize):
+    """:return: (line index, leading and trailing context lines left out) where the hunk matches, None if nowhere"""
+    old = [normalize(text) for text in hunk.old_lines()]
+    if not old:
+        # pure additions go where the header says
+        return min(max(hunk.start + offset, position), len(keys)), 0, 0
+
+    leading, trailing = hunk.context()
+    for level in range(min(fuzz, max(leading, trailing)) + 1):
+        skip_leading, skip_trailing = min(level, leading), min(level, trailing)
+        pattern = old[skip_leading:len(old) - skip_trailing]
+        if not pattern:
+            break
+
+        # nearest match to where the hunk is expected (its header moved by the offset of the previous hunks) first
+        expected = min(max(hunk.start + offset + skip_leading, position), len(keys))
+        last = len(keys) - len(pattern)
+        for distance in range(max(expected - position, last - expected) + 1):
+            for at in (expected - distance, expected + distance) if distance else (expected,):
+                if position <= at <= last and keys[at] == pattern[0] and keys[at:at + len(pattern)] == pattern:
+                    return at, skip_leading, skip_trailing
+
+    return None
+
+
+def _strip_eol(line):
+    return line.rstrip("\r\n")
+
+
+def _normalize_whitespace(line):
+    return " ".join(line.split())
+
+
+def apply_diff(model: DiffModel, root, fuzz=0, ignore_whitespace=False) -> ApplyResult:
+    """
+    Apply the text changes of a parsed diff to the working tree at 'root'.
+    Renames whose target already exists (moved beforehand, e.g. by 'svn mv') are patched in place.
+    """
+    if model.lines is None:
+        raise ValueError("The diff was streamed, its lines are not available")
+
+    result = ApplyResult()
+    for file in model.files:
+        path = file.path
+        try:
+            _apply_file(model, file, root, fuzz, ignore_whitespace, result)
+        except (OSError, ValueError) as e:
+            result.rejected[path] = [str(e)]
+
+    for path, reasons in result.rejected.items():
+        logger.warning(f"Could not apply {len(reasons)} hunks to {path}: {reasons}")
+    return result
+
+
+def _apply_file(model, file: FileDiff, root, fuzz, ignore_whitespace, result: ApplyResult):
+    path = file.path
+    target = _resolve(root, path)
+    source = _resolve(root, file.rename_from) if file.rename_from else target
+    if file.rename_from and not os.path.lexists(source):
+        source = target
+
+    if file.is_deleted:
+        if os.path.lexists(target):
+            os.remove(target)
+        result.deleted.append(path)
+        return
+
+    if file.is_binary:
+        result.skipped.append(path)
+        return
+
+    hunks = read_hunks(model, file)
+    if not hunks and not file.is_new and source == target:
+        # property, mode or pure rename of a file moved beforehand, nothing to write
+        _set_mode(file, target, result)
+        return
+
+    existed = os.path.lexists(target)
+    lines = []
+    if not file.is_new:
+        with open(source, "rb") as file_to_read:
+            lines = file_to_read.read().decode("utf-8", errors="surrogateescape").splitlines(keepends=True)
+
+    patched, rejected = patch_lines(lines, hunks, fuzz, ignore_whitespace, model.cr_stripped)
+    if rejected:
+        result.rejected[path] = rejected
+        return
+
+    contents = "".join(patched).encode("utf-8", errors="surrogateescape")
+    file_utils.write_atomically(target, contents)
+    result.digests[path] = file_utils.content_digest(contents)
+    if source != target:
+        os.remove(source)
+        result.renamed.append((file.rename_from, path))
+    elif not existed:
+        result.created.append(path)
+    _set_mode(file, target, result)
+
+
+def _set_mode(file: FileDiff, target, result: ApplyResult):
+    if not file.new_mode or file.new_mode == file.old_mode:
+        return
+
+    result.modes[file.path] = file.new_mode
+    result.old_modes[file.path] = file.old_mode
+    if os.name == "posix" and os.path.exists(target):
+        mode = os.stat(target).st_mode
+        executable = mode | ((mode & 0o444) >> 2)
+        os.chmod(target, executable if file.new_mode == EXECUTABLE_MODE else mode & ~0o111)
+
+
+def _resolve(root, path):
+    """the absolute path of a diff path, which has to stay inside root"""
+    full_path = os.path.normpath(os.path.join(root, path))
+    if os.path.isabs(path) or os.path.relpath(full_path, root).startswith(os.pardir):
+        raise ValueError(f"path outside of the working tree: {path}")
+    return full_path
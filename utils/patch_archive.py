@@ -0,0 +1,312 @@
+"""
+Archive of the patches applied by the syncs, kept compressed and content-addressed:
+
+    <directory>/objects/<2 hex>/<sha256 of the patch>.zst (or .gz)
+    <directory>/index.db        (sync name, revision) => object, in SQLite
+
+zstd is used when the 'zstandard' package is installed, gzip otherwise; objects of either kind are read back.
+Identical patches are stored once. Old entries are pruned by age, count per sync or total size of the archive.
+
+    python -m utils.patch_archive list <name>
+    python -m utils.patch_archive show <name> <rev>
+    python -m utils.patch_archive import <name> <patches directory>
+    python -m utils.patch_archive prune
+"""
+import argparse
+import collections
+import gzip
+import hashlib
+import os
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+
+try:
+    import zstandard
+except ImportError:  # optional, patches are gzipped without it
+    zstandard = None
+
+from utils.logger import get_logger
+
+logger = get_logger(__name__)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS patch (
+    name TEXT NOT NULL,
+    rev TEXT NOT NULL,
+    digest TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    stored_size INTEGER NOT NULL,
+    created REAL NOT NULL,
+    PRIMARY KEY (name, rev)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS patch_by_created ON patch (created);
+CREATE INDEX IF NOT EXISTS patch_by_digest ON patch (digest);
+"""
+
+EXTENSIONS = (".zst", ".gz")
+CHUNK_SIZE = 1024 * 1024
+
+ArchivedPatch = collections.namedtuple('ArchivedPatch', ['name', 'rev', 'digest', 'size', 'stored_size', 'created'])
+
+
+class PatchArchive:
+    """
+    Patches indexed by sync name and revision. Processes share the archive through the SQLite index, object files are
+    only added and removed while holding its write lock.
+
+    :param retention_days: entries older than that are pruned, None to keep them
+    :param retention_count: newest entries kept per sync, None for all
+    :param retention_bytes: most compressed bytes kept in the archive, oldest entries are pruned first
+    :param prune_interval: least seconds between two prunes run by put()
+    :param level: compression level, None for the default of the codec
+    """
+
+    def __init__(self, directory, retention_days=None, retention_count=None, retention_bytes=None,
+                 prune_interval=60 * 60, level=None):
+        self.directory = directory
+        self.retention_days = retention_days
+        self.retention_count = retention_count
+        self.retention_bytes = retention_bytes
+        self.prune_interval = prune_interval
+        self.level = level
+        self._last_prune = 0
+        self._lock = threading.RLock()
+        os.makedirs(os.path.join(directory, "objects"), exist_ok=True)
+        self._connection = sqlite3.connect(os.path.join(directory, "index.db"), timeout=30, isolation_level=None,
+                                           check_same_thread=False)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.executescript(SCHEMA)
+
+    def put(self, name, rev, contents, created=None):
+        """
+        Archive the patch of a revision (str or bytes), replacing what was archived for it before
+
+        :param created: when the patch was made (epoch seconds), now by default
+        :return: the digest of the patch
+        """
+        data = contents.encode("utf-8", errors="surrogateescape") if isinstance(contents, str) else contents
+        return self._store(name, rev, [data], created)
+
+    def put_file(self, name, rev, path, created=None):
+        """Archive a patch file, read in chunks, see put()"""
+        with open(path, "rb") as patch_file:
+            return self._store(name, rev, iter(lambda: patch_file.read(CHUNK_SIZE), b""), created)
+
+    def read(self, name, rev):
+        """:return: the archived patch of a revision, None if there is none"""
+        with self._lock:
+            row = self._connection.execute("SELECT digest FROM patch WHERE name = ? AND rev = ?",
+                                           (name, str(rev))).fetchone()
+        if row is None:
+            return None
+
+        path = self._find_object(row[0])
+        if path is None:
+            raise FileNotFoundError(f"The archived patch of {name}@{rev} is missing its object {row[0]}")
+        with open(path, "rb") as object_file:
+            if path.endswith(".gz"):
+                return gzip.decompress(object_file.read())
+            if zstandard is None:
+                raise RuntimeError(f"{path} is zstd compressed, reading it needs the 'zstandard' package")
+            return zstandard.ZstdDecompressor().stream_reader(object_file).read()
+
+    def list(self, name=None):
+        """:return: the archived patches (of one sync), oldest first"""
+        query = "SELECT name, rev, digest, size, stored_size, created FROM patch"
+        with self._lock:
+            rows = self._connection.execute(f"{query} WHERE name = ? ORDER BY created" if name else
+                                            f"{query} ORDER BY created", (name,) if name else ()).fetchall()
+        return [ArchivedPatch(*row) for row in rows]
+
+    def prune(self, now=None):
+        """Drop the entries outside the retention limits, and the objects no entry refers to any more"""
+        now = now or time.time()
+        with self._lock, self._transaction():
+            victims = set()
+            if self.retention_days is not None:
+                victims.update(self._connection.execute("SELECT name, rev FROM patch WHERE created < ?",
+                                                        (now - self.retention_days * 24 * 60 * 60,)).fetchall())
+            if self.retention_count is not None:
+                victims.update(self._connection.execute(
+                    "SELECT name, rev FROM (SELECT name, rev, ROW_NUMBER() OVER "
+                    "(PARTITION BY name ORDER BY created DESC) AS position FROM patch) WHERE position > ?",
+                    (self.retention_count,)).fetchall())
+            if self.retention_bytes is not None:
+                victims.update(self._over_size(victims))
+
+            digests = set()
+            for name, rev in victims:
+                digests.update(row[0] for row in self._connection.execute(
+                    "SELECT digest FROM patch WHERE name = ? AND rev = ?", (name, rev)))
+                self._connection.execute("DELETE FROM patch WHERE name = ? AND rev = ?", (name, rev))
+            removed = self._remove_unreferenced(digests)
+            self._last_prune = now
+
+        if victims:
+            logger.info(f"Pruned {len(victims)} archived patches, {removed} objects removed")
+        return len(victims)
+
+    def _over_size(self, victims):
+        """the oldest entries to drop for the objects of the others to fit in retention_bytes"""
+        rows = self._connection.execute("SELECT name, rev, digest, stored_size FROM patch ORDER BY created").fetchall()
+        references = collections.Counter(row[2] for row in rows if row[:2] not in victims)
+        sizes = {row[2]: row[3] for row in rows}
+        total = sum(sizes[digest] for digest in references)
+
+        over = []
+        for name, rev, digest, _ in rows:
+            if total <= self.retention_bytes:
+                break
+            if (name, rev) in victims:
+                continue
+            over.append((name, rev))
+            references[digest] -= 1
+            if references[digest] == 0:
+                total -= sizes[digest]
+        return over
+
+    def _store(self, name, rev, chunks, created):
+        extension = ".zst" if zstandard is not None else ".gz"
+        fd, temp_path = tempfile.mkstemp(suffix=".tmp", dir=os.path.join(self.directory, "objects"))
+        try:
+            sha = hashlib.sha256()
+            size = 0
+            with os.fdopen(fd, "wb") as object_file:
+                with self._compressor(object_file) as compressor:
+                    for chunk in chunks:
+                        sha.update(chunk)
+                        size += len(chunk)
+                        compressor.write(chunk)
+            digest = sha.hexdigest()
+            stored_size = os.path.getsize(temp_path)
+
+            with self._lock, self._transaction():
+                existing = self._find_object(digest)
+                if existing is None:
+                    path = self._object_path(digest, extension)
+                    os.makedirs(os.path.dirname(path), exist_ok=True)
+                    os.replace(temp_path, path)
+                else:
+                    stored_size = os.path.getsize(existing)
+                previous = self._connection.execute("SELECT digest FROM patch WHERE name = ? AND rev = ?",
+                                                    (name, str(rev))).fetchone()
+                self._connection.execute("INSERT OR REPLACE INTO patch (name, rev, digest, size, stored_size, created) "
+                                         "VALUES (?, ?, ?, ?, ?, ?)",
+                                         (name, str(rev), digest, size, stored_size, created or time.time()))
+                if previous and previous[0] != digest:
+                    self._remove_unreferenced({previous[0]})
+        finally:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+
+        if time.time() - self._last_prune >= self.prune_interval:
+            self.prune()
+        return digest
+
+    def _compressor(self, object_file):
+        if zstandard is not None:
+            return zstandard.ZstdCompressor(level=self.level or 3).stream_writer(object_file, closefd=False)
+        # no timestamp, the same patch always compresses to the same bytes
+        return gzip.GzipFile(fileobj=object_file, mode="wb", compresslevel=self.level or 6, mtime=0)
+
+    def _remove_unreferenced(self, digests):
+        removed = 0
+        for digest in digests:
+            if self._connection.execute("SELECT 1 FROM patch WHERE digest = ? LIMIT 1", (digest,)).fetchone():
+                continue
+            path = self._find_object(digest)
+            if path is not None:
+                os.remove(path)
+                removed += 1
+        return removed
+
+    def _object_path(self, digest, extension):
+        return os.path.join(self.directory, "objects", digest[:2], f"{digest}{extension}")
+
+    def _find_object(self, digest):
+        for extension in EXTENSIONS:
+            path = self._object_path(digest, extension)
+            if os.path.exists(path):
+                return path
+        return None
+
+    def _transaction(self):
+        return _Transaction(self._connection)
+
+
+class _Transaction:
+    """BEGIN IMMEDIATE ... COMMIT (ROLLBACK on error), other processes wait for the write lock meanwhile"""
+
+    def __init__(self, connection):
+        self.connection = connection
+
+    def __enter__(self):
+        self.connection.execute("BEGIN IMMEDIATE")
+
+    def __exit__(self, exc_type, exc, tb):
+        self.connection.execute("ROLLBACK" if exc_type else "COMMIT")
+
+
+_archives = {}
+_archives_lock = threading.Lock()
+
+
+def get_archive(directory, **kwargs) -> PatchArchive:
+    """The archive in a directory, one connection per process (worker processes open their own)"""
+    key = (os.getpid(), directory)
+    with _archives_lock:
+        if key not in _archives:
+            logger.info(f"Opening patch archive: {directory}")
+            _archives[key] = PatchArchive(directory, **kwargs)
+        return _archives[key]
+
+
+def main(argv=None):
+    from server import config
+
+    parser = argparse.ArgumentParser(description="Read back and maintain the patch archive")
+    parser.add_argument("--archive", default=config.patch_archive_dir)
+    commands = parser.add_subparsers(dest="command", required=True)
+    list_parser = commands.add_parser("list", help="the archived patches of a sync (of all syncs without a name)")
+    list_parser.add_argument("name", nargs="?")
+    show_parser = commands.add_parser("show", help="write the patch of a revision to stdout")
+    show_parser.add_argument("name")
+    show_parser.add_argument("rev")
+    import_parser = commands.add_parser("import", help="archive (and delete) the '<rev>.txt' patches of a sync")
+    import_parser.add_argument("name")
+    import_parser.add_argument("directory", help="e.g. the sync's folder in patches_dir")
+    commands.add_parser("prune", help="apply the configured retention now")
+    args = parser.parse_args(argv)
+
+    archive = PatchArchive(args.archive, retention_days=config.PATCH_RETENTION_DAYS,
+                           retention_count=config.PATCH_RETENTION_COUNT,
+                           retention_bytes=config.PATCH_RETENTION_BYTES)
+    if args.command == "list":
+        for patch in archive.list(args.name):
+            created = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(patch.created))
+            print(f"{patch.name}\t{patch.rev}\t{created}\t{patch.size}\t{patch.stored_size}\t{patch.digest}")
+    elif args.command == "show":
+        contents = archive.read(args.name, args.rev)
+        if contents is None:
+            print(f"No patch archived for {args.name}@{args.rev}", file=sys.stderr)
+            return 1
+        sys.stdout.buffer.write(contents)
+    elif args.command == "import":
+        imported = 0
+        for entry in sorted(os.scandir(args.directory), key=lambda e: e.stat().st_mtime):
+            # current.txt is the patch a sync is applying right now (see TrackerBase.patch_path), not an old one
+            if entry.is_file() and entry.name.endswith(".txt") and entry.name != "current.txt":
+                archive.put_file(args.name, entry.name[:-len(".txt")], entry.path, created=entry.stat().st_mtime)
+                os.remove(entry.path)
+                imported += 1
+        print(f"Archived {imported} patches of {args.name}")
+    else:
+        print(f"Pruned {archive.prune()} patches")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,101 @@
+import queue
+import threading
+from typing import Any, List, NamedTuple
+
+from utils import metrics, tracing
+from utils.diff_tools import DiffStream
+from utils.logger import get_logger
+
+logger = get_logger(__name__)
+
+
+class PendingRevision(NamedTuple):
+    rev: str
+    date: Any
+    msg: str
+    author: str
+    diff: Any
+    files: List[str]
+    usage: metrics.RevisionUsage
+
+
+class RevisionPrefetcher:
+    """
+    Fetches the diffs and metadata of upcoming revisions on a background thread while the current one is applied.
+    At most 'depth' revisions are fetched ahead and they are handed out in order. Diffs are parsed the way the target
+    will read them, and binary files are read from the source ahead of time (see TrackerBase.prefetch_files).
+    A depth of 0 fetches every revision synchronously when it is needed.
+    """
+
+    _done = object()
+
+    def __init__(self, source, target, revs, depth, blob_budget=0, trace_dir=None):
+        self.source = source
+        self.target = target
+        self.revs = revs
+        self.depth = depth
+        self.blob_budget = blob_budget
+        self.trace_dir = trace_dir
+        self._queue = queue.Queue(maxsize=max(depth, 1))
+        self._stop = threading.Event()
+        self._thread = None
+
+    def __iter__(self):
+        if self.depth <= 0:
+            for rev in self.revs:
+                yield self.fetch(rev)
+            return
+
+        self._thread = threading.Thread(target=self._run, args=(metrics.current_sync(),),
+                                        name=f"prefetch-{self.source.name}", daemon=True)
+        self._thread.start()
+        while True:
+            item = self._queue.get()
+            if item is self._done:
+                return
+            if isinstance(item, Exception):
+                raise item
+            yield item
+
+    def fetch(self, rev) -> PendingRevision:
+        with metrics.track_revision(metrics.RevisionUsage()) as usage, \
+                tracing.revision_trace(self.trace_dir, self.source.name, rev, "fetch"):
+            date, msg, author, diff, files = self.source.get_diff(rev)
+            if not isinstance(diff, DiffStream):
+                diff = self.target.parse_diff(diff)
+                if self.blob_budget > 0:
+                    self.source.prefetch_files(rev, diff.binary_files(), self.blob_budget)
+
+        return PendingRevision(rev, date, msg, author, diff, files, usage)
+
+    def close(self):
+        """Stop fetching ahead and release anything already fetched"""
+        self._stop.set()
+        if self._thread is not None:
+            while self._thread.is_alive():
+                try:
+                    self._queue.get(timeout=0.1)
+                except queue.Empty:
+                    pass
+            self._thread = None
+        self.source.clear_prefetched()
+
+    def _run(self, sync_name):
+        metrics.set_current_sync(sync_name)
+        try:
+            for rev in self.revs:
+                if self._stop.is_set():
+                    return
+                self._put(self.fetch(rev))
+            self._put(self._done)
+        except Exception as e:
+            logger.error(f"Failed to prefetch revisions for '{self.source.name}'", exc_info=e)
+            self._put(e)
+
+    def _put(self, item):
+        while not self._stop.is_set():
+            try:
+                self._queue.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                pass
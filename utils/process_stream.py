@@ -0,0 +1,39 @@
+import io
+import subprocess
+
+from utils import metrics
+
+
+class ProcessStream(io.RawIOBase):
+    """
+    The stdout of a command as a readable binary stream, read straight from the pipe. Reaching the end of the output
+    raises CalledProcessError if the command failed, so that a partial output is never taken for a whole one.
+    Closing the stream before its end kills the command.
+    """
+
+    def __init__(self, cmd, cwd):
+        super().__init__()
+        self.cmd = cmd
+        self._process = subprocess.Popen(cmd, stdout=subprocess.PIPE, cwd=cwd, bufsize=0)
+        metrics.record_subprocess(cmd[0])
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        count = self._process.stdout.readinto(buffer)
+        if count:
+            metrics.record_subprocess(self.cmd[0], count, started=False)
+            return count
+
+        returncode = self._process.wait()
+        if returncode != 0:
+            raise subprocess.CalledProcessError(returncode, self.cmd)
+        return 0
+
+    def close(self):
+        if self._process.poll() is None:
+            self._process.kill()
+        self._process.wait()
+        self._process.stdout.close()
+        super().close()
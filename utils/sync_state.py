@@ -0,0 +1,267 @@
+import os
+import sqlite3
+import threading
+import time
+
+from utils.logger import get_logger
+
+logger = get_logger(__name__)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS checkpoint (
+    name TEXT PRIMARY KEY,
+    src_rev TEXT NOT NULL,
+    target_rev TEXT NOT NULL,
+    position INTEGER NOT NULL DEFAULT 0,
+    updated REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS pending (
+    name TEXT NOT NULL,
+    seq INTEGER NOT NULL,
+    rev TEXT NOT NULL,
+    PRIMARY KEY (name, seq)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS revision_status (
+    name TEXT NOT NULL,
+    rev TEXT NOT NULL,
+    status TEXT NOT NULL,
+    target_rev TEXT,
+    updated REAL NOT NULL,
+    PRIMARY KEY (name, rev)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS revision_status_by_status ON revision_status (name, status);
+CREATE TABLE IF NOT EXISTS revision_map (
+    name TEXT NOT NULL,
+    src_rev TEXT NOT NULL,
+    target_rev TEXT NOT NULL,
+    PRIMARY KEY (name, src_rev)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS revision_map_by_target ON revision_map (name, target_rev);
+CREATE TABLE IF NOT EXISTS revision_map_backfill (
+    name TEXT PRIMARY KEY,
+    mapped INTEGER NOT NULL,
+    updated REAL NOT NULL
+);
+"""
+
+
+class SyncStateStore:
+    """
+    Sync state (checkpoint, pending queue, per-revision status and the source <=> target revision map) kept in a
+    SQLite database in WAL mode. Writes are group-committed: they are buffered in memory and written in one
+    transaction after 'group_size' writes, 'group_delay' seconds after the first of them (by a timer), on flush() or
+    together with the next durable write (e.g. a checkpoint), so a crash can only lose status rows written since the
+    last checkpoint. Durable writes are synced to disk (synchronous=FULL), the others only reach the OS.
+    """
+
+    def __init__(self, path, group_size=64, group_delay=1.0):
+        self.path = path
+        self.group_size = group_size
+        self.group_delay = group_delay
+        self._lock = threading.RLock()
+        self._connection = sqlite3.connect(path, timeout=30, isolation_level=None, check_same_thread=False)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute("PRAGMA synchronous=NORMAL")
+        self._connection.executescript(SCHEMA)
+        # statements waiting for their group commit, kept in memory so no write lock is held in between
+        self._buffer = []
+        self._timer = None
+
+    def get_checkpoint(self, name):
+        """:return: (src_rev, target_rev, position) or None if the sync has no checkpoint yet"""
+        with self._lock:
+            return self._connection.execute("SELECT src_rev, target_rev, position FROM checkpoint WHERE name = ?",
+                                            (name,)).fetchone()
+
+    def set_checkpoint(self, name, src_rev, target_rev, position=0):
+        self.write("INSERT INTO checkpoint (name, src_rev, target_rev, position, updated) VALUES (?, ?, ?, ?, ?) "
+                   "ON CONFLICT (name) DO UPDATE SET src_rev = excluded.src_rev, target_rev = excluded.target_rev, "
+                   "position = excluded.position, updated = excluded.updated",
+                   (name, str(src_rev), str(target_rev), position, time.time()), durable=True)
+
+    def replace_pending(self, name, revs):
+        with self._lock:
+            self._buffer.append(("DELETE FROM pending WHERE name = ?", (name,)))
+            self._commit("INSERT INTO pending (name, seq, rev) VALUES (?, ?, ?)",
+                         ((name, seq, str(rev)) for seq, rev in enumerate(revs)))
+
+    def count_pending(self, name):
+        with self._lock:
+            return self._connection.execute("SELECT count(*) FROM pending WHERE name = ?", (name,)).fetchone()[0]
+
+    def read_pending(self, name, start, stop, limit):
+        """pending revisions with start <= seq < stop (stop None for no bound), at most 'limit' of them"""
+        with self._lock:
+            rows = self._connection.execute(
+                "SELECT rev FROM pending WHERE name = ? AND seq >= ? AND seq < ? ORDER BY seq LIMIT ?",
+                (name, start, stop if stop is not None else 2 ** 62, limit)).fetchall()
+        return [row[0] for row in rows]
+
+    def set_revision_status(self, name, rev, status, target_rev=None):
+        self.write("INSERT INTO revision_status (name, rev, status, target_rev, updated) VALUES (?, ?, ?, ?, ?) "
+                   "ON CONFLICT (name, rev) DO UPDATE SET status = excluded.status, "
+                   "target_rev = coalesce(excluded.target_rev, target_rev), updated = excluded.updated",
+                   (name, str(rev), status, None if target_rev is None else str(target_rev), time.time()))
+
+    def get_revision_status(self, name, rev):
+        """:return: (status, target_rev) or None"""
+        with self._lock:
+            self.flush()
+            return self._connection.execute("SELECT status, target_rev FROM revision_status WHERE name = ? AND rev = ?",
+                                            (name, str(rev))).fetchone()
+
+    def list_revision_status(self, name):
+        """:return: (rev, status, target_rev, updated) of every revision of a sync, in the order they were recorded"""
+        with self._lock:
+            self.flush()
+            return self._connection.execute("SELECT rev, status, target_rev, updated FROM revision_status "
+                                            "WHERE name = ? ORDER BY updated", (name,)).fetchall()
+
+    def map_revision(self, name, src_rev, target_rev):
+        self.write("INSERT OR REPLACE INTO revision_map (name, src_rev, target_rev) VALUES (?, ?, ?)",
+                   (name, str(src_rev), str(target_rev)))
+
+    def backfill_revision_map(self, name, pairs):
+        """bulk insert of (src_rev, target_rev) pairs found in the target history, recording that the backfill ran"""
+        pairs = list(pairs)
+        with self._lock:
+            self._buffer.append(("INSERT OR REPLACE INTO revision_map_backfill (name, mapped, updated) "
+                                 "VALUES (?, ?, ?)", (name, len(pairs), time.time())))
+            self._commit("INSERT OR REPLACE INTO revision_map (name, src_rev, target_rev) VALUES (?, ?, ?)",
+                         ((name, str(s), str(t)) for s, t in pairs))
+
+    def is_revision_map_backfilled(self, name):
+        with self._lock:
+            return self._connection.execute("SELECT 1 FROM revision_map_backfill WHERE name = ?",
+                                            (name,)).fetchone() is not None
+
+    def lookup_revision(self, name, rev):
+        """
+        Find a revision on either side of the map, a git hash may be abbreviated (at least 7 characters)
+
+        :return: (src_rev, target_rev) pairs, empty if the revision is not mapped
+        """
+        rev = str(rev)
+        with self._lock:
+            self.flush()
+            rows = self._connection.execute(
+                "SELECT src_rev, target_rev FROM revision_map WHERE name = ? AND src_rev = ? UNION "
+                "SELECT src_rev, target_rev FROM revision_map WHERE name = ? AND target_rev = ?",
+                (name, rev, name, rev)).fetchall()
+            if rows or len(rev) < 7 or rev.isdigit():
+                return rows
+
+            # abbreviated hashes, as ranges so the indexes are used
+            return self._connection.execute(
+                "SELECT src_rev, target_rev FROM revision_map WHERE name = ? AND src_rev >= ? AND src_rev < ? UNION "
+                "SELECT src_rev, target_rev FROM revision_map WHERE name = ? AND target_rev >= ? AND target_rev < ? "
+                "LIMIT 2", (name, rev, rev + "~", name, rev, rev + "~")).fetchall()
+
+    def write(self, sql, params=(), durable=False):
+        with self._lock:
+            self._buffer.append((sql, params))
+            if durable or len(self._buffer) >= self.group_size:
+                self._commit(durable=durable)
+            elif self._timer is None:
+                self._timer = threading.Timer(self.group_delay, self._flush_later)
+                self._timer.daemon = True
+                self._timer.start()
+
+    def flush(self):
+        with self._lock:
+            if self._buffer:
+                self._commit()
+
+    def _flush_later(self):
+        """group commit of the writes buffered for 'group_delay' seconds, run by the timer"""
+        try:
+            with self._lock:
+                self._timer = None
+                if self._buffer:
+                    self._commit()
+        except sqlite3.Error as e:
+            logger.warning(f"Group commit of {len(self._buffer)} state writes failed, retrying with the next one: {e}")
+
+    def close(self):
+        with self._lock:
+            self.flush()
+            self._connection.close()
+
+    def _commit(self, sql=None, rows=(), durable=False):
+        """Write the buffered statements (and an optional bulk statement) in one transaction"""
+        if durable:
+            self._connection.execute("PRAGMA synchronous=FULL")
+        try:
+            self._connection.execute("BEGIN IMMEDIATE")
+            try:
+                for buffered_sql, params in self._buffer:
+                    self._connection.execute(buffered_sql, params)
+                if sql:
+                    self._connection.executemany(sql, rows)
+                self._connection.execute("COMMIT")
+            except Exception:
+                self._connection.execute("ROLLBACK")
+                raise
+        finally:
+            if durable:
+                self._connection.execute("PRAGMA synchronous=NORMAL")
+        self._buffer.clear()
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+
+
+class PendingRevisions:
+    """
+    A read-only, lazily loaded view of the pending queue of a sync: len() and indexing query the database and
+    iteration reads 'chunk_size' revisions at a time, so a long queue is never held in memory as a whole.
+    """
+
+    def __init__(self, store: SyncStateStore, name, start=0, stop=None, chunk_size=1000):
+        self.store = store
+        self.name = name
+        self.start = start
+        self.stop = stop
+        self.chunk_size = chunk_size
+
+    def __len__(self):
+        total = self.store.count_pending(self.name)
+        stop = total if self.stop is None else min(self.stop, total)
+        return max(stop - self.start, 0)
+
+    def __getitem__(self, item):
+        if isinstance(item, slice):
+            if item.step not in (None, 1):
+                raise ValueError("Pending revisions can only be sliced with a step of 1")
+            start, stop, _ = item.indices(len(self))
+            return PendingRevisions(self.store, self.name, self.start + start, self.start + max(start, stop),
+                                    self.chunk_size)
+
+        index = item + len(self) if item < 0 else item
+        revs = self.store.read_pending(self.name, self.start + index, self.stop, 1) if index >= 0 else []
+        if not revs:
+            raise IndexError(f"Pending revision index {item} out of range")
+        return revs[0]
+
+    def __iter__(self):
+        seq = self.start
+        while True:
+            revs = self.store.read_pending(self.name, seq, self.stop, self.chunk_size)
+            yield from revs
+            if len(revs) < self.chunk_size:
+                return
+            seq += len(revs)
+
+
+_stores = {}
+_stores_lock = threading.Lock()
+
+
+def get_store(path, **kwargs) -> SyncStateStore:
+    """The store for a database file, one connection per process (worker processes open their own)"""
+    key = (os.getpid(), path)
+    with _stores_lock:
+        if key not in _stores:
+            logger.info(f"Opening sync state database: {path}")
+            _stores[key] = SyncStateStore(path, **kwargs)
+        return _stores[key]
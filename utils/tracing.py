@@ -0,0 +1,284 @@
+import cProfile
+import collections
+import functools
+import itertools
+import json
+import os
+import re
+import sys
+import threading
+import time
+from contextlib import contextmanager
+
+try:
+    import resource
+except ImportError:  # not available on Windows, child rusage is left out of the spans there
+    resource = None
+
+from utils.logger import get_logger
+
+logger = get_logger(__name__)
+
+_context = threading.local()
+_span_ids = itertools.count(1)
+_write_lock = threading.Lock()
+
+
+class Trace:
+    """The spans of one revision of a sync, written as JSON lines to '<directory><sync>.jsonl' when it ends"""
+
+    def __init__(self, directory, sync, rev, phase):
+        self.directory = directory
+        self.sync = sync
+        self.rev = str(rev)
+        self.phase = phase
+        self.spans = []
+        self.stack = []
+
+    def fork(self):
+        """The trace as seen from another thread: the same spans, nested under the current span of this thread"""
+        forked = Trace(self.directory, self.sync, self.rev, self.phase)
+        forked.spans = self.spans
+        forked.stack = self.stack[-1:]
+        return forked
+
+    def write(self):
+        lines = "".join(json.dumps(span, default=str) + "\n" for span in self.spans)
+        with _write_lock:
+            with open(f"{self.directory}{self.sync}.jsonl", "a", encoding="utf-8") as trace_file:
+                trace_file.write(lines)
+
+
+@contextmanager
+def revision_trace(directory, sync, rev, phase="commit"):
+    """Collect the spans of everything this thread runs for a revision, nothing is collected if directory is None"""
+    if directory is None:
+        yield None
+        return
+
+    previous = getattr(_context, 'trace', None)
+    trace = _context.trace = Trace(directory, sync, rev, phase)
+    try:
+        with span(f"revision:{phase}", "revision"):
+            yield trace
+    finally:
+        _context.trace = previous
+        try:
+            trace.write()
+        except OSError as e:
+            logger.warning(f"Could not write trace of {sync}@{rev}: {e}")
+
+
+def current_trace():
+    return getattr(_context, 'trace', None)
+
+
+@contextmanager
+def in_trace(trace):
+    """Add the spans of this thread to a trace of another thread (see current_trace), e.g. in a pool worker"""
+    previous = current_trace()
+    _context.trace = trace.fork() if trace is not None else None
+    try:
+        yield
+    finally:
+        _context.trace = previous
+
+
+@contextmanager
+def span(name, kind="method", **attributes):
+    """A timed span (wall and thread CPU time, child rusage) in the current revision trace, if there is one"""
+    trace = getattr(_context, 'trace', None)
+    if trace is None:
+        yield None
+        return
+
+    record = {'sync': trace.sync, 'rev': trace.rev, 'phase': trace.phase, 'id': next(_span_ids),
+              'parent': trace.stack[-1]['id'] if trace.stack else None, 'name': name, 'kind': kind,
+              'thread': threading.current_thread().name, 'start': time.time()}
+    record.update(attributes)
+    children_before = resource.getrusage(resource.RUSAGE_CHILDREN) if resource else None
+    wall, cpu = time.perf_counter(), time.thread_time()
+    trace.stack.append(record)
+    try:
+        yield record
+    except Exception as e:
+        record['error'] = repr(e)
+        raise
+    finally:
+        trace.stack.pop()
+        record['wall'] = time.perf_counter() - wall
+        record['cpu'] = time.thread_time() - cpu
+        if children_before is not None:
+            # process wide, so it includes children of other threads that ended meanwhile
+            children = resource.getrusage(resource.RUSAGE_CHILDREN)
+            record['child_utime'] = children.ru_utime - children_before.ru_utime
+            record['child_stime'] = children.ru_stime - children_before.ru_stime
+            record['child_maxrss'] = children.ru_maxrss
+        trace.spans.append(record)
+
+
+def subprocess_span(argv):
+    return span(str(argv[0]) if argv else "subprocess", "subprocess", argv=[str(arg) for arg in argv])
+
+
+def traced_method(name, method):
+    """Wrap a tracker method in a span named '<class>.<method>'"""
+
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        if getattr(_context, 'trace', None) is None:
+            return method(self, *args, **kwargs)
+        with span(f"{type(self).__name__}.{name}"):
+            return method(self, *args, **kwargs)
+
+    return wrapper
+
+
+class ProfileRequests:
+    """
+    Pending requests to profile the next N revisions of a sync, kept as files in 'directory' so that the web process
+    can reach sync workers running in other processes. Every request is a new '<sync>.<time>-<pid>.request' file,
+    which take() claims by renaming it to '<sync>.profiling' (the newest request wins), so only the sync worker ever
+    rewrites the count and a request never gets lost in a concurrent read-modify-write.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        self._lock = threading.Lock()
+
+    def request(self, sync, revisions, mode="cprofile"):
+        if mode not in ("cprofile", "sampling"):
+            raise ValueError(f"Unknown profiler '{mode}', use 'cprofile' or 'sampling'")
+
+        self._write(f"{self.directory}{sync}.{time.time_ns()}-{os.getpid()}.request",
+                    {'revisions': int(revisions), 'mode': mode})
+        logger.info(f"Profiling the next {revisions} revisions of '{sync}' with {mode}")
+
+    def get(self, sync):
+        """the request being worked through, or else the newest one still waiting, None if there is none"""
+        for path in self._requests(sync)[::-1] + [self._active_path(sync)]:
+            try:
+                with open(path, encoding="utf-8") as request_file:
+                    return json.load(request_file)
+            except FileNotFoundError:
+                continue
+        return None
+
+    def take(self, sync):
+        """:return: the profiler mode to use for one revision, None if the sync is not being profiled"""
+        path = self._active_path(sync)
+        with self._lock:
+            try:
+                self._claim(sync)
+                with open(path, encoding="utf-8") as request_file:
+                    pending = json.load(request_file)
+            except (OSError, ValueError):
+                return None
+
+            pending['revisions'] -= 1
+            if pending['revisions'] > 0:
+                self._write(path, pending)
+            else:
+                os.remove(path)
+            return pending['mode']
+
+    def _claim(self, sync):
+        """make the newest request of a sync the active one, dropping the older ones"""
+        requests = self._requests(sync)
+        for path in requests[:-1]:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+        if requests:
+            try:
+                os.replace(requests[-1], self._active_path(sync))
+            except FileNotFoundError:
+                pass
+
+    def _requests(self, sync):
+        """paths of the requests waiting for a sync, oldest first"""
+        pattern = re.compile(rf"{re.escape(sync)}\.(\d+)-\d+\.request")
+        try:
+            names = os.listdir(self.directory)
+        except FileNotFoundError:
+            return []
+        matches = [(int(match.group(1)), name) for name in names for match in [pattern.fullmatch(name)] if match]
+        return [f"{self.directory}{name}" for _, name in sorted(matches)]
+
+    def _active_path(self, sync):
+        return f"{self.directory}{sync}.profiling"
+
+    @staticmethod
+    def _write(path, pending):
+        with open(f"{path}.tmp", "w", encoding="utf-8") as request_file:
+            json.dump(pending, request_file)
+        os.replace(f"{path}.tmp", path)
+
+
+class SamplingProfiler:
+    """Samples the stack of one thread every 'interval' seconds and counts the stacks it sees"""
+
+    def __init__(self, thread_id, interval=0.005):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stacks = collections.Counter()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="sampling-profiler", daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+                frame = frame.f_back
+            if stack:
+                self.stacks[";".join(reversed(stack))] += 1
+
+    def dump(self, path):
+        """collapsed stacks, one '<frame;frame;...> <count>' line each, as flame graph tools read them"""
+        with open(path, "w", encoding="utf-8") as profile_file:
+            for stack, count in self.stacks.most_common():
+                profile_file.write(f"{stack} {count}\n")
+
+
+@contextmanager
+def profiled(mode, path_prefix):
+    """Profile the block on this thread with cProfile ('.prof') or the sampling profiler ('.folded')"""
+    if mode is None:
+        yield
+        return
+
+    if mode == "sampling":
+        profiler = SamplingProfiler(threading.get_ident())
+        profiler.start()
+        try:
+            yield
+        finally:
+            profiler.stop()
+            profiler.dump(f"{path_prefix}.folded")
+        return
+
+    profiler = cProfile.Profile()
+    try:
+        profiler.enable()
+    except ValueError as e:
+        # only one cProfile can be active at a time (e.g. another sync thread is being profiled)
+        logger.warning(f"Not profiling {path_prefix}: {e}")
+        yield
+        return
+
+    try:
+        yield
+    finally:
+        profiler.disable()
+        profiler.dump_stats(f"{path_prefix}.prof")
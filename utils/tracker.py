@@ -1,29 +1,42 @@
-import shutil
+import os
 
 from utils import file_utils
+from utils.sync_state import get_store, PendingRevisions
 
 from utils.logger import get_logger
-from server.config import tracker_dir
+from server.config import tracker_dir, STATE_DB, STATE_GROUP_COMMIT_SIZE, STATE_GROUP_COMMIT_DELAY
 
 logger = get_logger(__name__)
 
 
+def store():
+    return get_store(STATE_DB, group_size=STATE_GROUP_COMMIT_SIZE, group_delay=STATE_GROUP_COMMIT_DELAY)
+
+
 def initialize(name):
+    """Make sure the sync has a checkpoint, importing it (and its pending queue) from the old flat files once"""
+    if store().get_checkpoint(name) is not None:
+        return
+
     filename = f"{tracker_dir}sync_last_{name}"
-    shutil.copy(filename, f"{filename}.bk")
+    with open(filename, "r") as infile:
+        src_rev, target_rev_and_pos = infile.read().strip().split('=>')
 
+    target_rev, _, pos = target_rev_and_pos.partition('@')
+    pending_file_name = f"{tracker_dir}pending_{name}"
+    if file_utils.file_exists(pending_file_name):
+        with open(pending_file_name, "r") as pending_file:
+            store().replace_pending(name, [rev.strip() for rev in pending_file if rev.strip()])
+        os.replace(pending_file_name, f"{pending_file_name}.bk")
 
-def get_last_revision(name):
-    with open(f"{tracker_dir}sync_last_{name}", "r") as infile:
-        src_rev, target_rev_and_pos = infile.read().split('=>')
-        infile.close()
+    logger.info(f"Importing '{name}' sync state from {filename}: {src_rev} => {target_rev}@{pos}")
+    store().set_checkpoint(name, src_rev, target_rev, int(pos) if pos else 0)
+    os.replace(filename, f"{filename}.bk")
 
-    if "@" in target_rev_and_pos:
-        target_rev, pos = target_rev_and_pos.split('@')
-        pos = 0 if not pos else int(pos)
-        return src_rev, target_rev, pos
 
-    return src_rev, target_rev_and_pos, 0
+def get_last_revision(name):
+    src_rev, target_rev, pos = store().get_checkpoint(name)
+    return src_rev, target_rev, pos
 
 
 def get_last_src_revision(name):
@@ -46,35 +59,63 @@ def get_last_target_revision(name):
 
 def set_last_revision(name, src_rev, target_rev, pos=0):
     logger.info(f"Saving last revision {src_rev} => {target_rev}")
-    with open(f"{tracker_dir}sync_last_{name}", "w") as save_file:
-        save_file.write(f"{src_rev}=>{target_rev}@{pos}")
-        save_file.flush()
-        save_file.close()
+    store().set_checkpoint(name, src_rev, target_rev, pos)
+
+
+def set_revision_status(name, rev, status, target_rev=None):
+    """Record what happened to a source revision ('empty', 'synced' or 'failed'), group-committed"""
+    store().set_revision_status(name, rev, status, target_rev)
+
+
+def get_revision_status(name, rev):
+    return store().get_revision_status(name, rev)
+
+
+def list_revision_status(name):
+    return store().list_revision_status(name)
+
+
+def map_revision(name, src_rev, target_rev):
+    store().map_revision(name, src_rev, target_rev)
+
+
+def lookup_revision(name, rev):
+    """:return: (src_rev, target_rev) pairs that 'rev' is part of, on either side"""
+    return store().lookup_revision(name, rev)
+
+
+def rebuild_revision_map(name, target):
+    """Backfill the revision map of a sync from the '#Synced from:' trailers of its target, once"""
+    if store().is_revision_map_backfilled(name):
+        return
+
+    logger.info(f"Rebuilding the '{name}' revision map from the {target.type} history")
+    pairs = list(target.get_synced_revisions())
+    store().backfill_revision_map(name, pairs)
+    logger.info(f"Mapped {len(pairs)} revisions for '{name}'")
+
+
+def flush():
+    """Commit state writes still waiting for their group commit"""
+    store().flush()
 
 
 def save_pending_revisions(name, pending_revs):
     if not pending_revs or len(pending_revs) <= 0:
-        print("No revs to write")
+        logger.info("No revs to write")
+        return
+
+    if isinstance(pending_revs, PendingRevisions):
+        # already the stored queue
         return
 
-    logger.info(f"Writing {len(pending_revs)} revs to 'pending' file")
-    with open(f"{tracker_dir}pending_{name}", "w") as pending_file:
-        pending_file.write("\n".join(map(str, pending_revs)))
-        pending_file.flush()
-        pending_file.close()
+    logger.info(f"Writing {len(pending_revs)} revs to the pending queue")
+    store().replace_pending(name, pending_revs)
 
 
-def get_pending_revisions(name):
+def get_pending_revisions(name) -> PendingRevisions:
     if not name:
         raise Exception("'Name' is required to load revisions")
 
-    revs = []
-    pending_file_name = f"{tracker_dir}pending_{name}"
-    logger.info(f"Loading '{name}' revs from 'pending' file: {pending_file_name}")
-
-    if file_utils.file_exists(pending_file_name):
-        with open(pending_file_name, "r") as pending_file:
-            revs = pending_file.readlines()
-            pending_file.close()
-
-    return list(map(str.strip, revs))
+    logger.info(f"Loading '{name}' revs from the pending queue")
+    return PendingRevisions(store(), name)